@@ -0,0 +1,89 @@
+import argparse
+import time
+from datetime import datetime, timezone
+from pymongo import MongoClient, UpdateOne
+from beershop.utils.config import Config
+from beershop.utils.durability import with_durability
+
+
+# parse arguments
+parser = argparse.ArgumentParser(
+    description=(
+        'Measure latency and throughput of the writes of orders, queue and stock for every durability profile. '
+        'Writes go to a scratch database named after the configured one, with the suffix "-benchmark".'
+    )
+)
+parser.add_argument('-config', dest='config', help='Configuration file in yaml format.')
+parser.add_argument('-n', dest='n', type=int, default=1000, help='Number of orders written for every profile.')
+parser.add_argument('-profiles', dest='profiles', nargs='+', help='Profiles to measure. Default: all the profiles.')
+args = parser.parse_args()
+
+config = Config.load(args.config)
+client = MongoClient(
+    host=config.database['host'],
+    port=config.database['port'],
+    serverSelectionTimeoutMS=config.database['timeout'],
+    **({'replicaSet': config.database['replicaset']} if config.database.get('replicaset') else {})
+)
+db = client[f"{config.database['name']}-benchmark"]
+
+def percentile(latencies, q):
+    return sorted(latencies)[int(len(latencies) * q)] * 1000
+
+def measure(durability):
+    db.drop_collection('orders')
+    db.drop_collection('orderqueue')
+    db.drop_collection('items')
+    db['items'].insert_one({'id': '0001', 'instock': args.n * 10})
+
+    # same writes of the api and of the queue handler, with the write concerns of the profile
+    orders = with_durability(db['orders'], durability, 'insert')
+    queue = with_durability(db['orderqueue'], durability, 'insert')
+    items = with_durability(db['items'], durability, 'update')
+    updates = with_durability(db['orders'], durability, 'update')
+
+    latencies = {'order': [], 'stock': []}
+    start = time.perf_counter()
+    for count in range(args.n):
+        order = {
+            'type': 'new',
+            'id': f'{count + 1:06d}',
+            'order': {'id': '0001', 'quantity': 1},
+            'user': 'benchmark',
+            'creationtime': datetime.now(timezone.utc),
+            'nmodified': 0,
+            'status': 'processing',
+        }
+
+        # order submission: insert into orders and append to the queue
+        begin = time.perf_counter()
+        orders.insert_one({**order})
+        queue.insert_one({**order})
+        latencies['order'].append(time.perf_counter() - begin)
+
+        # order processing: stock update and order confirmation
+        begin = time.perf_counter()
+        items.bulk_write([UpdateOne({'id': '0001'}, {'$inc': {'instock': -1}})])
+        updates.bulk_write([UpdateOne({'id': order['id'], 'user': 'benchmark'}, {'$set': {'status': 'confirmed'}})])
+        latencies['stock'].append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'throughput': args.n / elapsed,
+        'order p50': percentile(latencies['order'], 0.5),
+        'order p99': percentile(latencies['order'], 0.99),
+        'stock p50': percentile(latencies['stock'], 0.5),
+        'stock p99': percentile(latencies['stock'], 0.99),
+    }
+
+print('| Profile | Throughput | Order p50 | Order p99 | Stock p50 | Stock p99 |')
+print('|---|---|---|---|---|---|')
+for profile in args.profiles or list(config.durability['profiles']):
+    result = measure({**config.durability, 'profile': profile})
+    print(
+        f"| `{profile}` | {result['throughput']:.1f} orders/s "
+        f"| {result['order p50']:.2f} ms | {result['order p99']:.2f} ms "
+        f"| {result['stock p50']:.2f} ms | {result['stock p99']:.2f} ms |"
+    )
+
+client.drop_database(db.name)
@@ -0,0 +1,60 @@
+import argparse
+import time
+from flask import current_app
+from beershop import create_app
+from beershop.utils.config import Config
+from beershop.utils.dataset import read_items, initialize
+from beershop.utils.db import get_storage
+from beershop.utils.durability import with_durability
+
+
+# parse arguments
+parser = argparse.ArgumentParser(
+    description=(
+        'Measure the per-request overhead of the api routes on the Flask test client, resolving the '
+        'configuration and the collections on every request (before) or from the route context (after). '
+        'Runs on the memory backend.'
+    )
+)
+parser.add_argument('-n', dest='n', type=int, default=20000, help='Number of repetitions of every measure.')
+parser.add_argument('-dataset', dest='dataset', default='example/beer_profile_and_ratings.csv', help='Items of the catalog, in csv format.')
+args = parser.parse_args()
+
+config = Config(database={'name': 'beershop-benchmark', 'backend': 'memory', 'seed': None})
+app = create_app(config)
+initialize(app.extensions['storage'], read_items(args.dataset, 1))
+client = app.test_client()
+
+def before(route):
+    # preamble of the routes resolving everything on every request
+    db = get_storage(route)
+    config = current_app.config.get('CONFIG')
+    collection_items = db['items']
+    collection_orders = db['orders']
+    with_durability(db['orderqueue'], config.durability, 'insert')
+    current_app.extensions.get('snapshot')
+    return collection_items, collection_orders
+
+def after(route):
+    context = current_app.extensions['context']
+    handles = context.handles(route)
+    return handles.items, handles.orders
+
+def measure(operation):
+    # fastest of five runs, in microseconds per call
+    runs = []
+    for _ in range(5):
+        begin = time.perf_counter()
+        for _ in range(args.n):
+            operation()
+        runs.append((time.perf_counter() - begin) / args.n * 1e6)
+    return min(runs)
+
+# preamble alone, within a request context
+with app.test_request_context('/item/0001'):
+    for route in ['getitem', 'neworder']:
+        print(f'{route} preamble: before {measure(lambda: before(route)):.2f} us, after {measure(lambda: after(route)):.2f} us')
+
+# whole requests through the test client
+print(f"GET /item/0001: {measure(lambda: client.get('/item/0001')):.1f} us")
+print(f"POST /order/benchmark/999999/modify, order not found: {measure(lambda: client.post('/order/benchmark/999999/modify', json={'order': {'id': '0001', 'quantity': 1}})):.1f} us")
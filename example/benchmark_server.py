@@ -0,0 +1,44 @@
+import argparse
+import time
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+
+# parse arguments
+parser = argparse.ArgumentParser(description='Measure the throughput of a running Beershop server.')
+parser.add_argument('url', help='Url to request. Example: http://127.0.0.1:9666/items')
+parser.add_argument('-n', dest='n', type=int, default=2000, help='Total number of requests.')
+parser.add_argument('-c', dest='c', type=int, default=16, help='Number of concurrent clients.')
+args = parser.parse_args()
+
+url = urlsplit(args.url)
+path = url.path + (f'?{url.query}' if url.query else '')
+
+def client(nrequests):
+    # every client keeps its connection open, as a browser or a proxy would do
+    latencies = []
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    for _ in range(nrequests):
+        start = time.perf_counter()
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.getheader('Connection', '').lower() == 'close':
+            connection.close()
+            connection = http.client.HTTPConnection(url.hostname, url.port)
+    connection.close()
+    return latencies
+
+# run clients concurrently
+start = time.perf_counter()
+with ThreadPoolExecutor(args.c) as executor:
+    results = executor.map(client, [args.n // args.c] * args.c)
+    latencies = sorted(latency for result in results for latency in result)
+elapsed = time.perf_counter() - start
+
+print(f'requests: {len(latencies)}')
+print(f'throughput: {len(latencies) / elapsed:.1f} req/s')
+print(f'latency p50: {latencies[len(latencies) // 2] * 1000:.2f} ms')
+print(f'latency p99: {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms')
@@ -1,12 +1,18 @@
 from __future__ import annotations
 from flask import Flask, g
 import flask
+import os
+import secrets
+import logging
+from datetime import datetime, timezone
 
 from typing import Dict, Any
 
 
 __version__='0.1.0'
 
+logger = logging.getLogger()
+
 def create_app(config: Config) -> Flask:
     """Create Flask server.
     
@@ -19,16 +25,68 @@ def create_app(config: Config) -> Flask:
     # add config file to flask instance
     app.config['CONFIG'] = config
 
-    # necessary for login
-    app.secret_key = "pit379u25872aa9034t8aayuw0976b"
+    # write the logs from a background thread, so that requests never wait for them
+    from .utils.logs import configure_logging
+    configure_logging(config.logging)
+
+    # necessary for login. Without a configured key, every process generates its own
+    app.secret_key = config.server.get('secretkey') or os.environ.get('BEERSHOP_SECRET_KEY')
+    if not app.secret_key:
+        logger.warning('No secret key provided. A random key is generated, sessions will not survive a restart.')
+        app.secret_key = secrets.token_hex(32)
 
-    # handle database in g object
+    # handle database in g object. The client is shared by the whole process, so it is not closed
     @app.teardown_appcontext
     def teardown_db(exception):
-        db = g.pop('db', None)
+        g.pop('db', None)
+        g.pop('storage', None)
+
+    # keep the whole database in the process, with the queue handler running in a thread
+    if config.database.get('backend') == 'memory':
+        app.extensions['storage'], app.extensions['queuehandler'] = create_memory_storage(config)
+
+    # keep track of idempotency keys of the order mutations
+    if config.idempotency.get('enabled'):
+        from .utils.idempotency import IdempotencyStore
+        app.extensions['idempotency'] = IdempotencyStore(
+            config.idempotency['maxsize'],
+            config.idempotency['ttl']
+        )
+
+    # read archived orders when a query needs them
+    if config.archive.get('enabled'):
+        from .utils.archive import Archiver
+        app.extensions['archive'] = Archiver(config.database, config.archive)
 
-        if db is not None:
-            db.close()
+    # profile the routes and the database commands of every request
+    if config.profiling.get('enabled'):
+        from .utils.profiling import Profiler
+        profiler = Profiler(config.profiling)
+        profiler.init_app(app)
+        app.extensions['profiler'] = profiler
+
+    # group the appends to the order queue of concurrent requests
+    if config.queuewriter.get('enabled'):
+        from .utils.queuewriter import QueueWriter
+        profiler = app.extensions.get('profiler')
+        app.extensions['queuewriter'] = QueueWriter(
+            config.queuewriter['window'],
+            config.queuewriter['batchsize'],
+            listener=profiler.listener if profiler is not None else None
+        )
+
+    # serve the facets of the catalog from memory until the catalog changes
+    from .utils.catalog import FacetCache
+    app.extensions['facets'] = FacetCache()
+
+    # share a snapshot of the catalog between the workers through a file mapped in memory
+    if config.snapshot.get('enabled'):
+        from .utils.snapshot import SnapshotStore
+        app.extensions['snapshot'] = SnapshotStore(config.snapshot['path'], config.snapshot['refresh'])
+
+    # resolve once the configuration and the collections used by the api routes
+    from .utils.context import RouteContext
+    app.extensions['context'] = RouteContext.build(app, config)
 
     # redirect root to home
     @app.route("/")
@@ -38,12 +96,49 @@ def create_app(config: Config) -> Flask:
     # import application parts
     from .api.routes import api_bp
     from .home.routes import home_bp
+    from .admin.routes import admin_bp
     
     # register Blueprints
     app.register_blueprint(api_bp)
     app.register_blueprint(home_bp)
+    app.register_blueprint(admin_bp)
     
     if __name__ == '__main__':
         app.run(debug=True)
 
-    return app
\ No newline at end of file
+    return app
+
+def create_memory_storage(config: Config):
+    """Create the in-memory storage and start its queue handler
+
+    Items are loaded from the csv file in `database.seed`, if provided.
+
+    Args:
+        config: configuration of the application
+
+    Returns:
+        the storage and its queue handler, running in a background thread until stopped
+
+    """
+    from .utils.storage import MemoryStorage
+    from .utils.db import with_schema
+    from .utils.dataset import read_items, initialize
+    from .utils.queuehandler import QueueHandler
+
+    storage = with_schema(MemoryStorage(), config.database)
+    if config.database.get('seed'):
+        initialize(storage, read_items(config.database['seed']))
+
+    # same defaults of beershop-configure
+    storage.create_queue(10000, 100000)
+
+    handler = QueueHandler(
+        config.database,
+        polling=1,
+        durability=config.durability,
+        lookahead=config.queuehandler.get('lookahead', 0),
+        velocity=config.velocity.get('enabled', False)
+    )
+    handler.start(storage, starttime=datetime.fromtimestamp(0, timezone.utc))
+
+    return storage, handler
\ No newline at end of file
@@ -0,0 +1,120 @@
+import flask
+from flask import Blueprint, current_app, jsonify, request, stream_with_context
+from functools import wraps
+from datetime import datetime
+from bson import ObjectId
+import hmac
+import logging
+logger = logging.getLogger()
+
+from beershop.utils.db import get_storage
+from beershop.utils.export import EXPORTABLE, FORMATS, iter_documents, serialize
+
+
+# Blueprint Configuration
+admin_bp = Blueprint(
+    'admin_bp',
+    __name__,
+    url_prefix='/admin'
+)
+
+def require_admin(view):
+    """Decorator to restrict a route to requests carrying the admin token in 'X-Admin-Token'
+
+    Admin routes are disabled when no token is configured.
+
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        config = current_app.config.get('CONFIG')
+        token = config.admin.get('token')
+        provided = request.headers.get('X-Admin-Token', '')
+
+        if not token or not hmac.compare_digest(provided, token):
+            response = jsonify({'message': 'Forbidden'})
+            response.status_code = 403
+            return response
+
+        return view(*args, **kwargs)
+
+    return wrapper
+
+# export a collection
+@admin_bp.route('/export/<collection>', methods=['GET'])
+@require_admin
+def export(collection: str) -> flask.Response:
+    """Stream all the documents of a collection
+
+    Supports the search keys `format` (ndjson, csv, parquet), `start` and `end` to filter by time,
+    and `after` to resume an interrupted export from the '_id' of the last document received.
+
+    """
+    if collection not in EXPORTABLE:
+        message = f"Collection {collection} cannot be exported. Supported: {', '.join(EXPORTABLE)}"
+        logger.error(message)
+        return jsonify({'message': message})
+
+    # parse request
+    format = request.args.get('format', 'ndjson')
+    if format not in FORMATS:
+        message = f"Wrong format {format}. Supported: {', '.join(FORMATS)}"
+        logger.error(message)
+        return jsonify({'message': message})
+
+    times = {}
+    for key in ['start', 'end']:
+        value = request.args.get(key)
+        try:
+            times[key] = datetime.fromisoformat(value) if value is not None else None
+        except (TypeError, ValueError):
+            message = f'Wrong format passed to {key}. The only supported format is ISOFORMAT. Provided {value}'
+            logger.error(message)
+            return jsonify({'message': message})
+
+    after = request.args.get('after')
+    if after is not None and not ObjectId.is_valid(after):
+        message = f'Wrong format passed to after. Expected the _id of a document. Provided {after}'
+        logger.error(message)
+        return jsonify({'message': message})
+
+    # get storage
+    db = get_storage()
+
+    docs = iter_documents(
+        db[collection],
+        EXPORTABLE[collection],
+        starttime=times['start'],
+        endtime=times['end'],
+        after=after
+    )
+
+    logger.info(f'Export of {collection} in {format} started.')
+
+    return flask.Response(
+        stream_with_context(serialize(docs, collection, format)),
+        mimetype=FORMATS[format],
+        headers={'Content-Disposition': f'attachment; filename={collection}.{format}'}
+    )
+
+# profile of the routes
+@admin_bp.route('/profile', methods=['GET'])
+@require_admin
+def profile() -> flask.Response:
+    """Latency histograms and database usage of every route served by this process"""
+    profiler = current_app.extensions.get('profiler')
+    if profiler is None:
+        return jsonify({'message': 'Profiling is disabled.'})
+
+    return jsonify(profiler.report())
+
+# reset the profile of the routes
+@admin_bp.route('/profile/reset', methods=['POST'])
+@require_admin
+def resetprofile() -> flask.Response:
+    """Clear the profile of the routes served by this process"""
+    profiler = current_app.extensions.get('profiler')
+    if profiler is None:
+        return jsonify({'message': 'Profiling is disabled.'})
+
+    profiler.reset()
+    return jsonify({'message': 'Profile cleared.'})
@@ -1,11 +1,17 @@
 import flask
-from flask import Blueprint, current_app, jsonify, request
-from datetime import datetime, timezone
+from flask import Blueprint, jsonify, request
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 import pymongo
 import logging
 logger = logging.getLogger()
 
-from beershop.utils.db import get_db
+from beershop.utils.idempotency import idempotent
+from beershop.utils.catalog import SORTABLE
+from beershop.utils.snapshot import LIVE
+from beershop.utils.logs import log_event
+from beershop.utils.context import RouteContext, Handles, with_context
+from beershop.utils.velocity import velocity
 
 
 # Blueprint Configuration
@@ -19,20 +25,32 @@ api_bp = Blueprint(
 
 # get list of items
 @api_bp.route('/items', methods=['GET'])
-def getitems() -> flask.Response:
-    """Returns list of all items"""
+@with_context
+def getitems(context: RouteContext, handles: Handles) -> flask.Response:
+    """Returns list of all items
+
+    Items can be filtered by text search on name and style, by exact styles, by ranges of unit price
+    and stock, and sorted with a limit on the number of items.
+
+    """
     # parse request
     style = request.args.get('style')
     name = request.args.get('name')
-    
-    # get db client
-    dbclient = get_db()
-    
-    # get config
-    config = current_app.config.get('CONFIG')
-
-    # get database
-    db = dbclient[config.database['name']]
+    styles = request.args.get('styles')
+    instock = request.args.get('instock')
+    sort = request.args.get('sort')
+    try:
+        ranges = {
+            'unitprice': (_number(request.args.get('minprice')), _number(request.args.get('maxprice'))),
+            'instock': (_number(request.args.get('minstock')), _number(request.args.get('maxstock'))),
+        }
+        limit = int(request.args.get('limit', 0))
+        if limit < 0:
+            raise ValueError(limit)
+    except ValueError as err:
+        message = f'Wrong filter format. Expected numbers for prices, stocks and limit ({err})'
+        logger.error(message)
+        return jsonify({'message': message})
 
     # set filter on name and style
     if name is not None and style is not None:
@@ -51,92 +69,181 @@ def getitems() -> flask.Response:
     else:
         filt = {}
 
-    # get documents matching filters
-    docs_stylesearch = db['items'].find(
+    # set filter on exact styles, as listed by the facets. Styles are stored lower case
+    if styles is not None:
+        filt['content.Style'] = {'$in': [value.strip().lower() for value in styles.split(',')]}
+
+    # set filter on ranges of price and stock
+    for field, (low, high) in ranges.items():
+        condition = {}
+        if low is not None:
+            condition['$gte'] = low
+        if high is not None:
+            condition['$lte'] = high
+        if condition:
+            filt[field] = condition
+    if instock is not None and instock.lower() in ('true', '1'):
+        filt['instock'] = {**filt.get('instock', {}), '$gt': 0}
+
+    # get documents matching filters, without the marker of the last batch of the queue handler.
+    # With the snapshot of the catalog, only the stock is read from the database
+    snapshot = context.snapshot
+    docs_stylesearch = handles.items.find(
         filt, 
-        {'_id': False}
+        {'_id': False, 'lastbatch': False} if snapshot is None else {'_id': False, **{key: True for key in LIVE}}
     )
 
+    # sort on the requested field, with the id breaking ties
+    if sort is not None:
+        field = sort.lstrip('-')
+        if field not in SORTABLE:
+            message = f"Wrong sort format. Supported fields: {', '.join(SORTABLE)}"
+            logger.error(message)
+            return jsonify({'message': message})
+        direction = pymongo.DESCENDING if sort.startswith('-') else pymongo.ASCENDING
+        docs_stylesearch = docs_stylesearch.sort([(SORTABLE[field], direction), ('id', pymongo.ASCENDING)])
+    if limit:
+        docs_stylesearch = docs_stylesearch.limit(limit)
+
     # conver to list
     docs_stylesearch = list(docs_stylesearch)
+    if snapshot is not None:
+        docs_stylesearch = snapshot.get(handles.storage).join(docs_stylesearch, handles.items)
 
     return jsonify(list(docs_stylesearch))
 
+def _number(value: Optional[str]) -> Optional[float]:
+    """Parse a number of the query string, keeping integers as such"""
+    if value is None:
+        return None
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+# get the facets of the catalog
+@api_bp.route('/items/facets', methods=['GET'])
+@with_context
+def getfacets(context: RouteContext, handles: Handles) -> flask.Response:
+    """Returns the number of items by style and the histogram of the unit prices
+
+    The facets are computed once for every version of the catalog and kept in memory.
+
+    """
+    # parse request
+    try:
+        bins = int(request.args.get('bins', 10))
+        if not 1 <= bins <= 100:
+            raise ValueError(bins)
+    except ValueError as err:
+        message = f'Wrong number of bins. Expected an integer between 1 and 100 ({err})'
+        logger.error(message)
+        return jsonify({'message': message})
+
+    # the snapshot of the catalog has the styles and the prices in its index
+    snapshot = context.snapshot
+    if snapshot is not None:
+        return jsonify(snapshot.get(handles.storage).facets(bins))
+
+    return jsonify(context.facets.get(handles.storage, bins))
+
 # get single item providing an id
 @api_bp.route('/item/<iditem>', methods=['GET'])
-def getitem(iditem: str) -> flask.Response:
+@with_context
+def getitem(context: RouteContext, handles: Handles, iditem: str) -> flask.Response:
     """Returns a single item giving an ID"""    
-    # get db client
-    dbclient = get_db()
-    
-    # get config
-    config = current_app.config.get('CONFIG')
-
-    # get database
-    db = dbclient[config.database['name']]
-
-    # get documents matching filters
-    doc = db['items'].find_one(
+    # get documents matching filters, without the marker of the last batch of the queue handler.
+    # With the snapshot of the catalog, only the stock is read from the database
+    snapshot = context.snapshot
+    doc = handles.items.find_one(
         {'id': iditem},
-        {'_id': False}
+        {'_id': False, 'lastbatch': False} if snapshot is None else {'_id': False, **{key: True for key in LIVE}}
     )
+    if doc is not None and snapshot is not None:
+        doc = snapshot.get(handles.storage).join([doc], handles.items)[0]
     
     return jsonify(doc)
 
+# get the sales and the stock of an item by minute
+@api_bp.route('/items/<iditem>/velocity', methods=['GET'])
+@with_context
+def getvelocity(context: RouteContext, handles: Handles, iditem: str) -> flask.Response:
+    """Returns the quantities sold and released and the stock of an item by minute
+
+    The range is given by the 'start' and 'end' parameters, in ISOFORMAT. Default: the last hour.
+    The response includes an estimate of the minutes left before the stock reaches the limit of
+    out of stock, at the rate of the range.
+
+    """
+    # parse request. Times without timezone are in utc
+    try:
+        end = datetime.fromisoformat(request.args['end']) if 'end' in request.args else datetime.now(timezone.utc)
+        start = datetime.fromisoformat(request.args['start']) if 'start' in request.args else end - timedelta(hours=1)
+    except ValueError as err:
+        message = f'Wrong format passed to start or end. The only supported format is ISOFORMAT. ({err})'
+        logger.error(message)
+        return jsonify({'message': message})
+    start, end = (time if time.tzinfo is not None else time.replace(tzinfo=timezone.utc) for time in (start, end))
+    if start >= end:
+        return jsonify({'message': 'Wrong range. Expected start before end.'})
+
+    item = handles.items.find_one({'id': iditem}, {'_id': False, 'id': True, 'instock': True, 'limitoutofstock': True})
+    if item is None:
+        return jsonify({'message': f'{iditem} not found.'})
+
+    return jsonify(velocity(handles.velocity, item, start, end))
+
+def _enqueue(context: RouteContext, handles: Handles, document: dict):
+    """Append an order to the queue, grouped with the appends of concurrent requests if enabled"""
+    writer = context.queuewriter
+    if writer is None:
+        handles.queue.insert_one(document)
+    else:
+        writer.append(handles.queue, document)
+
 # create a new order
 @api_bp.route('/order/<username>/new', methods=['POST'])
-def neworder(username: str) -> flask.Response:
+@idempotent
+@with_context
+def neworder(context: RouteContext, handles: Handles, username: str) -> flask.Response:
     """Create a new order"""    
-    # get db client
-    dbclient = get_db()
-    
-    # get config
-    config = current_app.config.get('CONFIG')
-
-    # get database
-    db = dbclient[config.database['name']]
-
     # get collection
-    collection_orders = db['orders']
+    collection_orders = handles.orders
     
-    # get post json data
+    # check the format of the order
     data = request.json
-    
-    # check availability in stock
-    order = data.get('order')
-    if order is None:
-        message = "Wrong order format. Expected 'order' key"
-        logger.error(message)
-        return message
-
-    iditem = order.get('id')
-    if iditem is None:
-        message = "Wrong order format. Expected 'id' key"
-        logger.error(message)
-        return jsonify({'message': message})
-
-    quantity = order.get('quantity')
-    if iditem is None:
-        message = "Wrong order format. Expected 'quantity' key"
+    message = context.order(data)
+    if message is not None:
         logger.error(message)
         return jsonify({'message': message})
+    iditem = data['order']['id']
+    quantity = data['order']['quantity']
 
     # get collection of items
-    collection_items = db['items']
+    collection_items = handles.items
+
+    # reserve the stock with a single conditional decrement. Orders that would leave less than the
+    # headroom in stock go through the queue, where the handler decides on them in order of arrival
+    reserved = None
+    if context.config.fastpath.get('enabled') and quantity > 0:
+        reserved = handles.itemsupdate.find_one_and_update(
+            {'id': iditem, 'instock': {'$gte': quantity + context.config.fastpath['headroom']}},
+            {'$inc': {'instock': -quantity}},
+            {'_id': False, 'id': True}
+        )
 
-    # check stock availability
-    item = collection_items.find_one(
-        {'id': iditem}
-    )
+    if reserved is None:
+        # check stock availability
+        item = collection_items.find_one(
+            {'id': iditem}
+        )
 
-    if item is None:
-        return jsonify({'message': f'{iditem} not found.'})
+        if item is None:
+            return jsonify({'message': f'{iditem} not found.'})
 
-    if item['instock'] == 0:
-        return jsonify({'message': "Out of stock"})
+        if item['instock'] == 0:
+            return jsonify({'message': "Out of stock"})
 
-    if item['instock'] < quantity:
-        return jsonify({'message': f'Items in stock not sufficient for the requested order. Available: {item['instock']}.'})
+        if item['instock'] < quantity:
+            return jsonify({'message': f'Items in stock not sufficient for the requested order. Available: {item['instock']}.'})
 
     # create new order id starting from the latest order
     orders = collection_orders.find(
@@ -162,35 +269,37 @@ def neworder(username: str) -> flask.Response:
         'creationtime': datetime.now(timezone.utc),
         'nmodified': 0,
         'lastmodified': None,
-        'status': 'processing',
+        'status': 'processing' if reserved is None else 'confirmed',
         'laststatuschange': datetime.now(timezone.utc)
     }
 
-    # add new order to orders
-    collection_orders.insert_one(order)
+    # add new order to orders, releasing the reserved stock if it cannot be stored
+    try:
+        handles.ordersinsert.insert_one(order)
+    except pymongo.errors.PyMongoError:
+        if reserved is not None:
+            collection_items.update_one({'id': iditem}, {'$inc': {'instock': quantity}})
+        raise
 
-    # add new order to queue 
-    collection_queue = db['orderqueue']
-    collection_queue.insert_one(order)
+    # add new order to queue. An order confirmed here is only recorded by the queue handler. The
+    # queued order gets its own '_id' instead of the one of the stored order
+    queued = {key: value for key, value in order.items() if key != '_id'}
+    if reserved is not None:
+        queued['reserved'] = True
+    _enqueue(context, handles, queued)
+    log_event(logger, logging.INFO, 'order.queued', 'Order {order} created', order=idorder, type='new', status=order['status'])
 
-    return jsonify({'message': idorder})
+    return jsonify({'message': idorder, 'status': order['status']})
 
 # delete an order
 @api_bp.route('/order/<username>/<idorder>/delete', methods=['GET'])
-def deleteorder(username: str, idorder: str) -> flask.Response:
+@idempotent
+@with_context
+def deleteorder(context: RouteContext, handles: Handles, username: str, idorder: str) -> flask.Response:
     """Delete an order"""    
-    # get db client
-    dbclient = get_db()
-    
-    # get config
-    config = current_app.config.get('CONFIG')
-
-    # get database
-    db = dbclient[config.database['name']]
-
     # get collection
-    collection_orders = db['orders']
-    collection_items = db['items']
+    collection_orders = handles.orders
+    collection_items = handles.items
 
     # check the existence of the order
     order = collection_orders.find_one(
@@ -203,12 +312,12 @@ def deleteorder(username: str, idorder: str) -> flask.Response:
 
     if not order:
         message = f'Order {idorder} not found'
-        logger.info(message)
+        log_event(logger, logging.INFO, 'order.rejected', '{message}', order=idorder, message=message)
         return jsonify({'message': message})
 
     if order['status'] == 'deleted':
         message = f'Order {idorder} already cancelled'
-        logger.info(message)
+        log_event(logger, logging.INFO, 'order.rejected', '{message}', order=idorder, message=message)
         return jsonify({'message': message})
 
     # create a new order for the queue
@@ -223,19 +332,20 @@ def deleteorder(username: str, idorder: str) -> flask.Response:
         'status': 'processing',
         'laststatuschange': datetime.now(timezone.utc)
     }
-    
+
     # add new order to queue 
-    collection_queue = db['orderqueue']
-    collection_queue.insert_one(deleteorder)
+    _enqueue(context, handles, deleteorder)
 
     message = f'Order {idorder} deleted'
-    logger.info(message)
+    log_event(logger, logging.INFO, 'order.queued', '{message}', order=idorder, type='delete', message=message)
 
     return jsonify({'message': message})
 
 # modify order
 @api_bp.route('/order/<username>/<idorder>/modify', methods=['POST'])
-def modifyorder(username:str, idorder: str) -> flask.Response:
+@idempotent
+@with_context
+def modifyorder(context: RouteContext, handles: Handles, username: str, idorder: str) -> flask.Response:
     """Modify order
     
     An order can be modified only when status is either 'processing' or 'confirmed'. It cannot be
@@ -251,39 +361,17 @@ def modifyorder(username:str, idorder: str) -> flask.Response:
         flask jsonified response with the status of the modification request
 
     """    
-    # get db client
-    dbclient = get_db()
-    
-    # get config
-    config = current_app.config.get('CONFIG')
-
-    # get database
-    db = dbclient[config.database['name']]
-
     # get collection
-    collection_orders = db['orders']
+    collection_orders = handles.orders
 
-    # get post json data
+    # check the format of the order
     data = request.json
-    
-    # check availability in stock
-    order = data.get('order')
-    if order is None:
-        message = "Wrong order format. Expected 'order' key"
-        logger.error(message)
-        return jsonify({'message': message})
-
-    iditem = order.get('id')
-    if iditem is None:
-        message = "Wrong order format. Expected 'id' key"
-        logger.error(message)
-        return jsonify({'message': message})
-
-    quantity = order.get('quantity')
-    if iditem is None:
-        message = "Wrong order format. Expected 'quantity' key"
+    message = context.order(data)
+    if message is not None:
         logger.error(message)
         return jsonify({'message': message})
+    iditem = data['order']['id']
+    quantity = data['order']['quantity']
 
     # check the status of the order
     order = collection_orders.find_one(
@@ -296,7 +384,7 @@ def modifyorder(username:str, idorder: str) -> flask.Response:
 
     if not order:
         message = f'Order {idorder} not found'
-        logger.info(message)
+        log_event(logger, logging.INFO, 'order.rejected', '{message}', order=idorder, message=message)
         return jsonify({'message': message})
 
     if order['status'] not in ['processing', 'confirmed']:
@@ -304,21 +392,21 @@ def modifyorder(username:str, idorder: str) -> flask.Response:
             f"The order {idorder} cannot be modified. An order can be modified only when status is"
             f"either 'processing' or 'confirmed'. Current status {order['status']}"
         )
-        logger.info(message)
+        log_event(logger, logging.INFO, 'order.rejected', '{message}', order=idorder, message=message)
         return jsonify({'message': message})
 
     if iditem != order['order']['id']:
         message = f"The id item differs from the initial order. You can only modify the quantity."
-        logger.info(message)
+        log_event(logger, logging.INFO, 'order.rejected', '{message}', order=idorder, message=message)
         return jsonify({'message': message})
 
     if quantity >= order['order']['quantity']:
         message = f"The new quantity can only be reduced from the initial order. Initial order quantity ({order['order']['quantity']}. Request: {quantity})"
-        logger.info(message)
+        log_event(logger, logging.INFO, 'order.rejected', '{message}', order=idorder, message=message)
         return jsonify({'message': message})
 
     # get collection of items
-    collection_items = db['items']
+    collection_items = handles.items
 
     # check stock availability
     item = collection_items.find_one(
@@ -345,29 +433,20 @@ def modifyorder(username:str, idorder: str) -> flask.Response:
     }
 
     # add modify order to queue 
-    collection_queue = db['orderqueue']
-    collection_queue.insert_one(modifiedorder)
+    _enqueue(context, handles, modifiedorder)
     
     message = f'Order {idorder} modified'
-    logger.info(message)
+    log_event(logger, logging.INFO, 'order.queued', '{message}', order=idorder, type='modify', message=message)
 
     return jsonify({'message': message})
 
 # get an order by id
 @api_bp.route('/order/<username>/<idorder>/get', methods=['GET'])
-def getorderbyid(username: str, idorder: str) -> flask.Response:
+@with_context
+def getorderbyid(context: RouteContext, handles: Handles, username: str, idorder: str) -> flask.Response:
     """Get order by id"""    
-    # get db client
-    dbclient = get_db()
-    
-    # get config
-    config = current_app.config.get('CONFIG')
-
-    # get database
-    db = dbclient[config.database['name']]
-
     # get collection
-    collection_orders = db['orders']
+    collection_orders = handles.orders
 
     # get order
     order = collection_orders.find_one(
@@ -378,6 +457,13 @@ def getorderbyid(username: str, idorder: str) -> flask.Response:
         {'_id': False}
     )
 
+    # look for the order in the archive
+    archive = context.archive
+    if not order and archive is not None:
+        archived = archive.find(handles.storage, username, idorder=idorder)
+        if archived:
+            order = archived[0]
+
     if not order:
         message = f'Order {idorder} not found'
         logger.info(message)
@@ -387,19 +473,11 @@ def getorderbyid(username: str, idorder: str) -> flask.Response:
     
 # get orders with filters
 @api_bp.route('/orders/<username>', methods=['GET'])
-def getorders(username: str) -> flask.Response:
+@with_context
+def getorders(context: RouteContext, handles: Handles, username: str) -> flask.Response:
     """Get all orders"""    
-    # get db client
-    dbclient = get_db()
-    
-    # get config
-    config = current_app.config.get('CONFIG')
-
-    # get database
-    db = dbclient[config.database['name']]
-
     # get collection
-    collection_orders = db['orders']
+    collection_orders = handles.orders
 
     # get request search parameters
     start = request.args.get('start')
@@ -464,5 +542,17 @@ def getorders(username: str) -> flask.Response:
         filters,
         {'_id': False}
     )
+    orders = list(orders)
 
-    return jsonify(list(orders))
\ No newline at end of file
+    # read the archive only if the time range goes back beyond the orders kept in the collection
+    archive = context.archive
+    if archive is not None and archive.needed(starttime):
+        # an order copied to the archive but not yet deleted is returned once, as found in the collection
+        live = {order['id'] for order in orders}
+        orders += [
+            order
+            for order in archive.find(handles.storage, username, starttime=starttime, endtime=endtime, status=status)
+            if order['id'] not in live
+        ]
+
+    return jsonify(orders)
\ No newline at end of file
@@ -2,19 +2,27 @@ import sys
 import inspect
 import argparse
 import subprocess
-import pandas as pd
 import json
 from datetime import datetime, timezone
-import random
+from bson import ObjectId, json_util
 import os
-import pymongo
-from pymongo import MongoClient, errors
+import secrets
 import logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 from beershop.utils.config import Config
-from beershop.utils.queuehandler import QueueHandler
+from beershop.utils.db import create_storage
+from beershop.utils.dataset import read_items, initialize, create_text_index
+from beershop.utils.catalog import create_indexes
+from beershop.utils.velocity import create_indexes as create_velocity_indexes
+from beershop.utils.schema import SCHEMAS, MappedStorage, migrate as migrate_collection
+from beershop.utils.queuehandler import QueueHandler, requeue
+from beershop.utils.logs import configure_logging
+from beershop.utils.archive import Archiver
+from beershop.utils.export import EXPORTABLE, FORMATS, iter_documents, serialize
+from beershop.utils.engine import OrderEngine
+from beershop.utils.replay import load_dump, synthetic_stream, replay as replay_stream
 from beershop import create_app
 import beershop
 
@@ -43,36 +51,13 @@ def configure():
     config = Config.load(args.config)
 
     # connect to db
-    client = MongoClient(
-        host=config.database['host'],
-        port=config.database['port'], 
-        serverSelectionTimeoutMS=config.database['timeout']
-    )
+    db = create_storage(config.database)
 
-    # test connection
-    try:
-        client.is_mongos
-    except errors.ServerSelectionTimeoutError as err:
-        logger.error(f"Failed to connect to database. \n({err})")
-        sys.exit(1)
-    
-    # get collection of the stocks
-    db = client[config.database['name']]
-    
-    # drop collection if there is any
-    db['orderqueue'].drop()
-
-    # create capped collection
-    collection = pymongo.collection.Collection(
-        db, 
-        'orderqueue',
-        capped=True, 
-        max=args.nmax,
-        size=args.size
-    )
+    # create capped collection, dropping the existing one
+    db.create_queue(int(args.nmax), int(args.size))
 
     # add a dummy order to start tailing the collection
-    collection.insert_one(
+    db.queue.insert_one(
         {
             'dummy': 'dummy'
         }
@@ -80,6 +65,25 @@ def configure():
 
     logger.info('Order queue created.')
 
+    # expire idempotency keys shared by the server workers
+    db['idempotencykeys'].drop()
+    db['idempotencykeys'].create_index(
+        'createdat',
+        expireAfterSeconds=int(config.idempotency['ttl'])
+    )
+
+    logger.info('Idempotency keys collection created.')
+
+    # indexes of the filters and sorting of the catalog
+    create_indexes(db)
+
+    logger.info('Catalog indexes created.')
+
+    # one bucket per item and minute, removed after the retention
+    create_velocity_indexes(db, config.velocity['retention'])
+
+    logger.info('Velocity indexes created.')
+
 def start():
     """Command line option for starting the Beershop application using the integrated webserver"""
     parser = argparse.ArgumentParser(description='Start the Beershop application using the integrated web server.')
@@ -96,6 +100,48 @@ def start():
     app = create_app(config)
     app.run(debug=True, host='0.0.0.0', port=9666)
 
+def serve():
+    """Command line option for starting the Beershop application using a production WSGI server"""
+    parser = argparse.ArgumentParser(
+        description=(
+            'Start the Beershop application using a prefork multi-worker, multi-threaded WSGI server. '
+            'Workers, threads, keep-alive and max-requests recycling are read from the configuration file.'
+        )
+    )
+    parser.add_argument('-config', dest='config', help='Configuration file in yaml format.')
+    parser.add_argument('-j', action='version')
+
+    parser.version = beershop.__version__
+    args = parser.parse_args()
+
+    # the server is an optional dependency
+    try:
+        from beershop.utils.server import BeershopServer
+    except ImportError:
+        logger.error("The production server requires gunicorn. Install it with 'pip install beershop[server]'.")
+        sys.exit(1)
+
+    # read configuration file
+    config = Config.load(args.config)
+
+    # generate a secret key shared by all the workers if none is provided
+    if config.server.get('secretkey') is None and os.environ.get('BEERSHOP_SECRET_KEY') is None:
+        logger.warning('No secret key provided. A random key is generated, sessions will not survive a restart.')
+        config.server['secretkey'] = secrets.token_hex(32)
+
+    # the memory backend is not shared between processes, and is lost when its worker is recycled
+    if config.database['backend'] == 'memory':
+        if int(config.server['workers']) > 1:
+            logger.warning('The memory backend lives in a single process. Starting 1 worker.')
+            config.server['workers'] = 1
+        if int(config.server['maxrequests']) > 0:
+            logger.warning('The memory backend is lost when its worker is recycled. Recycling of the worker disabled.')
+            config.server['maxrequests'] = 0
+            config.server['maxrequestsjitter'] = 0
+
+    # start server
+    BeershopServer(config).run()
+
 def initialize_testdb():
     """Command line option to inizialize the test DB for the Beershop application"""
     parser = argparse.ArgumentParser(description='Initialize the DB with the test data.')
@@ -120,72 +166,14 @@ def initialize_testdb():
         logger.error(f"Wrong format of input file. Provided {args.filename.split('.')[-1]}. Supported 'CSV'")
         sys.exit(1)
 
-    # read input file
-    df = pd.read_csv(args.filename)
-
-    # set random seed to replicate results
-    random.seed(1)
-    
-    # set the default number of limit out of stock. Evalutate whether to pass this value as argument
-    limitoutofstock = 3
-
-    # convert to lower letters style to simply later search
-    df['Style'] = df['Style'].str.lower()
-
-    # convert to list of dict and reduce size
-    data = df.to_dict(orient='records')
-    data = data[::16]
-
-    # set current datetime in utc format
-    today = datetime.now(timezone.utc)
-
     # create stocks
-    items = list()
-    for count, beer in enumerate(data):
-        currentstock = {
-            'id': f'{count + 1:04d}',
-            'last_update': datetime.now(timezone.utc),
-            'creation_time': datetime.now(timezone.utc),
-            'instock': random.randrange(5, 50),
-            'limitoutofstock': limitoutofstock,
-            'content': beer,
-            'unitprice': random.randrange(2, 10)
-        }
-        items.append(currentstock)
-    
-    # connect to db
-    client = MongoClient(
-        host=config.database['host'],
-        port=config.database['port'], 
-        serverSelectionTimeoutMS=config.database['timeout']
-    )
-
-    # test connection
-    try:
-        client.is_mongos
-    except errors.ServerSelectionTimeoutError as err:
-        logger.error(f"Failed to connect to database. \n({err})")
-        sys.exit(1)
-    
-    # get collection of the stocks and orders
-    collection_items = client[config.database['name']]['items']
-    collection_orders = client[config.database['name']]['orders']
+    items = read_items(args.filename, int(args.seed))
 
-    # reset content
-    collection_items.drop()
-    collection_orders.drop()
-
-    # add test stocks
-    results = collection_items.insert_many(items)
+    # connect to db
+    db = create_storage(config.database)
 
-    # create index on descriptions to allow mongodb text search
-    collection_items.create_index(
-        {
-            'content.Style': 'text',
-            'content.Description': 'text', 
-            'content.Name': 'text'
-        }
-    )
+    # reset items and orders
+    initialize(db, items)
 
     logger.info('Test database initalized successfully.')
 
@@ -193,7 +181,10 @@ def start_queuehandler():
     """Command line option to start the queue handler to process orders"""
     parser = argparse.ArgumentParser(description='Start the queue handler to process orders. Only order after the start of listener are processed.')
     parser.add_argument('-polling', dest='polling', default=1, help='Polling time in seconds between every check on queue for new documents.')
+    parser.add_argument('-window', dest='window', type=float, default=0.05, help='Time in seconds to wait for further orders to process in the same batch (Default: 0.05).')
+    parser.add_argument('-batchsize', dest='batchsize', type=int, default=500, help='Maximum number of orders processed in the same batch (Default: 500).')
     parser.add_argument('-starttime', dest='starttime', help='Whether to start processing orders from a specific datetime. Supported format: ISOFORMAT')
+    parser.add_argument('-election', dest='election', action='store_true', help='Process orders only while holding the lease, so that several instances can run as hot standbys.')
     parser.add_argument('-config', dest='config', help='Configuration file in yaml format.')
     parser.add_argument('-j', action='version')
 
@@ -202,11 +193,19 @@ def start_queuehandler():
     
     # read configuration file
     config = Config.load(args.config)
+    configure_logging(config.logging)
 
     # initialize queue handler
     queuehandler = QueueHandler(
         config.database,
         args.polling,
+        args.window,
+        args.batchsize,
+        config.durability,
+        leasettl=config.queuehandler['leasettl'],
+        heartbeat=config.queuehandler['heartbeat'],
+        lookahead=config.queuehandler['lookahead'],
+        velocity=config.velocity['enabled'],
     )
 
     # convert in python datetime
@@ -217,5 +216,265 @@ def start_queuehandler():
 
     # start listener
     queuehandler.listen(
-        starttime
-    )
\ No newline at end of file
+        starttime,
+        election=args.election or config.queuehandler['election']
+    )
+
+def deadletter():
+    """Command line option to inspect and requeue the orders that the queue handler failed to process"""
+    parser = argparse.ArgumentParser(
+        description=(
+            'List the orders moved to the dead-letter collection by the queue handler, with the error attached, '
+            'or move them back to the queue.'
+        )
+    )
+    parser.add_argument('-requeue', dest='requeue', nargs='*', help='Requeue the dead letters with the given _id, or all of them if no _id is given.')
+    parser.add_argument('-maxattempts', dest='maxattempts', type=int, default=3, help='Do not requeue orders that already failed this number of times (Default: 3).')
+    parser.add_argument('-force', dest='force', action='store_true', help='Requeue orders regardless of the number of attempts.')
+    parser.add_argument('-config', dest='config', help='Configuration file in yaml format.')
+    parser.add_argument('-j', action='version')
+
+    parser.version = beershop.__version__
+    args = parser.parse_args()
+
+    # read configuration file
+    config = Config.load(args.config)
+
+    # connect to db
+    db = create_storage(config.database)
+
+    if args.requeue is None:
+        for doc in db.deadletter.find({}).sort('failedtime', 1):
+            print(json_util.dumps(doc))
+        return
+
+    ids = [ObjectId(value) for value in args.requeue] if args.requeue else None
+    nrequeued, nskipped = requeue(db, ids, None if args.force else args.maxattempts)
+
+    logger.info(f'{nrequeued} orders requeued.')
+    if nskipped:
+        logger.warning(f'{nskipped} orders not requeued since they failed {args.maxattempts} times. Use -force to requeue them.')
+
+def migrate():
+    """Command line option to convert orders and items to the compact schema"""
+    parser = argparse.ArgumentParser(
+        description=(
+            'Convert orders and items to the compact schema while the application is running. '
+            "All the servers and the queue handler must run with 'schema: migrating' during the migration."
+        )
+    )
+    parser.add_argument('-collections', dest='collections', nargs='+', choices=list(SCHEMAS), default=list(SCHEMAS), help='Collections to migrate (Default: all).')
+    parser.add_argument('-batchsize', dest='batchsize', type=int, default=500, help='Number of documents converted at once (Default: 500).')
+    parser.add_argument('-config', dest='config', help='Configuration file in yaml format.')
+    parser.add_argument('-j', action='version')
+
+    parser.version = beershop.__version__
+    args = parser.parse_args()
+
+    # read configuration file
+    config = Config.load(args.config)
+
+    if config.database['schema'] == 'standard':
+        logger.error("The servers would not read the converted documents. Set 'schema: migrating' in the database section of the configuration file.")
+        sys.exit(1)
+
+    # connect to db, without mapping the documents
+    db = create_storage(config.database).storage
+
+    for name in args.collections:
+        nmigrated = migrate_collection(db, name, args.batchsize)
+        logger.info(f'{nmigrated} documents of {name} converted to the compact schema.')
+
+    # a collection has a single text index, so the index on the standard fields is replaced
+    if 'items' in args.collections:
+        for index in db.items.list_indexes():
+            if 'textIndexVersion' in index:
+                db.items.drop_index(index['name'])
+        create_text_index(MappedStorage(db))
+        create_indexes(MappedStorage(db))
+        logger.info('Text and catalog indexes of items rebuilt on the compact fields.')
+
+    logger.info("Migration completed. Set 'schema: compact' in the database section of the configuration file.")
+
+def archive():
+    """Command line option to start the archiver of old orders"""
+    parser = argparse.ArgumentParser(
+        description=(
+            'Move old and terminated orders from the collection of orders to the archive. '
+            'Archiving rules are read from the configuration file.'
+        )
+    )
+    parser.add_argument('-once', dest='once', action='store_true', help='Archive orders once and exit instead of running periodically.')
+    parser.add_argument('-config', dest='config', help='Configuration file in yaml format.')
+    parser.add_argument('-j', action='version')
+
+    parser.version = beershop.__version__
+    args = parser.parse_args()
+
+    # read configuration file
+    config = Config.load(args.config)
+
+    if not config.archive['enabled']:
+        logger.error("Archive not enabled. Set 'enabled: true' in the archive section of the configuration file.")
+        sys.exit(1)
+
+    # initialize archiver
+    archiver = Archiver(
+        config.database,
+        config.archive,
+    )
+
+    if not args.once:
+        archiver.listen()
+        return
+
+    # connect to db
+    db = create_storage(config.database)
+    archiver.create_indexes(db)
+
+    narchived = archiver.run_once(db)
+    logger.info(f'{narchived} orders archived.')
+
+
+def export():
+    """Command line option to export orders or items to a file"""
+    parser = argparse.ArgumentParser(
+        description=(
+            'Export a collection to a file in ndjson, csv or parquet format. '
+            'Documents are streamed from the database, so the memory used does not depend on the size of the collection.'
+        )
+    )
+    parser.add_argument('collection', choices=list(EXPORTABLE), help='Collection to export.')
+    parser.add_argument('output', help='Path of the output file.')
+    parser.add_argument('-format', dest='format', choices=list(FORMATS), default='ndjson', help='Format of the output file (Default: ndjson).')
+    parser.add_argument('-start', dest='start', help='Export only documents created or updated after this datetime. Supported format: ISOFORMAT')
+    parser.add_argument('-end', dest='end', help='Export only documents created or updated before this datetime. Supported format: ISOFORMAT')
+    parser.add_argument('-batchsize', dest='batchsize', type=int, default=1000, help='Number of documents fetched from the database at once (Default: 1000).')
+    parser.add_argument('-checkpoint', dest='checkpoint', help='Checkpoint file used to resume an interrupted export (Default: OUTPUT.checkpoint).')
+    parser.add_argument('-resume', dest='resume', action='store_true', help='Resume the export from the checkpoint file.')
+    parser.add_argument('-config', dest='config', help='Configuration file in yaml format.')
+    parser.add_argument('-j', action='version')
+
+    parser.version = beershop.__version__
+    args = parser.parse_args()
+
+    # read configuration file
+    config = Config.load(args.config)
+
+    # convert in python datetime
+    starttime = datetime.fromisoformat(args.start) if args.start is not None else None
+    endtime = datetime.fromisoformat(args.end) if args.end is not None else None
+
+    # read checkpoint
+    checkpoint = args.checkpoint or f'{args.output}.checkpoint'
+    after = None
+    exported = 0
+    if args.resume:
+        if not os.path.exists(checkpoint):
+            logger.error(f'Checkpoint file {checkpoint} not found.')
+            sys.exit(1)
+        with open(checkpoint, 'r') as fid:
+            state = json.load(fid)
+        after = state['after']
+        exported = state['exported']
+        logger.info(f'Resuming export after {exported} documents.')
+
+    # a parquet file cannot be appended, so a resumed export is written to a new part
+    output = args.output
+    if args.resume and args.format == 'parquet' and after is not None:
+        root, ext = os.path.splitext(output)
+        output = f'{root}-{after}{ext}'
+
+    # connect to db
+    db = create_storage(config.database)
+
+    # keep track of the last document read, to be saved in the checkpoint
+    last = {'after': after, 'exported': exported}
+    def tracked(docs):
+        for doc in docs:
+            last['after'] = doc['_id']
+            last['exported'] += 1
+            yield doc
+
+    docs = tracked(
+        iter_documents(
+            db[args.collection],
+            EXPORTABLE[args.collection],
+            starttime=starttime,
+            endtime=endtime,
+            after=after,
+            batchsize=args.batchsize
+        )
+    )
+
+    # every chunk holds all the documents read so far, so the checkpoint is saved after every chunk
+    mode = 'ab' if args.resume and args.format != 'parquet' else 'wb'
+    header = mode == 'wb'
+    start = datetime.now(timezone.utc)
+    with open(output, mode) as fid:
+        for chunk in serialize(docs, args.collection, args.format, header=header):
+            fid.write(chunk)
+            fid.flush()
+            with open(f'{checkpoint}.tmp', 'w') as fidcheckpoint:
+                json.dump(last, fidcheckpoint)
+            os.replace(f'{checkpoint}.tmp', checkpoint)
+
+    elapsed = (datetime.now(timezone.utc) - start).total_seconds()
+    logger.info(f"{last['exported'] - exported} documents exported to {output} in {elapsed:.1f} s.")
+
+
+def replay():
+    """Command line option to replay a stream of orders without database"""
+    parser = argparse.ArgumentParser(
+        description=(
+            'Replay a dump of the order queue, or a synthetic stream of orders, through the order processing rules '
+            'without database, and report final stock, outcome of the orders and throughput.'
+        )
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-dump', dest='dump', help='Dump of the order queue in json or ndjson format (e.g. written by mongoexport).')
+    source.add_argument('-synthetic', dest='synthetic', type=int, help='Number of orders of a synthetic stream.')
+    parser.add_argument('-items', dest='items', help='Dump of the items used for the initial stock. If missing, every item starts with STOCK.')
+    parser.add_argument('-orders', dest='orders', help='Dump of the orders modified or deleted by the stream, if created before the stream.')
+    parser.add_argument('-nitems', dest='nitems', type=int, default=200, help='Number of items of the synthetic stream (Default: 200).')
+    parser.add_argument('-stock', dest='stock', type=int, default=50, help='Initial stock of the items when no dump of the items is provided (Default: 50).')
+    parser.add_argument('-seed', dest='seed', type=int, default=1, help='Seed of the synthetic stream.')
+    parser.add_argument('-output', dest='output', help='Write the full report, including the final stock of every item, in json format.')
+    parser.add_argument('-j', action='version')
+
+    parser.version = beershop.__version__
+    args = parser.parse_args()
+
+    # read stream of orders
+    if args.dump is not None:
+        if not os.path.exists(args.dump):
+            logger.error(f'Input file {args.dump} not found.')
+            sys.exit(1)
+        stream = list(load_dump(args.dump))
+        itemids = {order['order']['id'] for order in stream if 'order' in order}
+    else:
+        stream = list(synthetic_stream(args.synthetic, args.nitems, args.seed))
+        itemids = {f'{count + 1:04d}' for count in range(args.nitems)}
+
+    # initial stock
+    if args.items is not None:
+        stock = {item['id']: item['instock'] for item in load_dump(args.items)}
+    else:
+        stock = {iditem: args.stock for iditem in itemids}
+
+    # initial state of the orders
+    orders = {}
+    if args.orders is not None:
+        orders = {(order['id'], order['user']): order for order in load_dump(args.orders)}
+
+    report = replay_stream(OrderEngine(stock, orders), stream)
+
+    print(f"{report['orders']} orders replayed in {report['elapsed']:.3f} s ({report['throughput']:.0f} orders/s).")
+    for outcome, count in sorted(report['outcomes'].items()):
+        print(f'{outcome}: {count}')
+    print(f"Items with stock changed: {len(report['stockchanges'])}. Items out of stock: {sum(1 for value in report['stock'].values() if value == 0)}.")
+
+    if args.output is not None:
+        with open(args.output, 'w') as fid:
+            json.dump(report, fid, indent=2)
+        print(f'Report written to {args.output}.')
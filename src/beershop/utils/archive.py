@@ -0,0 +1,262 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Optional, Any
+from datetime import datetime, timezone, timedelta
+from pymongo import ReplaceOne, DeleteOne
+import pymongo
+import glob
+import os
+import sys
+import time
+import logging
+logger = logging.getLogger()
+
+from beershop.utils.db import create_storage
+
+
+@dataclass
+class Archiver:
+    """Class to move old orders out of the collection of orders
+
+    An order is archived when it is older than `maxage` days or, if its status is one of
+    `terminalstatus`, older than `terminalage` days. Orders are moved in batches either to a
+    collection or to compressed parquet files, depending on `backend`.
+
+    Since the age is always evaluated on the creation time, all the orders created in the last
+    `min(maxage, terminalage)` days are guaranteed to be in the collection of orders, and the
+    archive must be read only by queries that go further back in time.
+
+    Args:
+        database: configuration of the database
+        archive: configuration of the archive
+
+    """
+    _ORDERS_COLLECTION = 'orders'
+    _ARCHIVE_COLLECTION = 'ordersarchive'
+
+    database: dict[str, Any]
+    archive: dict[str, Any]
+
+    @property
+    def horizon(self) -> datetime:
+        """Creation time before which orders may be archived"""
+        age = min(self.archive['maxage'], self.archive['terminalage'])
+        return datetime.now(timezone.utc) - timedelta(days=age)
+
+    def needed(self, starttime: Optional[datetime]) -> bool:
+        """Whether a query on orders created after `starttime` must read the archive"""
+        if not self.archive['enabled']:
+            return False
+
+        if starttime is None:
+            return True
+
+        if starttime.tzinfo is None:
+            starttime = starttime.replace(tzinfo=timezone.utc)
+
+        return starttime < self.horizon
+
+    def _filter(self, now: datetime) -> dict[str, Any]:
+        """Filter of the orders to archive"""
+        return {
+            '$or': [
+                {
+                    'creationtime': {'$lt': now - timedelta(days=self.archive['maxage'])}
+                },
+                {
+                    'status': {'$in': self.archive['terminalstatus']},
+                    'creationtime': {'$lt': now - timedelta(days=self.archive['terminalage'])}
+                },
+            ]
+        }
+
+    def create_indexes(self, db):
+        """Index of the archive collection on the filters of the orders of a user"""
+        if self.archive['backend'] == 'collection':
+            db[self._ARCHIVE_COLLECTION].create_index([('user', pymongo.ASCENDING), ('creationtime', pymongo.ASCENDING)])
+
+    def _write_collection(self, db, orders: list[dict[str, Any]]):
+        """Copy orders to the archive collection. Orders already copied by an interrupted run are replaced"""
+        db[self._ARCHIVE_COLLECTION].bulk_write(
+            [ReplaceOne({'_id': order['_id']}, order, upsert=True) for order in orders],
+            ordered=False
+        )
+
+    @staticmethod
+    def _parquet_schema():
+        """Schema of the archived orders. Fixed so that all the files can be read as one dataset"""
+        import pyarrow as pa
+
+        return pa.schema([
+            ('_id', pa.string()),
+            ('type', pa.string()),
+            ('id', pa.string()),
+            ('order', pa.struct([('id', pa.string()), ('quantity', pa.int64())])),
+            ('user', pa.string()),
+            ('creationtime', pa.timestamp('ms')),
+            ('nmodified', pa.int64()),
+            ('lastmodified', pa.timestamp('ms')),
+            ('status', pa.string()),
+            ('laststatuschange', pa.timestamp('ms')),
+        ])
+
+    def _write_parquet(self, orders: list[dict[str, Any]]):
+        """Copy orders to a new compressed parquet file"""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        os.makedirs(self.archive['path'], exist_ok=True)
+
+        # object ids cannot be stored in parquet
+        records = [{**order, '_id': str(order['_id'])} for order in orders]
+        table = pa.Table.from_pylist(records, schema=self._parquet_schema())
+
+        # write to a temporary file first, so that readers never see a partial file
+        filename = os.path.join(
+            self.archive['path'],
+            f"orders-{datetime.now(timezone.utc):%Y%m%d%H%M%S%f}-{records[0]['_id']}.parquet"
+        )
+        pq.write_table(table, f'{filename}.tmp', compression='zstd')
+        os.replace(f'{filename}.tmp', filename)
+
+    def run_once(self, db) -> int:
+        """Archive all the orders matching the archiving rules
+
+        Args:
+            db: storage or database of the application
+
+        Returns:
+            number of archived orders
+
+        """
+        collection_orders = db[self._ORDERS_COLLECTION]
+        filters = self._filter(datetime.now(timezone.utc))
+
+        # the latest order is never archived since new order ids are generated from it
+        latest = list(collection_orders.find({}, {'id': True}).sort('id', pymongo.DESCENDING).limit(1))
+        if latest:
+            filters = {**filters, 'id': {'$ne': latest[0]['id']}}
+
+        narchived = 0
+        while True:
+            orders = list(collection_orders.find(filters).limit(int(self.archive['batchsize'])))
+            if not orders:
+                break
+
+            # copy to the archive before removing from orders
+            if self.archive['backend'] == 'parquet':
+                self._write_parquet(orders)
+            else:
+                self._write_collection(db, orders)
+
+            # remove only the orders unchanged since the copy. The queue handler may have modified
+            # the others in the meantime: they are copied again by the next batch
+            result = collection_orders.bulk_write(
+                [
+                    DeleteOne({
+                        '_id': order['_id'],
+                        'status': order.get('status'),
+                        'nmodified': order.get('nmodified'),
+                        'laststatuschange': order.get('laststatuschange')
+                    })
+                    for order in orders
+                ],
+                ordered=False
+            )
+            if result.deleted_count < len(orders):
+                logger.info(f'{len(orders) - result.deleted_count} orders changed while archived, copied again.')
+
+            narchived += result.deleted_count
+            logger.info(f'{result.deleted_count} orders archived.')
+
+        return narchived
+
+    def find(
+        self,
+        db,
+        user: str,
+        idorder: Optional[str] = None,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+        status: Optional[str] = None
+    ) -> list[dict[str, Any]]:
+        """Get archived orders of a user
+
+        Args:
+            db: storage or database of the application
+            user: username associated to the orders
+            idorder: id of the order
+            starttime: minimum creation time (included)
+            endtime: maximum creation time (excluded)
+            status: status of the orders
+
+        Returns:
+            list of orders without the '_id' field
+
+        """
+        if self.archive['backend'] == 'parquet':
+            return self._find_parquet(user, idorder, starttime, endtime, status)
+
+        filters = {'user': user}
+        if idorder is not None:
+            filters['id'] = idorder
+        if status is not None:
+            filters['status'] = status
+        if starttime is not None or endtime is not None:
+            filters['creationtime'] = {}
+            if starttime is not None:
+                filters['creationtime']['$gte'] = starttime
+            if endtime is not None:
+                filters['creationtime']['$lt'] = endtime
+
+        return list(db[self._ARCHIVE_COLLECTION].find(filters, {'_id': False}))
+
+    def _find_parquet(self, user, idorder, starttime, endtime, status) -> list[dict[str, Any]]:
+        """Get archived orders from the parquet files"""
+        import pyarrow.dataset as ds
+
+        files = sorted(glob.glob(os.path.join(self.archive['path'], 'orders-*.parquet')))
+        if not files:
+            return []
+
+        # datetimes are stored in utc without timezone
+        if starttime is not None and starttime.tzinfo is not None:
+            starttime = starttime.astimezone(timezone.utc).replace(tzinfo=None)
+        if endtime is not None and endtime.tzinfo is not None:
+            endtime = endtime.astimezone(timezone.utc).replace(tzinfo=None)
+
+        # push filters down to the parquet reader, so that only matching row groups are read
+        expression = ds.field('user') == user
+        if idorder is not None:
+            expression &= ds.field('id') == idorder
+        if status is not None:
+            expression &= ds.field('status') == status
+        if starttime is not None:
+            expression &= ds.field('creationtime') >= starttime
+        if endtime is not None:
+            expression &= ds.field('creationtime') < endtime
+
+        dataset = ds.dataset(files, format='parquet', schema=self._parquet_schema())
+        table = dataset.to_table(filter=expression)
+
+        # an order changed while archived is copied again to a later file, whose copy is kept
+        orders = {order['_id']: order for order in table.to_pylist()}
+        return [
+            {key: value for key, value in order.items() if key != '_id'}
+            for order in orders.values()
+        ]
+
+    def listen(self):
+        """Archive orders periodically"""
+        # connect to db
+        db = create_storage(self.database)
+        self.create_indexes(db)
+
+        logger.info('Archiving orders...')
+        while True:
+            try:
+                self.run_once(db)
+                time.sleep(self.archive['interval'])
+            except KeyboardInterrupt:
+                logger.info('Archiver stopped by the user.')
+                sys.exit()
@@ -0,0 +1,124 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Optional, Any, Iterable
+from collections import Counter
+import threading
+import logging
+logger = logging.getLogger()
+
+from beershop.utils.storage import Storage
+
+
+# fields of the items that can be used to sort the catalog
+SORTABLE = {
+    'id': 'id',
+    'name': 'content.Name',
+    'style': 'content.Style',
+    'abv': 'content.ABV',
+    'unitprice': 'unitprice',
+    'instock': 'instock',
+}
+
+# indexes of the catalog queries. The style filter comes first, then the range or sort field
+INDEXES = [
+    [('id', 1)],
+    [('content.Style', 1), ('unitprice', 1)],
+    [('content.Style', 1), ('instock', 1)],
+    [('unitprice', 1)],
+    [('instock', 1)],
+]
+
+
+def create_indexes(storage: Storage):
+    """Create the indexes of the catalog queries"""
+    for keys in INDEXES:
+        storage.items.create_index(keys)
+
+def catalog_version(storage: Storage) -> int:
+    """Version of the catalog, incremented every time items are added, removed or described differently
+
+    Stock changes do not change the version.
+
+    """
+    doc = storage[Storage.CATALOG].find_one({'_id': 'items'})
+    return doc['version'] if doc is not None else 0
+
+def bump_catalog_version(storage: Storage) -> int:
+    """Mark the catalog as changed. Must be called by every tool that changes items other than their stock"""
+    storage[Storage.CATALOG].update_one({'_id': 'items'}, {'$inc': {'version': 1}}, upsert=True)
+    return catalog_version(storage)
+
+def compute_facets(storage: Storage, bins: int) -> dict[str, Any]:
+    """Number of items by style and histogram of the unit prices of the catalog
+
+    Args:
+        storage: storage of the application
+        bins: number of bins of the price histogram
+
+    """
+    items = storage.items.find({}, {'_id': False, 'content.Style': True, 'unitprice': True})
+    return summarize(((item.get('content', {}).get('Style'), item.get('unitprice')) for item in items), bins)
+
+def summarize(values: Iterable[tuple[Optional[str], Optional[float]]], bins: int) -> dict[str, Any]:
+    """Number of items by style and histogram of the unit prices
+
+    Args:
+        values: style and unit price of every item
+        bins: number of bins of the price histogram
+
+    """
+    nitems = 0
+    styles = Counter()
+    prices = []
+    for style, unitprice in values:
+        nitems += 1
+        if style is not None:
+            styles[style] += 1
+        if unitprice is not None:
+            prices.append(unitprice)
+
+    histogram = []
+    if prices:
+        low, high = min(prices), max(prices)
+        width = (high - low) / bins if high > low else 1
+        counts = [0] * bins
+        for price in prices:
+            counts[min(int((price - low) / width), bins - 1)] += 1
+        histogram = [
+            {'min': low + width * position, 'max': low + width * (position + 1), 'count': count}
+            for position, count in enumerate(counts)
+        ]
+
+    return {
+        'items': nitems,
+        'styles': dict(styles),
+        'unitprice': histogram,
+    }
+
+
+@dataclass
+class FacetCache:
+    """Facets of the catalog, recomputed only when the catalog version changes
+
+    Every request reads the catalog version, a single document, instead of the whole catalog.
+
+    """
+    version: Optional[int] = None
+    facets: dict[int, dict[str, Any]] = field(default_factory=dict)
+    _lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def get(self, storage: Storage, bins: int = 10) -> dict[str, Any]:
+        version = catalog_version(storage)
+        with self._lock:
+            if version != self.version:
+                self.version = version
+                self.facets = {}
+            facets = self.facets.get(bins)
+
+        if facets is None:
+            facets = {'version': version, **compute_facets(storage, bins)}
+            with self._lock:
+                if version == self.version:
+                    self.facets[bins] = facets
+
+        return facets
@@ -1,11 +1,15 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional, Any
 import sys
 import os
+import tempfile
 import yaml
+from pymongo import WriteConcern, errors
 import logging
 logger = logging.getLogger()
 
+from beershop.utils.durability import PROFILES, OPERATIONS
+
 
 @dataclass
 class Config:
@@ -13,9 +17,122 @@ class Config:
     
     Args:
         database: configuration parameters for the database
+        server: configuration parameters for the production WSGI server
+        idempotency: configuration parameters of the store of idempotency keys
+        archive: configuration parameters of the archive of orders
+        admin: configuration parameters of the admin endpoints
+        profiling: configuration parameters of the profiling of the routes
+        readpreference: read preference of the read-only routes
+        durability: write concern profiles of the writes of orders, queue and stock
+        queuehandler: configuration parameters of the queue handler instances
+        fastpath: configuration parameters of the confirmation of new orders by the API
+        snapshot: configuration parameters of the snapshot of the catalog shared by the workers
+        logging: configuration parameters of the logs of the application
+        velocity: configuration parameters of the sales and stock of the items by minute
+        queuewriter: configuration parameters of the group commit of the appends to the queue
     
     """
+    _DATABASE_DEFAULTS = {
+        'backend': 'mongodb',
+        'seed': None,
+        'replicaset': None,
+        'schema': 'standard',
+    }
+    _SERVER_DEFAULTS = {
+        'host': '0.0.0.0',
+        'port': 9666,
+        'workers': 2,
+        'threads': 4,
+        'keepalive': 5,
+        'maxrequests': 10000,
+        'maxrequestsjitter': 1000,
+        'timeout': 30,
+        'secretkey': None,
+    }
+    _IDEMPOTENCY_DEFAULTS = {
+        'enabled': True,
+        'maxsize': 10000,
+        'ttl': 3600,
+        'shared': True,
+        'lease': 60,
+    }
+    _ARCHIVE_DEFAULTS = {
+        'enabled': False,
+        'backend': 'collection',
+        'path': 'archive',
+        'maxage': 365,
+        'terminalage': 30,
+        'terminalstatus': ['deleted', 'canceled'],
+        'batchsize': 1000,
+        'interval': 3600,
+    }
+    _ADMIN_DEFAULTS = {
+        'token': None,
+    }
+    _PROFILING_DEFAULTS = {
+        'enabled': False,
+        'servertiming': False,
+        'slowrequest': 500,
+        'samplerate': 0.1,
+        'buckets': [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500],
+    }
+    # routes that only read from the database. All the other routes read from the primary
+    _READ_ROUTES = ['getitems', 'getfacets', 'getitem', 'getvelocity', 'getorders', 'getorderbyid']
+    _READ_MODES = ['primary', 'primaryPreferred', 'secondary', 'secondaryPreferred', 'nearest']
+    _READPREFERENCE_DEFAULTS = {
+        'mode': 'primary',
+        'maxstaleness': -1,
+    }
+    _DURABILITY_DEFAULTS = {
+        'profile': 'default',
+        'profiles': {},
+    }
+    _QUEUEHANDLER_DEFAULTS = {
+        'election': False,
+        'leasettl': 10,
+        'heartbeat': 2,
+        'lookahead': 0,
+    }
+    _FASTPATH_DEFAULTS = {
+        'enabled': False,
+        'headroom': 0,
+    }
+    _SNAPSHOT_DEFAULTS = {
+        'enabled': False,
+        'path': None,
+        'refresh': 1,
+    }
+    _LOGGING_DEFAULTS = {
+        'enabled': True,
+        'level': 'INFO',
+        'format': 'text',
+        'queuesize': 10000,
+        'sampling': {},
+    }
+    _VELOCITY_DEFAULTS = {
+        'enabled': False,
+        'retention': 30,
+    }
+    _QUEUEWRITER_DEFAULTS = {
+        'enabled': False,
+        'window': 0.002,
+        'batchsize': 100,
+    }
+
     database: dict[str, Any]
+    server: dict[str, Any] = field(default_factory=dict)
+    idempotency: dict[str, Any] = field(default_factory=dict)
+    archive: dict[str, Any] = field(default_factory=dict)
+    admin: dict[str, Any] = field(default_factory=dict)
+    profiling: dict[str, Any] = field(default_factory=dict)
+    readpreference: dict[str, dict[str, Any]] = field(default_factory=dict)
+    durability: dict[str, Any] = field(default_factory=dict)
+    queuehandler: dict[str, Any] = field(default_factory=dict)
+    fastpath: dict[str, Any] = field(default_factory=dict)
+    snapshot: dict[str, Any] = field(default_factory=dict)
+    logging: dict[str, Any] = field(default_factory=dict)
+    velocity: dict[str, Any] = field(default_factory=dict)
+    queuewriter: dict[str, Any] = field(default_factory=dict)
 
     @classmethod
     def load(cls, configpath: Optional[str] = None) -> dict[str, Any]:
@@ -59,6 +176,143 @@ class Config:
         if databaseconfig is None:
             logger.error('Database config not found. Exiting.')
             sys.exit(1)
+        databaseconfig = {**cls._DATABASE_DEFAULTS, **databaseconfig}
+        if databaseconfig['backend'] not in ['mongodb', 'memory']:
+            logger.error(f"Wrong database backend. Provided '{databaseconfig['backend']}'. Supported: mongodb, memory")
+            sys.exit(1)
+        if databaseconfig['schema'] not in ['standard', 'migrating', 'compact']:
+            logger.error(f"Wrong database schema. Provided '{databaseconfig['schema']}'. Supported: standard, migrating, compact")
+            sys.exit(1)
+
+        # get server config, falling back to defaults for missing keys
+        serverconfig = {**cls._SERVER_DEFAULTS, **(config.get('server') or {})}
+
+        # get idempotency config
+        idempotencyconfig = {**cls._IDEMPOTENCY_DEFAULTS, **(config.get('idempotency') or {})}
+        if not isinstance(idempotencyconfig['lease'], (int, float)) or idempotencyconfig['lease'] <= 0:
+            logger.error(f"Wrong idempotency lease. Provided '{idempotencyconfig['lease']}'. Expected a positive number of seconds")
+            sys.exit(1)
+
+        # get archive config
+        archiveconfig = {**cls._ARCHIVE_DEFAULTS, **(config.get('archive') or {})}
+        if archiveconfig['backend'] not in ['collection', 'parquet']:
+            logger.error(f"Wrong archive backend. Provided '{archiveconfig['backend']}'. Supported: collection, parquet")
+            sys.exit(1)
+
+        # get admin config
+        adminconfig = {**cls._ADMIN_DEFAULTS, **(config.get('admin') or {})}
+
+        # get profiling config
+        profilingconfig = {**cls._PROFILING_DEFAULTS, **(config.get('profiling') or {})}
+        profilingconfig['buckets'] = sorted(profilingconfig['buckets'])
+
+        # get read preference config of every read-only route
+        readpreferenceconfig = config.get('readpreference') or {}
+        for route in readpreferenceconfig:
+            if route not in cls._READ_ROUTES:
+                logger.error(f"Read preference cannot be set for route '{route}'. Supported: {', '.join(cls._READ_ROUTES)}")
+                sys.exit(1)
+        readpreferenceconfig = {
+            route: {**cls._READPREFERENCE_DEFAULTS, **(readpreferenceconfig.get(route) or {})}
+            for route in cls._READ_ROUTES
+        }
+        for route, setting in readpreferenceconfig.items():
+            if setting['mode'] not in cls._READ_MODES:
+                logger.error(f"Wrong read preference of route '{route}'. Provided '{setting['mode']}'. Supported: {', '.join(cls._READ_MODES)}")
+                sys.exit(1)
+            # MongoDB requires at least 90 seconds, and no staleness limit on the primary
+            if setting['maxstaleness'] != -1 and (setting['mode'] == 'primary' or setting['maxstaleness'] < 90):
+                logger.error(f"Wrong maxstaleness of route '{route}'. Expected -1, or at least 90 seconds with a mode other than primary.")
+                sys.exit(1)
+
+        # get durability config. Profiles of the configuration file extend the built-in ones
+        durabilityconfig = {**cls._DURABILITY_DEFAULTS, **(config.get('durability') or {})}
+        durabilityconfig['profiles'] = {**PROFILES, **(durabilityconfig['profiles'] or {})}
+        if durabilityconfig['profile'] not in durabilityconfig['profiles']:
+            logger.error(f"Durability profile '{durabilityconfig['profile']}' not found. Available: {', '.join(durabilityconfig['profiles'])}")
+            sys.exit(1)
+        for name, profile in durabilityconfig['profiles'].items():
+            for collection, operations in profile.items():
+                for operation, setting in operations.items():
+                    if operation not in OPERATIONS.get(collection, []):
+                        logger.error(f"Wrong durability profile '{name}'. Write concern cannot be set for {operation} on {collection}.")
+                        sys.exit(1)
+                    try:
+                        concern = WriteConcern(**setting)
+                    except (TypeError, ValueError, errors.ConfigurationError) as err:
+                        logger.error(f"Wrong write concern in durability profile '{name}' for {operation} on {collection}. ({err})")
+                        sys.exit(1)
+                    # the results of the writes of orders and stock are read back
+                    if collection in ['orders', 'items'] and not concern.acknowledged:
+                        logger.error(f"Wrong write concern in durability profile '{name}' for {operation} on {collection}. Writes of {collection} must be acknowledged (w > 0).")
+                        sys.exit(1)
+
+        # get queue handler config. A leader must be able to miss a renewal without losing the lease
+        queuehandlerconfig = {**cls._QUEUEHANDLER_DEFAULTS, **(config.get('queuehandler') or {})}
+        if not 0 < 2 * queuehandlerconfig['heartbeat'] <= queuehandlerconfig['leasettl']:
+            logger.error(f"Wrong queue handler heartbeat. Expected a positive interval at most half of leasettl ({queuehandlerconfig['leasettl']}).")
+            sys.exit(1)
+        if not isinstance(queuehandlerconfig['lookahead'], int) or queuehandlerconfig['lookahead'] < 0:
+            logger.error(f"Wrong queue handler lookahead. Provided '{queuehandlerconfig['lookahead']}'. Expected a non-negative integer.")
+            sys.exit(1)
+
+        # get fast path config
+        fastpathconfig = {**cls._FASTPATH_DEFAULTS, **(config.get('fastpath') or {})}
+        if not isinstance(fastpathconfig['headroom'], int) or fastpathconfig['headroom'] < 0:
+            logger.error(f"Wrong fast path headroom. Provided '{fastpathconfig['headroom']}'. Expected a non-negative integer.")
+            sys.exit(1)
+
+        # get snapshot config. The snapshot is kept in the temporary folder by default
+        snapshotconfig = {**cls._SNAPSHOT_DEFAULTS, **(config.get('snapshot') or {})}
+        if snapshotconfig['path'] is None:
+            snapshotconfig['path'] = os.path.join(tempfile.gettempdir(), f"beershop-{databaseconfig['name']}.catalog")
+
+        # get logging config. Sampling rates are the fraction of the events kept
+        loggingconfig = {**cls._LOGGING_DEFAULTS, **(config.get('logging') or {})}
+        if str(loggingconfig['level']).upper() not in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
+            logger.error(f"Wrong logging level. Provided '{loggingconfig['level']}'. Supported: DEBUG, INFO, WARNING, ERROR, CRITICAL")
+            sys.exit(1)
+        if loggingconfig['format'] not in ['text', 'json']:
+            logger.error(f"Wrong logging format. Provided '{loggingconfig['format']}'. Supported: text, json")
+            sys.exit(1)
+        if not isinstance(loggingconfig['queuesize'], int) or loggingconfig['queuesize'] <= 0:
+            logger.error(f"Wrong logging queuesize. Provided '{loggingconfig['queuesize']}'. Expected a positive integer.")
+            sys.exit(1)
+        loggingconfig['sampling'] = loggingconfig['sampling'] or {}
+        for event, rate in loggingconfig['sampling'].items():
+            if not isinstance(rate, (int, float)) or not 0 <= rate <= 1:
+                logger.error(f"Wrong sampling rate of event '{event}'. Provided '{rate}'. Expected a number between 0 and 1.")
+                sys.exit(1)
+
+        # get velocity config. Buckets are kept forever without retention
+        velocityconfig = {**cls._VELOCITY_DEFAULTS, **(config.get('velocity') or {})}
+        if velocityconfig['retention'] is not None and (not isinstance(velocityconfig['retention'], (int, float)) or velocityconfig['retention'] <= 0):
+            logger.error(f"Wrong velocity retention. Provided '{velocityconfig['retention']}'. Expected a positive number of days.")
+            sys.exit(1)
+
+        # get queue writer config
+        queuewriterconfig = {**cls._QUEUEWRITER_DEFAULTS, **(config.get('queuewriter') or {})}
+        if not isinstance(queuewriterconfig['window'], (int, float)) or queuewriterconfig['window'] < 0:
+            logger.error(f"Wrong queue writer window. Provided '{queuewriterconfig['window']}'. Expected a non-negative number of seconds.")
+            sys.exit(1)
+        if not isinstance(queuewriterconfig['batchsize'], int) or queuewriterconfig['batchsize'] <= 0:
+            logger.error(f"Wrong queue writer batchsize. Provided '{queuewriterconfig['batchsize']}'. Expected a positive integer.")
+            sys.exit(1)
 
-        return cls(databaseconfig)
+        return cls(
+            databaseconfig,
+            server=serverconfig,
+            idempotency=idempotencyconfig,
+            archive=archiveconfig,
+            admin=adminconfig,
+            profiling=profilingconfig,
+            readpreference=readpreferenceconfig,
+            durability=durabilityconfig,
+            queuehandler=queuehandlerconfig,
+            fastpath=fastpathconfig,
+            snapshot=snapshotconfig,
+            logging=loggingconfig,
+            velocity=velocityconfig,
+            queuewriter=queuewriterconfig
+        )
 
@@ -0,0 +1,185 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Optional, Any, Callable
+from functools import wraps
+from flask import Flask, current_app
+from pymongo import read_preferences
+import os
+import logging
+logger = logging.getLogger()
+
+from beershop.utils.config import Config
+from beershop.utils.db import get_client, read_preference, with_schema
+from beershop.utils.durability import write_concern
+from beershop.utils.storage import Storage, MongoStorage
+
+
+@dataclass(frozen=True)
+class PayloadValidator:
+    """Checks of the json payload of a route, built once
+
+    Args:
+        fields: path of every required field, its expected type and its minimum value (None for
+            no minimum), checked in order
+
+    """
+    fields: tuple[tuple[tuple[str, ...], type, Optional[int]], ...]
+
+    def __call__(self, data: Any) -> Optional[str]:
+        """Description of the first problem of the payload, or None if it is valid"""
+        for path, expected, minimum in self.fields:
+            value = data
+            for key in path:
+                if not isinstance(value, dict) or value.get(key) is None:
+                    return f"Wrong order format. Expected '{key}' key"
+                value = value[key]
+            if not isinstance(value, expected) or isinstance(value, bool) and expected is not bool:
+                return f"Wrong order format. Expected '{path[-1]}' of type {expected.__name__}"
+            if minimum is not None and value < minimum:
+                return f"Wrong order format. Expected '{path[-1]}' of at least {minimum}"
+        return None
+
+
+# payload of the routes creating and modifying orders. The queue handler rejects non-positive quantities
+ORDER_PAYLOAD = PayloadValidator((
+    (('order',), dict, None),
+    (('order', 'id'), str, None),
+    (('order', 'quantity'), int, 1),
+))
+
+
+@dataclass
+class Handles:
+    """Collections of a route, resolved on the storage of the process
+
+    Args:
+        base: storage of the process the handles were resolved on
+        storage: storage with the read preference of the route
+        items: collection of the items
+        orders: collection of the orders
+        queue: collection of the order queue, with the write concern of the appends
+        itemsupdate: collection of the items, with the write concern of the stock updates
+        ordersinsert: collection of the orders, with the write concern of the inserts
+        velocity: collection of the velocity buckets of the items
+
+    """
+    base: Storage
+    storage: Storage
+    items: Any
+    orders: Any
+    queue: Any
+    itemsupdate: Any
+    ordersinsert: Any
+    velocity: Any
+
+
+@dataclass
+class RouteContext:
+    """State of the API routes resolved once, when the application is created
+
+    The configuration, the read preferences of the routes and the write concerns are resolved
+    by `create_app`. The collections are resolved on the first request of every route in a
+    process, since the MongoClient is opened after fork, and kept until the storage changes.
+
+    Args:
+        config: configuration of the application
+        extensions: extensions of the application, shared with the Flask instance
+        readpreferences: read preference of every read-only route not reading from the primary
+        concerns: write concern by collection and operation, None for the one of the client
+        order: validator of the payloads of the orders
+
+    """
+    config: Config
+    extensions: dict[str, Any]
+    readpreferences: dict[str, read_preferences._ServerMode] = field(default_factory=dict)
+    concerns: dict[tuple[str, str], Any] = field(default_factory=dict)
+    order: PayloadValidator = ORDER_PAYLOAD
+    _handles: dict[Optional[str], Handles] = field(init=False, repr=False, default_factory=dict)
+    _mongo: Optional[tuple[int, Storage]] = field(init=False, repr=False, default=None)
+
+    @classmethod
+    def build(cls, app: Flask, config: Config) -> RouteContext:
+        """Resolve the configuration of the routes of an application"""
+        readpreferences = {
+            route: read_preference(setting)
+            for route, setting in config.readpreference.items()
+            if setting['mode'] != 'primary'
+        }
+        concerns = {
+            (collection, operation): write_concern(config.durability, collection, operation)
+            for collection, operation in [(Storage.QUEUE, 'insert'), (Storage.ITEMS, 'update'), (Storage.ORDERS, 'insert')]
+        }
+        return cls(config, app.extensions, readpreferences, concerns)
+
+    @property
+    def snapshot(self):
+        return self.extensions.get('snapshot')
+
+    @property
+    def archive(self):
+        return self.extensions.get('archive')
+
+    @property
+    def queuewriter(self):
+        return self.extensions.get('queuewriter')
+
+    @property
+    def facets(self):
+        return self.extensions['facets']
+
+    def storage(self) -> Storage:
+        """Storage of the process: the in-memory one, or the database on the MongoClient of the process"""
+        storage = self.extensions.get('storage')
+        if storage is not None:
+            return storage
+
+        pid = os.getpid()
+        if self._mongo is None or self._mongo[0] != pid:
+            self._mongo = (pid, with_schema(MongoStorage(get_client()[self.config.database['name']]), self.config.database))
+        return self._mongo[1]
+
+    def handles(self, route: Optional[str] = None) -> Handles:
+        """Collections of a route, with its read preference and the write concerns of the writes"""
+        base = self.storage()
+        handles = self._handles.get(route)
+        if handles is None or handles.base is not base:
+            handles = self._resolve(base, route)
+            self._handles[route] = handles
+        return handles
+
+    def _resolve(self, base: Storage, route: Optional[str]) -> Handles:
+        storage = base
+        if route in self.readpreferences:
+            storage = base.with_read_preference(self.readpreferences[route])
+
+        def concerned(name: str, operation: str):
+            collection = storage[name]
+            concern = self.concerns.get((name, operation))
+            return collection if concern is None else collection.with_options(write_concern=concern)
+
+        return Handles(
+            base=base,
+            storage=storage,
+            items=storage[Storage.ITEMS],
+            orders=storage[Storage.ORDERS],
+            queue=concerned(Storage.QUEUE, 'insert'),
+            itemsupdate=concerned(Storage.ITEMS, 'update'),
+            ordersinsert=concerned(Storage.ORDERS, 'insert'),
+            velocity=storage[Storage.VELOCITY],
+        )
+
+
+def with_context(view: Callable) -> Callable:
+    """Decorator passing the route context and the collections of the route to a view
+
+    The name of the view is the name of the route in the read preference configuration.
+
+    """
+    route = view.__name__
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        context = current_app.extensions['context']
+        return view(context, context.handles(route), *args, **kwargs)
+
+    return wrapper
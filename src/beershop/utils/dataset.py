@@ -0,0 +1,82 @@
+from __future__ import annotations
+from typing import Any
+from datetime import datetime, timezone
+import pandas as pd
+import random
+import logging
+logger = logging.getLogger()
+
+from beershop.utils.storage import Storage
+from beershop.utils.catalog import create_indexes, bump_catalog_version
+
+
+def read_items(filename: str, seed: int = 1) -> list[dict[str, Any]]:
+    """Build the items of the shop from the csv file of the dataset
+
+    Args:
+        filename: path to the input file in csv format
+        seed: seed to be used when generating random stock levels and prices
+
+    """
+    # read input file
+    df = pd.read_csv(filename)
+
+    # set random seed to replicate results
+    rng = random.Random(seed)
+
+    # set the default number of limit out of stock. Evalutate whether to pass this value as argument
+    limitoutofstock = 3
+
+    # convert to lower letters style to simply later search
+    df['Style'] = df['Style'].str.lower()
+
+    # convert to list of dict and reduce size
+    data = df.to_dict(orient='records')
+    data = data[::16]
+
+    # create stocks
+    items = list()
+    for count, beer in enumerate(data):
+        currentstock = {
+            'id': f'{count + 1:04d}',
+            'last_update': datetime.now(timezone.utc),
+            'creation_time': datetime.now(timezone.utc),
+            'instock': rng.randrange(5, 50),
+            'limitoutofstock': limitoutofstock,
+            'content': beer,
+            'unitprice': rng.randrange(2, 10)
+        }
+        items.append(currentstock)
+
+    return items
+
+def initialize(storage: Storage, items: list[dict[str, Any]]):
+    """Replace items and orders of a storage
+
+    Args:
+        storage: storage of the application
+        items: items of the shop
+
+    """
+    # reset content
+    storage.items.drop()
+    storage.orders.drop()
+
+    # add test stocks
+    storage.items.insert_many(items)
+
+    create_text_index(storage)
+    create_indexes(storage)
+
+    # invalidate the facets cached by the running servers
+    bump_catalog_version(storage)
+
+def create_text_index(storage: Storage):
+    """Create the index on descriptions to allow mongodb text search"""
+    storage.items.create_index(
+        {
+            'content.Style': 'text',
+            'content.Description': 'text',
+            'content.Name': 'text'
+        }
+    )
@@ -1,19 +1,46 @@
 from flask import g, current_app
-from pymongo import MongoClient, errors
+from typing import Optional
+from pymongo import MongoClient, errors, read_preferences
+import os
 import sys
+import threading
 import logging
 logger = logging.getLogger()
 
+from beershop.utils.storage import Storage, MongoStorage
+from beershop.utils.schema import MappedStorage
+
+
+# MongoClient shared by all the requests served by the current process. A client must never be
+# used across a fork, so it is tagged with the pid of the process that created it
+_client = None
+_clientpid = None
+_clientlock = threading.Lock()
+
+_READ_PREFERENCES = {
+    'primary': read_preferences.Primary,
+    'primaryPreferred': read_preferences.PrimaryPreferred,
+    'secondary': read_preferences.Secondary,
+    'secondaryPreferred': read_preferences.SecondaryPreferred,
+    'nearest': read_preferences.Nearest,
+}
+
 
 def connect_to_database():
     # get config
     config = current_app.config.get('CONFIG')
 
+    # count the commands sent by every request when profiling
+    profiler = current_app.extensions.get('profiler')
+    listeners = [profiler.listener] if profiler is not None else []
+
     # connect to db
     client = MongoClient(
         host=config.database['host'],
-        port=config.database['port'], 
-        serverSelectionTimeoutMS=config.database['timeout']
+        port=config.database['port'],
+        serverSelectionTimeoutMS=config.database['timeout'],
+        event_listeners=listeners,
+        **replicaset_options(config.database)
     )
 
     # test connection
@@ -22,11 +49,122 @@ def connect_to_database():
     except errors.ServerSelectionTimeoutError as err:
         logger.error(f"Failed to connect to database. \n({err})")
         sys.exit(1)
-    
+
     return client
 
+def replicaset_options(database: dict) -> dict:
+    """Options of the MongoClient to connect to a replica set, if configured"""
+    if database.get('replicaset'):
+        return {'replicaSet': database['replicaset']}
+    return {}
+
+def read_preference(setting: dict) -> read_preferences._ServerMode:
+    """Build a pymongo read preference from its configuration
+
+    Args:
+        setting: read preference mode and maximum staleness in seconds (-1 for no limit)
+
+    """
+    mode = _READ_PREFERENCES[setting['mode']]
+    if mode is read_preferences.Primary:
+        return mode()
+    return mode(max_staleness=setting['maxstaleness'])
+
+def with_schema(storage: Storage, database: dict) -> Storage:
+    """Keep orders and items in compact form, if configured
+
+    Args:
+        storage: storage holding the documents
+        database: configuration of the database
+
+    """
+    schema = database.get('schema', 'standard')
+    if schema == 'standard':
+        return storage
+    return MappedStorage(storage, legacy=schema == 'migrating')
+
+def get_client():
+    """Return the MongoClient of the current process, opening it on first use"""
+    global _client, _clientpid
+
+    if _client is None or _clientpid != os.getpid():
+        with _clientlock:
+            if _client is None or _clientpid != os.getpid():
+                _client = connect_to_database()
+                _clientpid = os.getpid()
+
+    return _client
+
+def reset_client():
+    """Forget the MongoClient inherited from the parent process
+
+    Must be called in a worker right after fork. The inherited client is not closed since its
+    sockets are still owned by the parent process.
+
+    """
+    global _client, _clientpid
+
+    _client = None
+    _clientpid = None
+
 def get_db():
     if 'db' not in g:
-        g.db = connect_to_database()
+        g.db = get_client()
+
+    return g.db
+
+def get_storage(route: Optional[str] = None) -> Storage:
+    """Return the storage of the application
+
+    The in-memory storage is owned by the application, while the MongoDB storage is built on the
+    MongoClient of the current process.
+
+    Args:
+        route: name of a read-only route. Reads use the read preference configured for the route,
+            while they go to the primary by default.
+
+    """
+    if 'storage' not in g:
+        storage = current_app.extensions.get('storage')
+        if storage is None:
+            config = current_app.config.get('CONFIG')
+            storage = with_schema(MongoStorage(get_client()[config.database['name']]), config.database)
+        g.storage = storage
+
+    if route is None:
+        return g.storage
+
+    config = current_app.config.get('CONFIG')
+    setting = config.readpreference.get(route)
+    if setting is None or setting['mode'] == 'primary':
+        return g.storage
+
+    return g.storage.with_read_preference(read_preference(setting))
+
+def create_storage(database: dict) -> Storage:
+    """Connect to the storage outside of the application, e.g. from command line tools
+
+    Args:
+        database: configuration of the database
+
+    """
+    if database.get('backend', 'mongodb') == 'memory':
+        logger.error('The memory backend lives inside the server process and cannot be used by command line tools.')
+        sys.exit(1)
+
+    # connect to db
+    client = MongoClient(
+        host=database['host'],
+        port=database['port'],
+        serverSelectionTimeoutMS=database['timeout'],
+        **replicaset_options(database)
+    )
+
+    # test connection
+    try:
+        client.is_mongos
+    except errors.ServerSelectionTimeoutError as err:
+        logger.error(f"Failed to connect to database. \n({err})")
+        sys.exit(1)
 
-    return g.db
\ No newline at end of file
+    return with_schema(MongoStorage(client[database['name']]), database)
@@ -0,0 +1,66 @@
+from __future__ import annotations
+from typing import Optional, Any
+from pymongo import WriteConcern
+import logging
+logger = logging.getLogger()
+
+
+# built-in durability profiles. Writes without a setting use the write concern of the client
+PROFILES = {
+    'default': {},
+    'fast': {
+        'orderqueue': {'insert': {'w': 0}},
+        'orders': {'insert': {'w': 1, 'j': False}, 'update': {'w': 1, 'j': False}},
+        'items': {'update': {'w': 1, 'j': False}},
+    },
+    'balanced': {
+        'orderqueue': {'insert': {'w': 1, 'j': False}},
+        'orders': {'insert': {'w': 1, 'j': True}, 'update': {'w': 'majority', 'j': True}},
+        'items': {'update': {'w': 'majority', 'j': True}},
+    },
+    'safe': {
+        'orderqueue': {'insert': {'w': 'majority', 'j': True}},
+        'orders': {'insert': {'w': 'majority', 'j': True}, 'update': {'w': 'majority', 'j': True}},
+        'items': {'update': {'w': 'majority', 'j': True}},
+    },
+}
+
+# writes that can be configured in a profile, by collection
+OPERATIONS = {
+    'orderqueue': ['insert'],
+    'orders': ['insert', 'update'],
+    'items': ['update'],
+}
+
+
+def write_concern(durability: dict[str, Any], collection: str, operation: str) -> Optional[WriteConcern]:
+    """Write concern of an operation in the active durability profile
+
+    Args:
+        durability: configuration of the durability profiles
+        collection: name of the collection
+        operation: either 'insert' or 'update'
+
+    Returns:
+        write concern, or None if the profile uses the write concern of the client
+
+    """
+    profile = durability.get('profiles', {}).get(durability.get('profile'), {})
+    setting = profile.get(collection, {}).get(operation)
+    if setting is None:
+        return None
+    return WriteConcern(**setting)
+
+def with_durability(collection, durability: dict[str, Any], operation: str):
+    """Collection writing with the write concern of an operation in the active durability profile
+
+    Args:
+        collection: pymongo or memory collection
+        durability: configuration of the durability profiles
+        operation: either 'insert' or 'update'
+
+    """
+    concern = write_concern(durability, collection.name, operation)
+    if concern is None:
+        return collection
+    return collection.with_options(write_concern=concern)
@@ -0,0 +1,143 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Optional, Any
+from datetime import datetime, timezone
+
+
+@dataclass
+class OrderEngine:
+    """In-memory state transitions of the orders
+
+    The engine holds the stock of the items and the state of the orders, and applies queued
+    orders ('new', 'modify', 'delete') one by one without any access to the database. It is used
+    by the queue handler to process every batch and by the replay command. The quantities sold and
+    released by the applied orders are summed by item in `sold` and `released`.
+
+    Args:
+        stock: quantity in stock by item id
+        orders: state of the orders by order id and user
+
+    """
+    stock: dict[str, int]
+    orders: dict[tuple[str, str], dict[str, Any]] = field(default_factory=dict)
+    initialstock: dict[str, int] = field(init=False)
+    updates: dict[tuple[str, str], dict[str, Any]] = field(init=False, default_factory=dict)
+    sold: dict[str, int] = field(init=False, default_factory=dict)
+    released: dict[str, int] = field(init=False, default_factory=dict)
+
+    def __post_init__(self):
+        self.initialstock = dict(self.stock)
+
+    def apply(self, order: dict[str, Any], now: Optional[datetime] = None) -> tuple[str, str]:
+        """Apply a queued order
+
+        Args:
+            order: queued order
+            now: time of the status change. Default: current utc time.
+
+        Returns:
+            outcome of the order ('confirmed', 'canceled', 'modified', 'deleted', 'ignored',
+            'deferred') and a message describing it
+
+        """
+        if now is None:
+            now = datetime.now(timezone.utc)
+
+        key = (order['id'], order['user'])
+        iditem = order['order']['id']
+
+        match order['type']:
+            case 'new' if order.get('reserved'):
+                # confirmed by the API, that already reserved the stock
+                self.orders[key] = {**order}
+                self.sold[iditem] = self.sold.get(iditem, 0) + order['order']['quantity']
+                return 'confirmed', f"Order {order['id']} confirmed with stock reserved by the API."
+
+            case 'new':
+                self.orders[key] = {**order}
+
+                if self.stock.get(iditem) is None:
+                    outcome = 'canceled'
+                    message = f"Order {order['id']} canceled because item {iditem} does not exist."
+                elif self.stock[iditem] == 0:
+                    outcome = 'canceled'
+                    message = f"Order {order['id']} canceled because item out of stock."
+                elif self.stock[iditem] < order['order']['quantity']:
+                    outcome = 'canceled'
+                    message = f"Order {order['id']} canceled because items in stock are not sufficient for the requested order."
+                else:
+                    outcome = 'confirmed'
+                    message = f"Order {order['id']} confirmed."
+                    self.stock[iditem] -= order['order']['quantity']
+                    self.sold[iditem] = self.sold.get(iditem, 0) + order['order']['quantity']
+
+                changes = {
+                    'status': outcome,
+                    'laststatuschange': now
+                }
+
+            case 'modify' | 'delete' if order.get('ahead') and self.orders.get(key, {}).get('status') in [None, 'processing']:
+                # moved ahead of the queue, but the new order is still waiting to be processed
+                return 'deferred', f"Order {order['id']} not changed ahead of the queue because it is not processed yet."
+
+            case 'modify':
+                initialorder = self.orders.get(key)
+                if initialorder is None or initialorder['status'] != 'confirmed':
+                    return 'ignored', f"Order {order['id']} not modified because it is not confirmed."
+
+                # the order may have changed since the modification was requested
+                if iditem != initialorder['order']['id'] or order['order']['quantity'] >= initialorder['order']['quantity']:
+                    return 'ignored', f"Order {order['id']} not modified because the quantity can only be reduced."
+
+                changes = {
+                    'type': 'modify',
+                    'status': 'confirmed',
+                    'laststatuschange': now,
+                    'nmodified': initialorder['nmodified'] + 1,
+                    'lastmodified': now,
+                    'order': order['order']
+                }
+
+                # release the quantity removed from the order
+                quantity = initialorder['order']['quantity'] - order['order']['quantity']
+                self.stock[iditem] += quantity
+                self.released[iditem] = self.released.get(iditem, 0) + quantity
+                outcome = 'modified'
+                message = f"Order {order['id']} modified."
+
+            case 'delete':
+                initialorder = self.orders.get(key)
+                if initialorder is None or initialorder['status'] == 'deleted':
+                    return 'ignored', f"Order {order['id']} already deleted."
+
+                changes = {
+                    'type': 'delete',
+                    'status': 'deleted',
+                    'laststatuschange': now,
+                    'nmodified': initialorder['nmodified'] + 1,
+                    'lastmodified': now,
+                }
+
+                # restore the quantity held by the order, if any
+                if initialorder['status'] == 'confirmed':
+                    iditem = initialorder['order']['id']
+                    self.stock[iditem] += initialorder['order']['quantity']
+                    self.released[iditem] = self.released.get(iditem, 0) + initialorder['order']['quantity']
+                outcome = 'deleted'
+                message = f"Order {order['id']} deleted."
+
+            case _:
+                return 'ignored', f"Order {order['id']} ignored because type {order['type']} is unknown."
+
+        self.orders[key].update(changes)
+        self.updates.setdefault(key, {}).update(changes)
+
+        return outcome, message
+
+    def stockchanges(self) -> dict[str, int]:
+        """Total stock change of every item since the engine was created"""
+        return {
+            iditem: self.stock[iditem] - self.initialstock.get(iditem, 0)
+            for iditem in self.stock
+            if self.stock[iditem] != self.initialstock.get(iditem, 0)
+        }
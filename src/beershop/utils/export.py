@@ -0,0 +1,209 @@
+from __future__ import annotations
+from typing import Optional, Any, Iterator, Iterable
+from datetime import datetime
+from bson import ObjectId
+import csv
+import io
+import json
+import logging
+logger = logging.getLogger()
+
+
+# collections that can be exported and the field used to filter them by time
+EXPORTABLE = {
+    'orders': 'creationtime',
+    'items': 'last_update',
+}
+
+# columns of the exported collections, with nested documents flattened, and their type
+COLUMNS = {
+    'orders': [
+        ('_id', str),
+        ('type', str),
+        ('id', str),
+        ('order.id', str),
+        ('order.quantity', int),
+        ('user', str),
+        ('creationtime', datetime),
+        ('nmodified', int),
+        ('lastmodified', datetime),
+        ('status', str),
+        ('laststatuschange', datetime),
+    ],
+    'items': [
+        ('_id', str),
+        ('id', str),
+        ('last_update', datetime),
+        ('creation_time', datetime),
+        ('instock', int),
+        ('limitoutofstock', int),
+        ('unitprice', float),
+        *[(f'content.{name}', str) for name in ['Name', 'Style', 'Brewery', 'Beer Name (Full)', 'Description']],
+        ('content.ABV', float),
+        *[
+            (f'content.{name}', int)
+            for name in ['Min IBU', 'Max IBU', 'Astringency', 'Body', 'Alcohol', 'Bitter', 'Sweet', 'Sour', 'Salty', 'Fruits', 'Hoppy', 'Spices', 'Malty']
+        ],
+        *[(f'content.{name}', float) for name in ['review_aroma', 'review_appearance', 'review_palate', 'review_taste', 'review_overall']],
+        ('content.number_of_reviews', int),
+    ],
+}
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def iter_documents(
+    collection,
+    timefield: str,
+    starttime: Optional[datetime] = None,
+    endtime: Optional[datetime] = None,
+    after: Optional[str] = None,
+    batchsize: int = 1000
+) -> Iterator[dict[str, Any]]:
+    """Iterate over the documents of a collection in the order of their '_id'
+
+    Documents are fetched from the database `batchsize` at a time, so the memory used does not
+    depend on the size of the collection.
+
+    Args:
+        collection: collection to export
+        timefield: field used to filter by time
+        starttime: minimum value of the time field (included)
+        endtime: maximum value of the time field (excluded)
+        after: '_id' of the last document already exported, to resume an export
+        batchsize: number of documents fetched per round trip
+
+    """
+    filters = {}
+    if starttime is not None or endtime is not None:
+        filters[timefield] = {}
+        if starttime is not None:
+            filters[timefield]['$gte'] = starttime
+        if endtime is not None:
+            filters[timefield]['$lt'] = endtime
+    if after is not None:
+        filters['_id'] = {'$gt': ObjectId(after)}
+
+    cursor = collection.find(filters).sort('_id', 1).batch_size(batchsize)
+    for doc in cursor:
+        doc['_id'] = str(doc['_id'])
+        yield doc
+
+def _default(value: Any) -> Any:
+    """Serialize values not supported by json"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def _flatten(doc: dict[str, Any], prefix: str = '') -> dict[str, Any]:
+    """Flatten nested documents using dotted keys"""
+    flat = {}
+    for key, value in doc.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+def ndjson_chunks(docs: Iterable[dict[str, Any]], chunksize: int = 1000) -> Iterator[bytes]:
+    """Serialize documents as newline delimited json"""
+    lines = []
+    for doc in docs:
+        lines.append(json.dumps(doc, default=_default))
+        if len(lines) == chunksize:
+            yield ('\n'.join(lines) + '\n').encode()
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode()
+
+def csv_chunks(docs: Iterable[dict[str, Any]], columns: list[str], header: bool = True, chunksize: int = 1000) -> Iterator[bytes]:
+    """Serialize documents as csv, with the same columns for every document"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    if header:
+        writer.writeheader()
+    nrows = 0
+    for doc in docs:
+        row = _flatten(doc)
+        writer.writerow({key: _default(value) if isinstance(value, datetime) else value for key, value in row.items()})
+        nrows += 1
+
+        if nrows == chunksize:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+            nrows = 0
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands over the written bytes instead of storing them"""
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def pop(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _parquet_schema(collection: str):
+    """Schema of an exported collection. Fixed, so that every row group has the same types"""
+    import pyarrow as pa
+
+    types = {str: pa.string(), int: pa.int64(), float: pa.float64(), datetime: pa.timestamp('ms')}
+    return pa.schema([(name, types[kind]) for name, kind in COLUMNS[collection]])
+
+def parquet_chunks(docs: Iterable[dict[str, Any]], collection: str, rowgroupsize: int = 10000) -> Iterator[bytes]:
+    """Serialize documents as a parquet file written one row group at a time
+
+    Nested documents are flattened. Datetimes are stored in utc without timezone.
+
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _parquet_schema(collection)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    rows = []
+
+    for doc in docs:
+        rows.append(_flatten(doc))
+        if len(rows) == rowgroupsize:
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            rows = []
+            yield sink.pop()
+
+    if rows:
+        writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+    writer.close()
+    yield sink.pop()
+
+def serialize(docs: Iterable[dict[str, Any]], collection: str, format: str, header: bool = True) -> Iterator[bytes]:
+    """Serialize the documents of an exportable collection in one of the supported formats"""
+    match format:
+        case 'ndjson':
+            return ndjson_chunks(docs)
+        case 'csv':
+            return csv_chunks(docs, [name for name, _ in COLUMNS[collection]], header=header)
+        case 'parquet':
+            return parquet_chunks(docs, collection)
+    raise ValueError(f"Unsupported format '{format}'. Supported: {', '.join(FORMATS)}")
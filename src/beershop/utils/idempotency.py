@@ -0,0 +1,240 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from collections import OrderedDict
+from typing import Optional
+from functools import wraps
+from datetime import datetime, timedelta, timezone
+import hashlib
+import threading
+import time
+import flask
+from flask import current_app, request, jsonify
+from pymongo import errors
+import logging
+logger = logging.getLogger()
+
+from beershop.utils.db import get_storage
+
+
+@dataclass
+class StoredResponse:
+    """Response returned to the first request carrying an idempotency key
+
+    Args:
+        data: body of the response
+        status: http status code
+        mimetype: mimetype of the body
+
+    """
+    data: bytes
+    status: int
+    mimetype: str
+
+    def to_response(self) -> flask.Response:
+        response = flask.Response(self.data, status=self.status, mimetype=self.mimetype)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+
+@dataclass
+class IdempotencyStore:
+    """Bounded store of recent idempotency keys and their responses
+
+    Keys are evicted when older than `ttl` seconds or, when the store is full, starting from the
+    oldest one. A key is claimed before the request is processed, so concurrent retries of a
+    request still in progress are detected.
+
+    Args:
+        maxsize: maximum number of keys kept in memory
+        ttl: time in seconds after which a key expires
+
+    """
+    PENDING = 'pending'
+    DONE = 'done'
+    NEW = 'new'
+    CONFLICT = 'conflict'
+
+    maxsize: int
+    ttl: float
+    _entries: OrderedDict = field(init=False, repr=False, default_factory=OrderedDict)
+    _lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def _expire(self, now: float):
+        """Remove expired keys. Entries are kept in insertion order of their claim time"""
+        while self._entries:
+            claimtime, _, _ = next(iter(self._entries.values()))
+            if now - claimtime < self.ttl:
+                break
+            self._entries.popitem(last=False)
+
+    def begin(self, key: str, fingerprint: str) -> tuple[str, Optional[StoredResponse]]:
+        """Claim a key
+
+        Args:
+            key: idempotency key scoped to the request
+            fingerprint: hash of the request payload
+
+        Returns:
+            the state of the key ('new', 'pending', 'done', or 'conflict' when the fingerprint
+            differs) and the stored response if any.
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = (now, fingerprint, None)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                return self.NEW, None
+
+            _, storedfingerprint, response = entry
+            if storedfingerprint != fingerprint:
+                return self.CONFLICT, None
+
+            if response is None:
+                return self.PENDING, None
+
+            return self.DONE, response
+
+    def complete(self, key: str, response: StoredResponse):
+        """Store the response of a claimed key"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], entry[1], response)
+
+    def remember(self, key: str, fingerprint: str, response: StoredResponse):
+        """Store a response obtained from another process"""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), fingerprint, response)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def abort(self, key: str):
+        """Release a claimed key, so that the request can be retried"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _claim_shared(collection, key: str, fingerprint: str, lease: float) -> tuple[str, Optional[StoredResponse]]:
+    """Claim a key in the collection shared by all the workers
+
+    A pending claim older than `lease` seconds is taken over, since the worker holding it may have
+    crashed before storing the response.
+
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        collection.insert_one(
+            {
+                '_id': key,
+                'fingerprint': fingerprint,
+                'createdat': now,
+                'claimedat': now,
+                'response': None
+            }
+        )
+        return IdempotencyStore.NEW, None
+    except errors.DuplicateKeyError:
+        doc = collection.find_one({'_id': key})
+
+    # the key expired between the insert and the read
+    if doc is None:
+        return _claim_shared(collection, key, fingerprint, lease)
+
+    if doc['fingerprint'] != fingerprint:
+        return IdempotencyStore.CONFLICT, None
+
+    if doc['response'] is None:
+        # take over an expired claim, unless another worker took it over first
+        claimedat = doc.get('claimedat')
+        since = claimedat or doc['createdat']
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        if (now - since).total_seconds() > lease:
+            taken = collection.find_one_and_update(
+                {'_id': key, 'response': None, 'claimedat': claimedat},
+                {'$set': {'claimedat': now}}
+            )
+            if taken is not None:
+                logger.warning(f'Request {key} claimed {(now - since).total_seconds():.0f} s ago taken over.')
+                return IdempotencyStore.NEW, None
+        return IdempotencyStore.PENDING, None
+
+    return IdempotencyStore.DONE, StoredResponse(**doc['response'])
+
+
+def idempotent(view):
+    """Decorator to make a route idempotent through the 'Idempotency-Key' header
+
+    A retried request carrying the same key returns the original response without being processed
+    again. Requests without the header are processed as usual.
+
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        store = current_app.extensions.get('idempotency')
+        key = request.headers.get('Idempotency-Key')
+        if store is None or not key:
+            return view(*args, **kwargs)
+
+        # scope the key to the route and the user
+        key = f'{request.method}:{request.path}:{key}'
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+        # check the keys recently seen by this worker first, then the ones seen by all the workers
+        state, stored = store.begin(key, fingerprint)
+        config = current_app.config.get('CONFIG')
+        collection = None
+        if state == IdempotencyStore.NEW and config.idempotency['shared']:
+            collection = get_storage()['idempotencykeys']
+            if config.database['backend'] == 'memory':
+                # the memory backend ignores the TTL index created by beershop-configure
+                expiry = datetime.now(timezone.utc) - timedelta(seconds=config.idempotency['ttl'])
+                collection.delete_many({'createdat': {'$lt': expiry}})
+            state, stored = _claim_shared(collection, key, fingerprint, config.idempotency['lease'])
+            if state != IdempotencyStore.NEW:
+                store.abort(key)
+                if state == IdempotencyStore.DONE:
+                    store.remember(key, fingerprint, stored)
+
+        if state == IdempotencyStore.DONE:
+            logger.info(f'Request {key} replayed.')
+            return stored.to_response()
+
+        if state == IdempotencyStore.PENDING:
+            response = jsonify({'message': 'A request with the same Idempotency-Key is still in progress'})
+            response.status_code = 409
+            return response
+
+        if state == IdempotencyStore.CONFLICT:
+            response = jsonify({'message': 'Idempotency-Key already used for a different request'})
+            response.status_code = 422
+            return response
+
+        # process the request
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except Exception:
+            store.abort(key)
+            if collection is not None:
+                collection.delete_one({'_id': key})
+            raise
+
+        stored = StoredResponse(response.get_data(), response.status_code, response.mimetype)
+        store.complete(key, stored)
+        if collection is not None:
+            collection.update_one(
+                {'_id': key},
+                {'$set': {'response': {'data': stored.data, 'status': stored.status, 'mimetype': stored.mimetype}}}
+            )
+
+        return response
+
+    return wrapper
@@ -0,0 +1,164 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Optional, Any
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from pymongo import ReturnDocument, errors
+import os
+import socket
+import threading
+import time
+import uuid
+import logging
+logger = logging.getLogger()
+
+
+class LeaseLost(Exception):
+    """Raised when a queue handler is no longer the holder of the lease"""
+
+
+def default_owner() -> str:
+    """Identifier of a queue handler instance, unique across hosts and restarts"""
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+@dataclass
+class Lease:
+    """Lease on the processing of the order queue, held by a single queue handler at a time
+
+    The lease is a document of the leases collection. The holder renews it every few seconds; when
+    it stops renewing, another instance takes it over once `ttl` seconds have elapsed. Every
+    takeover increments the term of the lease, and every write of the holder on the lease
+    document is conditional on its term, so a former holder cannot move the checkpoint.
+
+    The document also keeps the checkpoint, the '_id' of the last queued order processed, and the
+    writes of the batch in progress, so that a new holder completes them and resumes right after
+    the last order processed by the former one.
+
+    Expiry times are set with the clock of the instances, that must be kept in sync.
+
+    Args:
+        collection: collection of the leases
+        name: name of the lease
+        owner: identifier of the instance
+        ttl: time in seconds after the last renewal when the lease can be taken over
+
+    """
+    collection: Any
+    name: str = 'queuehandler'
+    owner: str = field(default_factory=default_owner)
+    ttl: float = 10
+    term: Optional[int] = None
+    _deadline: float = field(init=False, repr=False, default=0)
+    _stop: threading.Event = field(init=False, repr=False, default_factory=threading.Event)
+
+    @property
+    def held(self) -> bool:
+        """Whether the lease was renewed within `ttl` seconds, by the clock of this instance"""
+        return self.term is not None and time.monotonic() < self._deadline
+
+    def _fence(self) -> dict[str, Any]:
+        return {'_id': self.name, 'owner': self.owner, 'term': self.term}
+
+    def acquire(self) -> Optional[dict[str, Any]]:
+        """Take the lease if it is free or expired
+
+        Returns:
+            the lease document, or None if another instance holds the lease
+
+        """
+        now = datetime.now(timezone.utc)
+        begin = time.monotonic()
+        try:
+            doc = self.collection.find_one_and_update(
+                {'_id': self.name, '$or': [{'owner': None}, {'expires': {'$lt': now}}]},
+                {
+                    '$set': {'owner': self.owner, 'expires': now + timedelta(seconds=self.ttl), 'renewed': now},
+                    '$inc': {'term': 1},
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except errors.DuplicateKeyError:
+            # the lease exists and it is held by another instance
+            return None
+
+        self.term = doc['term']
+        self._deadline = begin + self.ttl
+        return doc
+
+    def renew(self) -> bool:
+        """Extend the lease. Returns False if the lease was taken over"""
+        now = datetime.now(timezone.utc)
+        begin = time.monotonic()
+        result = self.collection.update_one(
+            self._fence(),
+            {'$set': {'expires': now + timedelta(seconds=self.ttl), 'renewed': now}}
+        )
+        if result.matched_count == 0:
+            self._deadline = 0
+            return False
+        self._deadline = begin + self.ttl
+        return True
+
+    def release(self):
+        """Give up the lease, so that a standby instance takes it over without waiting for the expiry"""
+        self.stop()
+        try:
+            self.collection.update_one(self._fence(), {'$set': {'owner': None}})
+        except errors.PyMongoError as err:
+            logger.warning(f'Failed to release the lease, it expires in {self.ttl} seconds. ({err})')
+        self.term = None
+
+    def journal(self, batchid: ObjectId, marker: ObjectId, stockchanges: dict[str, int], updates: dict[tuple[str, str], dict[str, Any]]):
+        """Record the writes of a batch before applying them
+
+        Args:
+            batchid: '_id' of the last queued order of the batch
+            marker: identifier of the stock updates of the batch
+            stockchanges: stock change by item id
+            updates: fields updated for every order, by order id and user
+
+        Raises:
+            LeaseLost: if the lease was taken over
+
+        """
+        pending = {
+            'batch': batchid,
+            'marker': marker,
+            'stock': [{'id': iditem, 'change': change} for iditem, change in stockchanges.items()],
+            'orders': [{'id': idorder, 'user': user, 'changes': changes} for (idorder, user), changes in updates.items()],
+        }
+        if self.collection.update_one(self._fence(), {'$set': {'pending': pending}}).matched_count == 0:
+            raise LeaseLost(f'Lease {self.name} taken over before the writes of batch {batchid}.')
+
+    def commit(self, batchid: ObjectId):
+        """Move the checkpoint after a batch, whose writes are completed
+
+        Raises:
+            LeaseLost: if the lease was taken over
+
+        """
+        result = self.collection.update_one(self._fence(), {'$set': {'checkpoint': batchid}, '$unset': {'pending': ''}})
+        if result.matched_count == 0:
+            raise LeaseLost(f'Lease {self.name} taken over before the checkpoint of batch {batchid}.')
+
+    def start(self, interval: float) -> threading.Thread:
+        """Renew the lease every `interval` seconds in a background thread, until it is lost or stopped"""
+        self._stop = threading.Event()
+        thread = threading.Thread(target=self._heartbeat, args=(interval, self._stop), name='lease', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+
+    def _heartbeat(self, interval: float, stop: threading.Event):
+        while not stop.wait(interval):
+            try:
+                if not self.renew():
+                    logger.warning(f'Lease {self.name} taken over by another instance.')
+                    return
+            except errors.PyMongoError as err:
+                # keep trying until the lease expires, then the holder stops processing
+                logger.warning(f'Failed to renew the lease {self.name}. ({err})')
@@ -0,0 +1,167 @@
+from __future__ import annotations
+from typing import Optional, Any
+from datetime import datetime, timezone
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+logger = logging.getLogger()
+
+
+# events of the stock audit, never sampled out nor dropped
+AUDIT = {'stock.updated', 'order.deadletter'}
+
+# fraction of the events kept, by event name. Events not listed are always kept
+_sampling: dict[str, float] = {}
+
+# handler and listener installed on the root logger
+_installed: Optional[tuple[AsyncHandler, logging.handlers.QueueListener]] = None
+
+
+class Event:
+    """Message of a structured log record, formatted only when the record is written
+
+    Args:
+        name: name of the event, e.g. 'order.applied'
+        template: message with the fields in braces, e.g. 'Order {order} confirmed'
+        fields: values of the event
+
+    """
+    __slots__ = ('name', 'template', 'fields')
+
+    def __init__(self, name: str, template: str, fields: dict[str, Any]):
+        self.name = name
+        self.template = template
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return self.template.format(**self.fields)
+
+
+def sampled(name: str, level: int = logging.INFO) -> bool:
+    """Whether an event is kept by the sampling. Warnings, errors and audit events are always kept"""
+    rate = _sampling.get(name, 1)
+    return rate >= 1 or level >= logging.WARNING or name in AUDIT or random.random() < rate
+
+def log_event(logger: logging.Logger, level: int, name: str, template: str, **fields):
+    """Log an event, unless it is sampled out
+
+    The message is not formatted here: the fields are kept in the record and the message is built
+    by the handler that writes it. Fields must not be changed after the call.
+
+    Args:
+        logger: logger of the module
+        level: level of the record
+        name: name of the event
+        template: message with the fields in braces
+        fields: values of the event
+
+    """
+    if logger.isEnabledFor(level) and sampled(name, level):
+        logger.log(level, Event(name, template, fields), stacklevel=2)
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as single-line JSON objects, with the fields of the events"""
+    def format(self, record: logging.LogRecord) -> str:
+        doc = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'thread': record.threadName,
+        }
+        if isinstance(record.msg, Event):
+            doc['event'] = record.msg.name
+            doc.update(record.msg.fields)
+        doc['message'] = record.getMessage()
+        if record.exc_info:
+            doc['exception'] = self.formatException(record.exc_info)
+        return json.dumps(doc, default=str)
+
+
+class StderrHandler(logging.StreamHandler):
+    """Handler writing to the current standard error, even if it is replaced after the setup"""
+    def __init__(self, level: int = logging.NOTSET):
+        logging.Handler.__init__(self, level)
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+
+class AsyncHandler(logging.handlers.QueueHandler):
+    """Handler putting the records in a bounded queue, written by a background thread
+
+    When the queue is full, records are dropped and counted, except warnings, errors and audit
+    events that wait for room in the queue.
+
+    Args:
+        records: queue of the records
+
+    """
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the message is formatted by the listener thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.WARNING or (isinstance(record.msg, Event) and record.msg.name in AUDIT):
+                self.queue.put(record)
+            else:
+                self.dropped += 1
+
+
+def configure_logging(config: dict[str, Any]) -> Optional[logging.handlers.QueueListener]:
+    """Set up the logging of the process
+
+    Adds to the root logger a handler putting the records in a queue, written to the standard error
+    by a background thread in text or JSON format. Calling it again replaces the previous setup.
+
+    Args:
+        config: logging configuration of the application
+
+    Returns:
+        the listener writing the records, None if the logging is not enabled
+
+    """
+    global _installed, _sampling
+
+    if not config.get('enabled'):
+        return None
+    _sampling = dict(config.get('sampling') or {})
+
+    # stop the previous listener, writing the records left in its queue
+    root = logging.getLogger()
+    if _installed is not None:
+        handler, listener = _installed
+        root.removeHandler(handler)
+        listener.stop()
+    else:
+        atexit.register(_stop)
+
+    output = StderrHandler()
+    if config.get('format') == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+
+    handler = AsyncHandler(queue.Queue(config.get('queuesize', 10000)))
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    listener.start()
+
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, str(config.get('level', 'INFO')).upper()))
+    _installed = (handler, listener)
+    return listener
+
+def _stop():
+    if _installed is not None:
+        _installed[1].stop()
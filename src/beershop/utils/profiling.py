@@ -0,0 +1,240 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Optional, Any
+from bisect import bisect_left
+from contextlib import contextmanager
+from pymongo import monitoring
+import bson
+import flask
+from flask import g, request
+import os
+import random
+import threading
+import time
+import logging
+logger = logging.getLogger()
+
+
+@dataclass
+class RequestStats:
+    """Database usage of a single request
+
+    Args:
+        commands: number of commands sent to MongoDB
+        bytessent: size of the commands in bytes
+        bytesreceived: size of the replies in bytes
+        dbtime: time in milliseconds spent waiting for MongoDB
+        names: number of commands by command name
+
+    """
+    commands: int = 0
+    bytessent: int = 0
+    bytesreceived: int = 0
+    dbtime: float = 0.0
+    names: dict[str, int] = field(default_factory=dict)
+
+
+class CommandProfiler(monitoring.CommandListener):
+    """Listener of the MongoDB commands issued by the thread serving a request
+
+    pymongo calls the listener in the thread that sends the command, so the commands of every
+    request are counted separately with a thread local. Commands sent by another thread on behalf
+    of requests, like the group commit of the order queue, are counted with `shared`.
+
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def begin(self):
+        self._local.stats = RequestStats()
+
+    def end(self) -> Optional[RequestStats]:
+        stats = getattr(self._local, 'stats', None)
+        self._local.stats = None
+        return stats
+
+    def _stats(self) -> Optional[RequestStats]:
+        return getattr(self._local, 'stats', None)
+
+    def current(self) -> Optional[RequestStats]:
+        """Stats of the request served by the current thread, if any"""
+        return self._stats()
+
+    @contextmanager
+    def shared(self, requests: list[Optional[RequestStats]]):
+        """Count the commands sent by the current thread on behalf of several requests
+
+        Every request counts the commands and the database time in full, since it waits for them,
+        and an equal share of the bytes. The requests must be waiting for the commands.
+
+        """
+        previous = self._stats()
+        stats = self._local.stats = RequestStats()
+        try:
+            yield
+        finally:
+            self._local.stats = previous
+            profiles = [profile for profile in requests if profile is not None]
+            for profile in profiles:
+                profile.commands += stats.commands
+                profile.bytessent += stats.bytessent // len(profiles)
+                profile.bytesreceived += stats.bytesreceived // len(profiles)
+                profile.dbtime += stats.dbtime
+                for name, count in stats.names.items():
+                    profile.names[name] = profile.names.get(name, 0) + count
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        stats = self._stats()
+        if stats is None:
+            return
+        stats.commands += 1
+        stats.bytessent += len(bson.encode(event.command))
+        stats.names[event.command_name] = stats.names.get(event.command_name, 0) + 1
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        stats = self._stats()
+        if stats is None:
+            return
+        stats.bytesreceived += len(bson.encode(event.reply))
+        stats.dbtime += event.duration_micros / 1000
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        stats = self._stats()
+        if stats is None:
+            return
+        stats.dbtime += event.duration_micros / 1000
+
+
+@dataclass
+class RouteProfile:
+    """Latency histogram and database usage of a route
+
+    Args:
+        buckets: upper bounds in milliseconds of the latency buckets
+
+    """
+    buckets: list[float]
+    counts: list[int] = field(init=False)
+    requests: int = 0
+    latency: float = 0.0
+    maxlatency: float = 0.0
+    commands: int = 0
+    bytessent: int = 0
+    bytesreceived: int = 0
+    dbtime: float = 0.0
+
+    def __post_init__(self):
+        # the last bucket collects the requests slower than the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def add(self, elapsed: float, stats: Optional[RequestStats]):
+        self.counts[bisect_left(self.buckets, elapsed)] += 1
+        self.requests += 1
+        self.latency += elapsed
+        self.maxlatency = max(self.maxlatency, elapsed)
+        if stats is not None:
+            self.commands += stats.commands
+            self.bytessent += stats.bytessent
+            self.bytesreceived += stats.bytesreceived
+            self.dbtime += stats.dbtime
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the quantile `q`"""
+        if not self.requests:
+            return None
+        target = q * self.requests
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= target:
+                return bound
+        return self.maxlatency
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'latency': {
+                'mean': self.latency / self.requests if self.requests else None,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'max': self.maxlatency,
+                'histogram': {
+                    **{f'le{bound:g}': count for bound, count in zip(self.buckets, self.counts)},
+                    'inf': self.counts[-1],
+                },
+            },
+            'db': {
+                'commands': self.commands / self.requests if self.requests else None,
+                'bytessent': self.bytessent / self.requests if self.requests else None,
+                'bytesreceived': self.bytesreceived / self.requests if self.requests else None,
+                'time': self.dbtime / self.requests if self.requests else None,
+            },
+        }
+
+
+@dataclass
+class Profiler:
+    """Per-route profiling of the requests served by the current process
+
+    Latencies are in milliseconds. Database figures of a route are averages per request.
+
+    Args:
+        profiling: configuration of the profiler
+
+    """
+    profiling: dict[str, Any]
+    listener: CommandProfiler = field(init=False, default_factory=CommandProfiler)
+    routes: dict[str, RouteProfile] = field(init=False, default_factory=dict)
+    _lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def init_app(self, app: flask.Flask):
+        """Install the request hooks on the application"""
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def before_request(self):
+        g.profilingstart = time.perf_counter()
+        self.listener.begin()
+
+    def after_request(self, response: flask.Response) -> flask.Response:
+        start = g.pop('profilingstart', None)
+        stats = self.listener.end()
+        if start is None:
+            return response
+        elapsed = (time.perf_counter() - start) * 1000
+
+        rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        route = f'{request.method} {rule}'
+        with self._lock:
+            profile = self.routes.get(route)
+            if profile is None:
+                profile = self.routes[route] = RouteProfile(self.profiling['buckets'])
+            profile.add(elapsed, stats)
+
+        if self.profiling['servertiming']:
+            timings = [f'app;dur={elapsed:.2f}']
+            if stats is not None:
+                timings.append(f'db;dur={stats.dbtime:.2f};desc="{stats.commands} commands"')
+            response.headers['Server-Timing'] = ', '.join(timings)
+
+        # log a sample of the slow requests
+        if elapsed >= self.profiling['slowrequest'] and random.random() < self.profiling['samplerate']:
+            commands = stats.names if stats is not None else {}
+            logger.warning(
+                f'Slow request {route} ({request.path}): {elapsed:.1f} ms, '
+                f'{sum(commands.values())} db commands {commands}.'
+            )
+
+        return response
+
+    def report(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'routes': {route: profile.to_dict() for route, profile in sorted(self.routes.items())},
+            }
+
+    def reset(self):
+        with self._lock:
+            self.routes.clear()
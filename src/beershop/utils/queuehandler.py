@@ -1,222 +1,675 @@
 from __future__ import annotations
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import dataclass, field
+from collections import deque
+from typing import Optional, Any, Callable
 import time
 from datetime import datetime, timezone
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import UpdateOne, errors
 import pymongo
+import threading
 import sys
 import logging
 logger = logging.getLogger()
 
+from beershop.utils.engine import OrderEngine
+from beershop.utils.durability import with_durability
+from beershop.utils.storage import Storage
+from beershop.utils.db import create_storage
+from beershop.utils.leader import Lease, LeaseLost
+from beershop.utils.logs import log_event
+from beershop.utils.velocity import record as record_velocity
+
+
+def check(order: dict[str, Any]) -> Optional[str]:
+    """Check the format of a queued order
+
+    Returns:
+        description of the first problem found, or None if the order is well formed
+
+    """
+    if order.get('type') not in ['new', 'modify', 'delete']:
+        return f"Unknown order type {order.get('type')!r}."
+    for key in ['id', 'user']:
+        if not isinstance(order.get(key), str):
+            return f"Missing or wrong '{key}'."
+    if not isinstance(order.get('order'), dict):
+        return "Missing or wrong 'order'."
+    if not isinstance(order['order'].get('id'), str):
+        return "Missing or wrong item 'id'."
+    quantity = order['order'].get('quantity')
+    if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity <= 0:
+        return f"Wrong quantity {quantity!r}. Expected a positive integer."
+    return None
+
+def requeue(storage: Storage, ids: Optional[list[ObjectId]] = None, maxattempts: Optional[int] = 3) -> tuple[int, int]:
+    """Move orders from the dead-letter collection back to the queue
+
+    Args:
+        storage: storage of the application
+        ids: '_id' of the dead letters to requeue. Default: all.
+        maxattempts: dead letters that already failed this number of times are not requeued. None
+            for no limit.
+
+    Returns:
+        number of orders requeued and number of orders skipped for too many attempts
+
+    """
+    filters = {'_id': {'$in': ids}} if ids is not None else {}
+
+    nrequeued = 0
+    nskipped = 0
+    for deadletter in list(storage.deadletter.find(filters)):
+        if maxattempts is not None and deadletter['attempts'] >= maxattempts:
+            nskipped += 1
+            continue
+
+        # the order gets a new '_id', so that it is read by the queue handler as a new entry
+        storage.queue.insert_one({**deadletter['queued'], 'attempts': deadletter['attempts']})
+        storage.deadletter.delete_one({'_id': deadletter['_id']})
+        nrequeued += 1
+
+    return nrequeued, nskipped
+
+def prioritize(orders: list[dict[str, Any]], ahead: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Order in which the orders of a batch are applied
+
+    Modifications and deletions come first, then the orders read ahead of the batch, then the new
+    orders. An operation on an order whose creation is in the batch, and every operation after it
+    on the same order, keeps its place among the new orders.
+
+    Args:
+        orders: orders of the batch, in order of arrival
+        ahead: modifications and deletions queued after the batch, in order of arrival
+
+    """
+    releasing = []
+    pending = []
+    pinned = set()
+    for order in orders:
+        key = (order['id'], order['user'])
+        if order['type'] in ['modify', 'delete'] and key not in pinned:
+            releasing.append(order)
+        else:
+            pinned.add(key)
+            pending.append(order)
+
+    ahead = [order for order in ahead if (order['id'], order['user']) not in pinned]
+    return releasing + ahead + pending
+
 
 @dataclass
 class QueueHandler:
     """Class to manage the queue of orders
-    
+
+    Orders are read from the queue in batches. A batch collects the orders arriving within `window`
+    seconds, up to `batchsize` orders, and it is applied with a single read and a single write for
+    the items and for the orders involved: all the operations on the same order collapse into its
+    final state and the stock changes of the same item are summed into one update.
+
     Args:
         database: configuration of the database
         polling: time in seconds between every check on queue for new documents
+        window: time in seconds to wait for further orders to add to a batch
+        batchsize: maximum number of orders in a batch
+        durability: configuration of the durability profiles of the writes
+        retries: number of retries of the reads of a batch on connection errors
+        backoff: time in seconds before the first retry, doubled at every retry
+        leasettl: time in seconds after which the lease of a silent leader can be taken over
+        heartbeat: time in seconds between the renewals of the lease, and between the attempts to
+            take it over
+        lookahead: maximum number of modifications and deletions read beyond a batch and applied
+            ahead of its new orders. 0 to process the queue in order of arrival.
+        velocity: whether the quantities sold and released and the stock of the items are recorded
+            by minute.
 
     """
-    _QUEUE_COLLECTION = 'orderqueue'
-    _ORDERS_COLLECTION = 'orders'
-    _ITEMS_COLLECTION = 'items'
-
     database: DatabaseConfig
     polling: int
+    window: float = 0.05
+    batchsize: int = 500
+    durability: dict[str, Any] = field(default_factory=dict)
+    retries: int = 3
+    backoff: float = 0.1
+    leasettl: float = 10
+    heartbeat: float = 2
+    lookahead: int = 0
+    velocity: bool = False
+    _ahead: set[ObjectId] = field(init=False, repr=False, default_factory=set)
+    _readahead: deque = field(init=False, repr=False, default_factory=deque)
+    _stop: threading.Event = field(init=False, repr=False, default_factory=threading.Event)
+    _thread: Optional[threading.Thread] = field(init=False, repr=False, default=None)
+
+    def collect(self, cursor: pymongo.cursor.Cursor) -> list[dict[str, Any]]:
+        """Collect a batch of orders from the queue
+
+        With a lookahead, the orders already queued after the batch are also read, up to
+        `batchsize` or `lookahead` orders, to apply their modifications and deletions ahead. They
+        start the next batch.
+
+        Args:
+            cursor: tailable cursor on the queue
+
+        Returns:
+            list of queued orders, in the order of arrival. Empty if the queue has no new orders.
+
+        """
+        batch = []
+        while self._readahead and len(batch) < self.batchsize:
+            batch.append(self._readahead.popleft())
+        if not batch:
+            try:
+                batch = [cursor.next()]
+            except StopIteration:
+                return []
+
+        # keep reading until the window is elapsed or the batch is full
+        order = batch[-1]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.batchsize and time.monotonic() < deadline:
+            order = cursor.try_next()
+            if order is None:
+                break
+            batch.append(order)
+
+        # read ahead the orders already queued
+        while self.lookahead and order is not None and len(self._readahead) < max(self.batchsize, self.lookahead):
+            order = cursor.try_next()
+            if order is not None:
+                self._readahead.append(order)
+
+        return batch
+
+    def ahead(self) -> list[dict[str, Any]]:
+        """Modifications and deletions read from the queue after the batch, to apply them ahead
+
+        Modifications only reduce quantities and deletions release the stock of an order, so
+        applying them first avoids canceling the new orders of the batch for stock about to be
+        released. At most `lookahead` orders are returned, so that the new orders of the batch are
+        not delayed further.
+
+        Returns:
+            queued orders marked as 'ahead', in order of arrival
+
+        """
+        if not self.lookahead:
+            return []
+
+        ahead = [
+            {**order, 'ahead': True}
+            for order in self._readahead
+            if order.get('type') in ['modify', 'delete'] and order['_id'] not in self._ahead
+        ]
+        return ahead[:self.lookahead]
+
+    def _retry(self, operation: Callable[[], Any]) -> Any:
+        """Run a read on the database, retrying up to `retries` times on connection errors"""
+        for attempt in range(self.retries + 1):
+            try:
+                return operation()
+            except errors.ConnectionFailure as err:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f'Database read failed, retrying ({attempt + 1}/{self.retries}). ({err})')
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def deadletter(self, collection_deadletter, order: dict[str, Any], error: str, stage: str):
+        """Move a queued order that cannot be processed to the dead-letter collection
+
+        Args:
+            collection_deadletter: dead-letter collection. If None, the order is only logged.
+            order: queued order
+            error: description of the error
+            stage: processing stage that failed ('validate', 'read', 'apply' or 'write')
+
+        """
+        log_event(
+            logger, logging.ERROR, 'order.deadletter', 'Order {order} moved to the dead-letter queue. {stage}: {error}',
+            order=order.get('id'), queueid=order.get('_id'), stage=stage, error=error
+        )
+        if collection_deadletter is None:
+            return
+
+        deadletter = {
+            'queued': {key: value for key, value in order.items() if key not in ['_id', 'ahead']},
+            'queueid': order.get('_id'),
+            'error': error,
+            'stage': stage,
+            'attempts': order.get('attempts', 0) + 1,
+            'failedtime': datetime.now(timezone.utc),
+        }
+        if deadletter['queueid'] is None:
+            collection_deadletter.insert_one(deadletter)
+            return
+
+        # a batch processed again after a failover does not duplicate its dead letters
+        collection_deadletter.update_one({'queueid': deadletter['queueid']}, {'$setOnInsert': deadletter}, upsert=True)
+
+    def process(self, batch: list[dict[str, Any]], collection_orders, collection_items, collection_deadletter=None, lease: Optional[Lease] = None, ahead: Optional[list[dict[str, Any]]] = None, collection_velocity=None) -> dict[tuple[str, str], dict[str, Any]]:
+        """Apply a batch of queued orders
+
+        The orders are applied one by one in memory in the order of arrival, so every order gets
+        the same outcome it would get if processed alone. Only the final state of every order and
+        the total stock change of every item are then written to the database.
+
+        A queued order that is malformed or fails to apply is moved to the dead-letter collection
+        without affecting the other orders of the batch.
+
+        With a lease, the writes are recorded in the lease document before being applied, and a
+        failing write is raised instead of moving the orders to the dead-letter collection: the
+        next holder of the lease completes them.
+
+        With a lookahead, modifications and deletions, of the batch and read ahead of it, are
+        applied before the new orders of the batch, keeping the order of arrival of the operations
+        on the same order.
+
+        Args:
+            batch: queued orders
+            collection_orders: collection of the orders
+            collection_items: collection of the items
+            collection_deadletter: collection of the orders that cannot be processed
+            lease: lease held by the queue handler, if elected among several instances
+            ahead: modifications and deletions queued after the batch, to apply ahead of it
+            collection_velocity: collection of the velocity buckets of the items, if recorded
+
+        Returns:
+            fields updated for every order, by order id and user
+
+        """
+        # isolate malformed documents
+        orders = []
+        for order in batch:
+            if order.get('dummy') == 'dummy':
+                # seed of the queue written by beershop-configure
+                continue
+            error = check(order)
+            if error is not None:
+                self.deadletter(collection_deadletter, order, error, 'validate')
+                continue
+            orders.append(order)
+
+        # malformed orders read ahead are moved to the dead-letter queue when their turn comes
+        if self.lookahead:
+            orders = prioritize(orders, [order for order in ahead or [] if check(order) is None])
+
+        # orders of the items whose stock was reserved by the API while the batch was applied are
+        # applied again on the new stock
+        updates = {}
+        for attempt in range(self.retries + 1):
+            if not orders:
+                break
+            if attempt > 0:
+                logger.warning(f'Stock changed while applying {len(orders)} orders, applying them again ({attempt}/{self.retries}).')
+            orders = self.apply(orders, batch, updates, collection_orders, collection_items, collection_deadletter, lease, collection_velocity)
+
+        for order in orders:
+            self.deadletter(collection_deadletter, order, f'Stock changed while applying the order {self.retries + 1} times.', 'write')
+
+        return updates
+
+    def apply(self, orders: list[dict[str, Any]], batch: list[dict[str, Any]], updates: dict[tuple[str, str], dict[str, Any]], collection_orders, collection_items, collection_deadletter=None, lease: Optional[Lease] = None, collection_velocity=None) -> list[dict[str, Any]]:
+        """Apply valid queued orders on the current stock and write the results
+
+        Args:
+            orders: valid queued orders
+            batch: batch of the orders
+            updates: fields updated for every order, by order id and user, updated in place
+            collection_orders: collection of the orders
+            collection_items: collection of the items
+            collection_deadletter: collection of the orders that cannot be processed
+            lease: lease held by the queue handler, if elected among several instances
+            collection_velocity: collection of the velocity buckets of the items, if recorded
+
+        Returns:
+            orders not written because the stock of their item changed in the meantime
+
+        """
+        # get stock of the items and current state of the orders modified or deleted in the batch
+        try:
+            stock, current = self._retry(lambda: self.load(orders, collection_orders, collection_items))
+        except errors.PyMongoError as err:
+            for order in orders:
+                self.deadletter(collection_deadletter, order, str(err), 'read')
+            return []
+
+        # apply orders in memory. A failing order leaves the engine unchanged
+        engine = OrderEngine(stock, current)
+        applied = []
+        for order in orders:
+            try:
+                outcome, message = engine.apply(order)
+            except Exception as err:
+                if not order.get('ahead'):
+                    self.deadletter(collection_deadletter, order, f'{type(err).__name__}: {err}', 'apply')
+                continue
+            if outcome == 'deferred':
+                continue
+            applied.append(order)
+            log_event(logger, logging.INFO, 'order.applied', '{message}', order=order['id'], type=order['type'], outcome=outcome, message=message)
+
+        # writes are not retried here, since a stock increment cannot be safely repeated. MongoDB
+        # retryable writes already retry them once, and apply them at most once. The marker makes
+        # the stock updates of the batch recognizable
+        stockchanges = engine.stockchanges()
+        marker = ObjectId()
+        if lease is not None and (stockchanges or engine.updates):
+            lease.journal(batch[-1]['_id'], marker, stockchanges, engine.updates)
+        try:
+            conflicts = self.write_stock(stockchanges, collection_items, marker)
+            items = {(order['id'], order['user']): order['order']['id'] for order in applied}
+            written = {key: changes for key, changes in engine.updates.items() if items[key] not in conflicts}
+            self.write_orders(written, collection_orders)
+        except errors.PyMongoError as err:
+            if lease is not None:
+                raise
+            for order in applied:
+                self.deadletter(collection_deadletter, order, str(err), 'write')
+            return []
+
+        for iditem in stockchanges:
+            if iditem not in conflicts:
+                log_event(
+                    logger, logging.INFO, 'stock.updated', 'Stock of item {item} updated from {before} to {after}.',
+                    item=iditem, before=engine.initialstock[iditem], after=engine.stock[iditem], marker=marker
+                )
+        for key, changes in written.items():
+            updates.setdefault(key, {}).update(changes)
+
+        # the orders of the items in conflict are counted when applied again. A failure loses the
+        # statistics of the batch, not its orders
+        if collection_velocity is not None:
+            try:
+                record_velocity(
+                    collection_velocity,
+                    datetime.now(timezone.utc),
+                    {iditem: quantity for iditem, quantity in engine.sold.items() if iditem not in conflicts},
+                    {iditem: quantity for iditem, quantity in engine.released.items() if iditem not in conflicts},
+                    engine.stock
+                )
+            except errors.PyMongoError as err:
+                logger.warning(f'Failed to record the velocity of the items of the batch. ({err})')
+
+        # orders applied ahead are skipped when the queue reaches them
+        for order in applied:
+            if order.get('ahead') and order['order']['id'] not in conflicts:
+                self._ahead.add(order['_id'])
+
+        return [order for order in applied if order['order']['id'] in conflicts]
+
+    def write_stock(self, stockchanges: dict[str, int], collection_items, marker: ObjectId, guard: bool = True) -> set[str]:
+        """Write the total stock change of every item of a batch
+
+        The items are marked with the batch, so that writing the same batch again does not change
+        the stock twice.
+
+        Args:
+            stockchanges: stock change by item id
+            collection_items: collection of the items
+            marker: identifier of the batch
+            guard: whether a decrement is applied only if the stock is still sufficient. The API
+                reserves stock directly when the fast path is enabled.
+
+        Returns:
+            id of the items not updated because their stock is no longer sufficient
+
+        """
+        if not stockchanges:
+            return set()
+
+        requests = []
+        for iditem, change in stockchanges.items():
+            filters = {'id': iditem, 'lastbatch': {'$ne': marker}}
+            if guard and change < 0:
+                filters['instock'] = {'$gte': -change}
+            requests.append(UpdateOne(filters, {'$inc': {'instock': change}, '$set': {'lastbatch': marker}}))
+        result = with_durability(collection_items, self.durability, 'update').bulk_write(requests, ordered=False)
+        if result.matched_count == len(requests):
+            return set()
+
+        # the items not marked were not updated
+        return {
+            item['id']
+            for item in collection_items.find(
+                {'id': {'$in': list(stockchanges)}, 'lastbatch': {'$ne': marker}},
+                {'_id': False, 'id': True}
+            )
+        }
+
+    def write_orders(self, updates: dict[tuple[str, str], dict[str, Any]], collection_orders):
+        """Write the final state of every order of a batch. Setting the final state is idempotent"""
+        if updates:
+            with_durability(collection_orders, self.durability, 'update').bulk_write(
+                [UpdateOne({'id': idorder, 'user': user}, {'$set': changes}) for (idorder, user), changes in updates.items()],
+                ordered=False
+            )
+
+    def recover(self, storage: Storage, lease: Lease, pending: Optional[dict[str, Any]]) -> Optional[ObjectId]:
+        """Complete the writes of the batch in progress when the former holder of the lease stopped
+
+        The decisions of the former leader are kept, so the stock is updated without checking it
+        again.
+
+        Returns:
+            '_id' of the last queued order of the batch completed, if any
+
+        """
+        if not pending:
+            return None
+
+        stockchanges = {change['id']: change['change'] for change in pending['stock']}
+        updates = {(order['id'], order['user']): order['changes'] for order in pending['orders']}
+        self.write_stock(stockchanges, storage.items, pending['marker'], guard=False)
+        self.write_orders(updates, storage.orders)
+        lease.commit(pending['batch'])
+        logger.info(f"Writes of {len(updates)} orders left by the former leader completed.")
+        return pending['batch']
+
+    def load(self, orders: list[dict[str, Any]], collection_orders, collection_items) -> tuple[dict[str, int], dict[tuple[str, str], dict[str, Any]]]:
+        """Read the stock of the items and the state of the orders involved in a batch
+
+        Args:
+            orders: queued orders
+            collection_orders: collection of the orders
+            collection_items: collection of the items
+
+        Returns:
+            stock by item id and current state of the modified or deleted orders by order id and user
+
+        """
+        # get stock of the items in the batch
+        itemids = list({order['order']['id'] for order in orders})
+        stock = {
+            item['id']: item['instock']
+            for item in collection_items.find(
+                {'id': {'$in': itemids}},
+                {'_id': False, 'id': True, 'instock': True}
+            )
+        }
+
+        # get current state of the orders modified or deleted in the batch
+        keys = list({(order['id'], order['user']) for order in orders if order['type'] != 'new'})
+        current = {}
+        if keys:
+            for order in collection_orders.find(
+                {'$or': [{'id': idorder, 'user': user} for idorder, user in keys]},
+                {'_id': False}
+            ):
+                current[(order['id'], order['user'])] = order
+
+        return stock, current
 
-    def listen(self, starttime: Optional[datetime] = None):
+    def listen(self, starttime: Optional[datetime] = None, election: bool = False):
         """Listen to new documents
-        
+
         Args:
             starttime: whether to start processing orders from a specific datetime.
+            election: whether to process orders only while holding the lease, so that several
+                instances can run as hot standbys of each other
 
         """
         # connect to db
-        client = MongoClient(
-            host=self.database['host'],
-            port=self.database['port'], 
-            serverSelectionTimeoutMS=self.database['timeout']
-        )
+        storage = create_storage(self.database)
 
-        # test connection
-        try:
-            client.is_mongos
-        except errors.ServerSelectionTimeoutError as err:
-            logger.error(f'Failed to connect to database. \n({err})')
-            sys.exit(1)
-
-        # get collection of queued orders
-        db = client[self.database['name']]
-        collection_queue = db[self._QUEUE_COLLECTION]
-
-        # filter by starttime
-        if starttime is not None:
-            filterstarttime = {'creationtime': {'$gt': starttime}}
+        if election:
+            self.lead(storage, starttime)
+        else:
+            self.run(storage, starttime)
+
+    def lead(self, storage: Storage, starttime: Optional[datetime] = None, lease: Optional[Lease] = None):
+        """Process the orders of the queue while holding the lease, waiting as a standby otherwise
+
+        The first leader starts from `starttime`. Every following leader resumes right after the
+        last order processed by the former one. The lease is released when `stop` is called.
+
+        Args:
+            storage: storage of the application
+            starttime: whether to start processing orders from a specific datetime, when no
+                leader processed orders before
+            lease: lease to take. Default: the lease of the queue handler in the leases collection.
+
+        """
+        if lease is None:
+            lease = Lease(storage[Storage.LEASES], ttl=self.leasettl)
+
+        logger.info(f'Queue handler {lease.owner} waiting for the lease...')
+        while not self._stop.is_set():
+            try:
+                doc = lease.acquire()
+            except errors.PyMongoError as err:
+                logger.warning(f'Failed to read the lease. ({err})')
+                doc = None
+            if doc is None:
+                self._stop.wait(self.heartbeat)
+                continue
+
+            logger.info(f"Queue handler {lease.owner} is the leader (term {doc['term']}).")
+            lease.start(self.heartbeat)
+            try:
+                checkpoint = self.recover(storage, lease, doc.get('pending')) or doc.get('checkpoint')
+                self.run(storage, starttime, lease=lease, checkpoint=checkpoint)
+            except (LeaseLost, errors.PyMongoError) as err:
+                logger.warning(f'Queue handler {lease.owner} stepped down. ({err})')
+                lease.release()
+            except (KeyboardInterrupt, SystemExit):
+                lease.release()
+                raise
+            finally:
+                lease.stop()
+
+            if self._stop.is_set():
+                lease.release()
+                logger.info(f'Queue handler {lease.owner} stopped.')
+                return
+
+            # the cursor on the queue died or the lease was lost, wait before taking the lease again
+            self._stop.wait(self.heartbeat)
+
+    def start(self, storage: Storage, starttime: Optional[datetime] = None) -> threading.Thread:
+        """Listen to new documents in a background thread of the current process
+
+        Used with the in-memory storage, that is not visible outside of the process of the API.
+
+        """
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, args=(storage, starttime), name='queuehandler', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop processing the orders after the batch in progress, and wait for the thread started by `start`"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run(self, storage: Storage, starttime: Optional[datetime] = None, lease: Optional[Lease] = None, checkpoint: Optional[ObjectId] = None):
+        """Process the orders added to the queue of a storage
+
+        Args:
+            storage: storage of the application
+            starttime: whether to start processing orders from a specific datetime.
+            lease: lease held by the queue handler. Processing stops when it is lost.
+            checkpoint: '_id' of the last queued order already processed. Processing resumes
+                after it in the order of the queue. It has precedence over `starttime`.
+
+        Raises:
+            LeaseLost: if the lease is lost
+            PyMongoError: if a write fails while holding the lease
+
+        """
+        if starttime is None:
+            starttime = datetime.now(timezone.utc)
+        if checkpoint is not None and storage.queue.find_one({'_id': checkpoint}, {'_id': True}) is None:
+            logger.warning(f'Last order processed {checkpoint} no longer in the queue, resuming from the time it was queued.')
+            starttime = checkpoint.generation_time
+            checkpoint = None
+
+        # filter by the time the orders were queued, which is part of the '_id'. Modifications and
+        # deletions keep the creation time of the order, so it cannot be used. The '_id' are
+        # generated by the workers of the API, so they do not follow the order of the queue, and
+        # a checkpoint is found by reading the queue in order of insertion instead
+        if checkpoint is None:
+            filterstarttime = {'_id': {'$gt': ObjectId.from_datetime(starttime)}}
         else:
-            filterstarttime = {'creationtime': {'$gt': datetime.now(timezone.utc)}}
-        
-        # get collection of orders and items
-        collection_orders = db[self._ORDERS_COLLECTION]
-        collection_items = db[self._ITEMS_COLLECTION]
-
-        # get tailable cursor
-        cursor = collection_queue.find(
+            filterstarttime = {}
+
+        # get tailable cursor. Waits for new documents at most for the batch window
+        cursor = storage.queue.find(
             filterstarttime,
             cursor_type=pymongo.CursorType.TAILABLE_AWAIT
-        )
+        ).max_await_time_ms(max(1, int(self.window * 1000)))
+
+        # orders read ahead by a former cursor are read again
+        self._readahead.clear()
+        self._ahead.clear()
+
+        # skip the orders up to the checkpoint included
+        while checkpoint is not None:
+            order = cursor.try_next()
+            if order is None:
+                logger.warning(f'Last order processed {checkpoint} not found in the queue, resuming from the end of the queue.')
+                break
+            if order['_id'] == checkpoint:
+                break
 
         # listen to changes
         logging.info('Listening to orders...')
-        while cursor.alive:
+        while cursor.alive and not self._stop.is_set():
+            if lease is not None and not lease.held:
+                raise LeaseLost(f'Lease {lease.name} not renewed for {lease.ttl} seconds.')
+            batch = collected = []
             try:
-                order = cursor.next()
-
-                # check stock availability
-                item = collection_items.find_one(
-                    {
-                        'id': order['order']['id'],
-                    },
-                    {'id': False}
+                batch = self.collect(cursor)
+                if not batch:
+                    self._stop.wait(self.polling)
+                    continue
+
+                # skip the orders already applied ahead of the queue
+                collected = batch
+                batch = [order for order in batch if order.get('_id') not in self._ahead]
+                self._ahead.difference_update(order.get('_id') for order in collected)
+                if len(batch) < len(collected):
+                    logger.info(f'{len(collected) - len(batch)} orders already applied ahead of the queue.')
+                if not batch:
+                    if lease is not None:
+                        lease.commit(collected[-1]['_id'])
+                    continue
+
+                ahead = self.ahead()
+                self.process(
+                    batch, storage.orders, storage.items, storage.deadletter, lease, ahead,
+                    storage[Storage.VELOCITY] if self.velocity else None
                 )
-                
-                match order['type']:
-                    case 'new':
-                        if item['instock'] == 0:
-                            # set status of order as cancelled
-                            collection_orders.update_one(
-                                {
-                                    'id': order['id'],
-                                    'user': order['user']
-                                },
-                                {'$set': 
-                                    {
-                                        'status': 'canceled',
-                                        'laststatuschange': datetime.now(timezone.utc)
-                                    },
-                                }
-                            )
-                            logger.info(f"Order {order['id']} canceled because item out of stock.")
-
-                        if item['instock'] < order['order']['quantity']:
-                            # set status of order as cancelled
-                            collection_orders.update_one(
-                                {
-                                    'id': order['id'],
-                                    'user': order['user']
-                                },
-                                {'$set': 
-                                    {
-                                        'status': 'canceled',
-                                        'laststatuschange': datetime.now(timezone.utc)
-                                    },
-                                }
-                            )
-                            logger.info(f"Order {order['id']} canceled because items in stock are not sufficient for the requested order.")
-
-                        # confim order if the quantity is sufficient
-                        collection_orders.update_one(
-                            {
-                                'id': order['id'],
-                                'user': order['user']
-                            },
-                            {'$set': 
-                                {
-                                    'status': 'confirmed',
-                                    'laststatuschange': datetime.now(timezone.utc)
-                                }
-                            }
-                        )
-                        logger.info(f"Order {order['id']} confirmed.")
-
-                        # change stock quantity
-                        newstockquantity = item['instock'] - order['order']['quantity']
-                        collection_items.update_one(
-                            {
-                                'id': order['order']['id'],
-                            },
-                            {'$set': {'instock':newstockquantity}}
-                        )
-                        logger.info(f"Stock of item {order['order']['id']} updated after order {order['id']} from {item['instock']} to {newstockquantity}.")
-
-                    case 'modify':
-                        # get initial order
-                        initialorder = collection_orders.find_one(
-                            {
-                                'id': order['id'],
-                                'user': order['user']
-                            },
-                            {'_id': False}
-                        )
-
-                        # update order
-                        collection_orders.update_one(
-                            {
-                                'id': order['id'],
-                                'user': order['user']
-                            },
-                            {'$set': 
-                                {
-                                    'type': 'modify',
-                                    'status': 'confirmed',
-                                    'laststatuschange': datetime.now(timezone.utc),
-                                    'nmodified': order['nmodified'] + 1,
-                                    'lastmodified': datetime.now(timezone.utc),
-                                    'order': order['order']                                  
-                                }
-                            }
-                        )
-
-                        logger.info(f"Order {order['id']} modified.")
-
-                        # update stock quantity
-                        increasestock = initialorder['order']['quantity'] - order['order']['quantity']
-                        newstockquantity = item['instock'] + increasestock
-                        collection_items.update_one(
-                            {
-                                'id': order['order']['id'],
-                            },
-                            {'$set': {'instock': newstockquantity}}
-                        )
-                        logger.info(f"Stock of item {order['order']['id']} updated after order {order['id']} modification from {item['instock']} to {newstockquantity}.")
-                    
-                    case 'delete':
-                        # set order status as delete
-                        collection_orders.update_one(
-                            {
-                                'id': order['id'],
-                                'user': order['user']
-                            },
-                            {'$set': 
-                                {
-                                    'type': 'delete',
-                                    'status': 'deleted',
-                                    'laststatuschange': datetime.now(timezone.utc),
-                                    'nmodified': order['nmodified'] + 1,
-                                    'lastmodified': datetime.now(timezone.utc),
-                                    'order': order['order']                                  
-                                }
-                            }
-                        )
-
-                        # restore quantity in stock
-                        newstockquantity = item['instock'] + order['order']['quantity']
-                    
-                        collection_items.update_one(
-                            {
-                                'id': order['order']['id'],
-                            },
-                            {'$set': {'instock': newstockquantity}}
-                        )
-                        logger.info(f"Stock of item {order['order']['id']} updated after order {order['id']} cancellation from {item['instock']} to {newstockquantity}.")
-            except StopIteration:
-                try:
-                    time.sleep(self.polling)
-                except KeyboardInterrupt:
-                    logger.info('Queue handler stopped by the user.')
-                    sys.exit()
+                if lease is not None:
+                    lease.commit(collected[-1]['_id'])
             except KeyboardInterrupt:
                 logger.info('Queue handler stopped by the user.')
                 sys.exit()
-            
+            except LeaseLost:
+                raise
+            except Exception as err:
+                if lease is not None and isinstance(err, errors.PyMongoError):
+                    # the writes recorded in the lease are completed by the next leader
+                    raise
+                # never stop processing the orders behind a failing batch
+                logger.exception(f'Failed to process a batch of {len(batch)} orders. ({err})')
@@ -0,0 +1,133 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Optional, Any
+from concurrent.futures import Future
+from pymongo import errors
+import contextlib
+import threading
+import time
+import logging
+logger = logging.getLogger()
+
+from beershop.utils.profiling import CommandProfiler, RequestStats
+
+
+@dataclass
+class _Append:
+    collection: Any
+    document: dict[str, Any]
+    future: Future = field(default_factory=Future)
+    stats: Optional[RequestStats] = None
+
+
+@dataclass
+class QueueWriter:
+    """Group commit of the appends to the order queue
+
+    The requests of a server process hand their queued orders to a single writer thread, that
+    collects them for `window` seconds, up to `batchsize` orders, and writes them with one ordered
+    `insert_many`. Every request waits until its own order is acknowledged with the write concern
+    of the collection, so a request never answers before its order is in the queue.
+
+    Orders keep the order in which they were handed to the writer.
+
+    Args:
+        window: time in seconds to wait for further orders after the first one
+        batchsize: maximum number of orders written at once
+        listener: listener of the profiler, counting the writes in the profile of the requests
+
+    """
+    window: float = 0.002
+    batchsize: int = 100
+    listener: Optional[CommandProfiler] = None
+    _pending: list[_Append] = field(init=False, repr=False, default_factory=list)
+    _condition: threading.Condition = field(init=False, repr=False, default_factory=threading.Condition)
+    _thread: Optional[threading.Thread] = field(init=False, repr=False, default=None)
+
+    def append(self, collection, document: dict[str, Any]) -> Any:
+        """Append an order to the queue, waiting for the write of its group
+
+        Args:
+            collection: collection of the queue, with the write concern of the appends
+            document: queued order
+
+        Returns:
+            '_id' of the queued order
+
+        Raises:
+            PyMongoError: if the order is not written
+
+        """
+        append = _Append(collection, document, stats=self.listener.current() if self.listener is not None else None)
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='queuewriter', daemon=True)
+                self._thread.start()
+            self._pending.append(append)
+            self._condition.notify()
+        return append.future.result()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+
+                # wait for further orders, unless the batch is full
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.batchsize and (left := deadline - time.monotonic()) > 0:
+                    self._condition.wait(left)
+                batch, self._pending = self._pending[:self.batchsize], self._pending[self.batchsize:]
+
+            try:
+                self.write(batch)
+            except Exception as err:
+                # never leave a request waiting
+                for append in batch:
+                    if not append.future.done():
+                        append.future.set_exception(err)
+
+    def _profiled(self, appends: list[_Append]):
+        """Count the write of a group in the profile of the requests waiting for it"""
+        if self.listener is None:
+            return contextlib.nullcontext()
+        return self.listener.shared([append.stats for append in appends])
+
+    def write(self, batch: list[_Append]):
+        """Write a batch of orders, with one `insert_many` for every collection
+
+        With an ordered `insert_many`, MongoDB stops at the first failing order: the orders before
+        it are written, and the orders after it are written again without it.
+
+        """
+        groups = {}
+        for append in batch:
+            groups.setdefault(append.collection, []).append(append)
+
+        for collection, remaining in groups.items():
+            while remaining:
+                try:
+                    with self._profiled(remaining):
+                        collection.insert_many([append.document for append in remaining], ordered=True)
+                except errors.BulkWriteError as err:
+                    writeerrors = err.details.get('writeErrors') or []
+                    if err.details.get('writeConcernErrors') or not writeerrors:
+                        for append in remaining:
+                            append.future.set_exception(err)
+                        break
+                    writeerror = writeerrors[0]
+                    failed = writeerror['index']
+                    for append in remaining[:failed]:
+                        append.future.set_result(append.document['_id'])
+                    exception = errors.DuplicateKeyError if writeerror.get('code') == 11000 else errors.WriteError
+                    remaining[failed].future.set_exception(exception(writeerror.get('errmsg'), writeerror.get('code'), writeerror))
+                    remaining = remaining[failed + 1:]
+                except errors.PyMongoError as err:
+                    logger.warning(f'Failed to append {len(remaining)} orders to the queue. ({err})')
+                    for append in remaining:
+                        append.future.set_exception(err)
+                    break
+                else:
+                    for append in remaining:
+                        append.future.set_result(append.document['_id'])
+                    break
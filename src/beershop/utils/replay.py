@@ -0,0 +1,109 @@
+from __future__ import annotations
+from typing import Any, Iterator, Iterable
+from collections import Counter
+from datetime import datetime, timezone
+from bson import json_util
+import random
+import time
+import logging
+logger = logging.getLogger()
+
+from beershop.utils.engine import OrderEngine
+
+
+def load_dump(filename: str) -> Iterator[dict[str, Any]]:
+    """Read documents from a dump written by mongoexport or beershop-export
+
+    Both newline delimited json and json arrays are supported. Extended json values (e.g.
+    '{"$date": ...}') are converted to python types.
+
+    """
+    with open(filename, 'r') as fid:
+        first = fid.read(1)
+        while first.isspace():
+            first = fid.read(1)
+        fid.seek(0)
+
+        if first == '[':
+            yield from json_util.loads(fid.read())
+            return
+
+        for line in fid:
+            if line.strip():
+                yield json_util.loads(line)
+
+def synthetic_stream(norders: int, nitems: int, seed: int = 1, user: str = 'user') -> Iterator[dict[str, Any]]:
+    """Generate a random stream of queued orders
+
+    80% of the operations are new orders, 10% reduce the quantity of a previous order and 10%
+    delete a previous order.
+
+    Args:
+        norders: number of operations
+        nitems: number of distinct items
+        seed: seed of the random generator
+        user: username of the orders
+
+    """
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    orders = []
+
+    for count in range(norders):
+        draw = rng.random()
+        if draw < 0.8 or not orders:
+            order = {
+                'type': 'new',
+                'id': f'{len(orders) + 1:06d}',
+                'order': {'id': f'{rng.randrange(nitems) + 1:04d}', 'quantity': rng.randrange(1, 6)},
+                'user': user,
+                'creationtime': now,
+                'nmodified': 0,
+                'status': 'processing',
+            }
+            orders.append(order)
+            yield order
+        else:
+            previous = orders[rng.randrange(len(orders))]
+            if draw < 0.9:
+                yield {
+                    **previous,
+                    'type': 'modify',
+                    'order': {**previous['order'], 'quantity': rng.randrange(1, previous['order']['quantity'] + 1)},
+                }
+            else:
+                yield {**previous, 'type': 'delete'}
+
+def replay(engine: OrderEngine, stream: Iterable[dict[str, Any]]) -> dict[str, Any]:
+    """Apply a stream of queued orders to an engine
+
+    Args:
+        engine: engine holding the initial stock and orders
+        stream: queued orders
+
+    Returns:
+        report with the number of orders by outcome, final stock and throughput
+
+    """
+    outcomes = Counter()
+    now = datetime.now(timezone.utc)
+
+    start = time.perf_counter()
+    for order in stream:
+        # skip documents that are not orders, like the seed of the queue
+        if 'type' not in order:
+            outcomes['skipped'] += 1
+            continue
+        outcome, _ = engine.apply(order, now)
+        outcomes[outcome] += 1
+    elapsed = time.perf_counter() - start
+
+    total = sum(outcomes.values())
+    return {
+        'orders': total,
+        'outcomes': dict(outcomes),
+        'elapsed': elapsed,
+        'throughput': total / elapsed if elapsed > 0 else None,
+        'stock': dict(engine.stock),
+        'stockchanges': engine.stockchanges(),
+    }
@@ -0,0 +1,674 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Optional, Any, Callable, Iterable, Iterator
+from itertools import chain, islice
+import heapq
+import pymongo
+from pymongo import errors
+from pymongo.operations import InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+import logging
+logger = logging.getLogger()
+
+from beershop.utils.storage import Storage
+
+
+_MISSING = object()
+
+
+@dataclass(frozen=True)
+class PaddedId:
+    """Zero-padded numeric id stored as an integer
+
+    Ids that would not be restored exactly (e.g. not numeric) are stored unchanged.
+
+    Args:
+        width: number of digits of the id
+
+    """
+    width: int
+
+    def encode(self, value: Any) -> Any:
+        if isinstance(value, str) and value.isdigit() and value == f'{int(value):0{self.width}d}':
+            return int(value)
+        return value
+
+    def decode(self, value: Any) -> Any:
+        if isinstance(value, int) and not isinstance(value, bool):
+            return f'{value:0{self.width}d}'
+        return value
+
+
+@dataclass(frozen=True)
+class Enum:
+    """Value out of a known list stored as its position. Unknown values are stored unchanged
+
+    Args:
+        values: known values
+
+    """
+    values: tuple[str, ...]
+
+    def encode(self, value: Any) -> Any:
+        if value in self.values:
+            return self.values.index(value)
+        return value
+
+    def decode(self, value: Any) -> Any:
+        if isinstance(value, int) and not isinstance(value, bool) and 0 <= value < len(self.values):
+            return self.values[value]
+        return value
+
+
+@dataclass(frozen=True)
+class Field:
+    """Field of a compact document
+
+    Args:
+        name: name of the field in the database
+        codec: conversion of the value, if any
+        fields: fields of a nested document, if any
+        default: value not stored and restored when the field is missing
+
+    """
+    name: str
+    codec: Any = None
+    fields: Optional[dict[str, Field]] = None
+    default: Any = _MISSING
+
+
+@dataclass
+class Schema:
+    """Mapping between the documents used by the application and their compact form
+
+    Fields not in the schema are stored unchanged, so documents still in the standard form are
+    decoded to themselves.
+
+    Args:
+        fields: fields of the documents by name used in the application
+        marker: field present only in the documents in the standard form
+        derived: fields computed from the other fields of the document. The field is stored
+            under the given name only when it differs from the computed value.
+
+    """
+    fields: dict[str, Field]
+    marker: str
+    derived: dict[str, tuple[str, tuple[str, ...], Callable[[dict[str, Any]], Any]]] = field(default_factory=dict)
+
+    def path(self, key: str) -> tuple[str, Optional[Field]]:
+        """Name in the database of a dotted field, and the schema of the field"""
+        spec = self.fields
+        names = []
+        current = None
+        keys = key.split('.')
+        for position, name in enumerate(keys):
+            if spec is None or name not in spec:
+                names.extend(keys[position:])
+                current = None
+                break
+            current = spec[name]
+            names.append(current.name)
+            spec = current.fields
+        return '.'.join(names), current
+
+    # documents
+
+    def _encode_value(self, spec: Optional[Field], value: Any) -> Any:
+        if spec is None or value is None:
+            return value
+        if spec.fields is not None and isinstance(value, dict):
+            return self._encode_fields(spec.fields, value)
+        if spec.codec is not None:
+            return spec.codec.encode(value)
+        return value
+
+    def _decode_value(self, spec: Optional[Field], value: Any) -> Any:
+        if spec is None or value is None:
+            return value
+        if spec.fields is not None and isinstance(value, dict):
+            return self._decode_fields(spec.fields, value)
+        if spec.codec is not None:
+            return spec.codec.decode(value)
+        return value
+
+    def _encode_fields(self, fields: dict[str, Field], doc: dict[str, Any]) -> dict[str, Any]:
+        encoded = {}
+        for key, value in doc.items():
+            spec = fields.get(key)
+            if spec is None:
+                encoded[key] = value
+            elif spec.default is _MISSING or value != spec.default:
+                encoded[spec.name] = self._encode_value(spec, value)
+        return encoded
+
+    def _decode_fields(self, fields: dict[str, Field], doc: dict[str, Any], included: Callable[[str], bool] = lambda key: True) -> dict[str, Any]:
+        names = {spec.name: (key, spec) for key, spec in fields.items()}
+        decoded = {}
+        for name, value in doc.items():
+            if name in names:
+                key, spec = names[name]
+                decoded[key] = self._decode_value(spec, value)
+            else:
+                decoded[name] = value
+        for key, spec in fields.items():
+            if spec.default is not _MISSING and key not in decoded and included(key):
+                decoded[key] = spec.default
+        return decoded
+
+    def encode(self, doc: dict[str, Any]) -> dict[str, Any]:
+        """Compact form of a document"""
+        encoded = self._encode_fields(self.fields, {key: value for key, value in doc.items() if key not in self.derived})
+        for key, (name, _, compute) in self.derived.items():
+            if key in doc and doc[key] != compute(doc):
+                encoded[name] = doc[key]
+        return encoded
+
+    def decode(self, doc: dict[str, Any], projection: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+        """Document in the form used by the application, from either the compact or the standard form"""
+        included = _included(projection)
+        decoded = self._decode_fields(self.fields, doc, included)
+        for key, (name, dependencies, compute) in self.derived.items():
+            if name in decoded:
+                decoded[key] = decoded.pop(name)
+            elif key not in decoded and included(key) and all(dependency in decoded for dependency in dependencies):
+                decoded[key] = compute(decoded)
+        return decoded
+
+    # queries
+
+    def _encode_condition(self, spec: Optional[Field], condition: Any) -> Any:
+        if isinstance(condition, dict) and any(key.startswith('$') for key in condition):
+            encoded = {}
+            for operator, operand in condition.items():
+                match operator:
+                    case '$in' | '$nin' | '$all':
+                        encoded[operator] = [self._encode_value(spec, value) for value in operand]
+                    case '$not':
+                        encoded[operator] = self._encode_condition(spec, operand)
+                    case '$exists' | '$type' | '$size' | '$regex' | '$options' | '$elemMatch':
+                        encoded[operator] = operand
+                    case _:
+                        encoded[operator] = self._encode_value(spec, operand)
+            return encoded
+        return self._encode_value(spec, condition)
+
+    def encode_filter(self, filter: Optional[dict[str, Any]]) -> dict[str, Any]:
+        """Query on the compact documents"""
+        encoded = {}
+        for key, condition in (filter or {}).items():
+            if key in ['$or', '$and', '$nor']:
+                encoded[key] = [self.encode_filter(subfilter) for subfilter in condition]
+            elif key.startswith('$'):
+                encoded[key] = condition
+            elif key in self.derived:
+                raise errors.OperationFailure(f"Field '{key}' cannot be queried with the compact schema.")
+            else:
+                name, spec = self.path(key)
+                encoded[name] = self._encode_condition(spec, condition)
+        return encoded
+
+    def encode_projection(self, projection: Optional[dict[str, Any]]) -> Optional[dict[str, Any]]:
+        """Projection on the compact documents"""
+        if not projection:
+            return projection
+        if isinstance(projection, (list, tuple)):
+            projection = {key: True for key in projection}
+
+        encoded = {}
+        for key, value in projection.items():
+            if key in self.derived:
+                name, dependencies, _ = self.derived[key]
+                encoded[name] = value
+                if value:
+                    for dependency in dependencies:
+                        encoded[self.path(dependency)[0]] = value
+                continue
+            encoded[self.path(key)[0]] = value
+        return encoded
+
+    def encode_sort(self, keys: list[tuple[str, int]]) -> list[tuple[str, int]]:
+        return [(self.path(key)[0], direction) for key, direction in keys]
+
+    def encode_update(self, update: dict[str, Any]) -> dict[str, Any]:
+        """Update operators on the compact documents"""
+        encoded = {}
+        for operator, fields in update.items():
+            encoded[operator] = {}
+            for key, value in fields.items():
+                if key in self.derived:
+                    name, dependencies, compute = self.derived[key]
+                    if operator == '$unset':
+                        encoded[operator][name] = value
+                    elif operator == '$set' and all(dependency in fields for dependency in dependencies) and compute(fields) == value:
+                        # derived from the other fields of the update
+                        encoded.setdefault('$unset', {})[name] = ''
+                    else:
+                        encoded[operator][name] = value
+                    continue
+
+                name, spec = self.path(key)
+                if operator == '$set' and spec is not None and spec.default is not _MISSING and value == spec.default:
+                    encoded.setdefault('$unset', {})[name] = ''
+                elif operator == '$unset':
+                    encoded[operator][name] = value
+                else:
+                    encoded[operator][name] = self._encode_value(spec, value)
+        return {operator: fields for operator, fields in encoded.items() if fields}
+
+    def encode_index(self, keys) -> list[tuple[str, Any]]:
+        if isinstance(keys, str):
+            keys = [(keys, pymongo.ASCENDING)]
+        elif isinstance(keys, dict):
+            keys = list(keys.items())
+        return [(self.path(key)[0], direction) for key, direction in keys]
+
+def _included(projection: Optional[dict[str, Any]]) -> Callable[[str], bool]:
+    """Whether a top level field is returned by a projection"""
+    if not projection:
+        return lambda key: True
+    if isinstance(projection, (list, tuple)):
+        projection = {key: True for key in projection}
+    if any(value for key, value in projection.items() if key != '_id'):
+        return lambda key: bool(projection.get(key)) or any(name.startswith(f'{key}.') for name in projection)
+    return lambda key: projection.get(key, True)
+
+
+def _ordertype(order: dict[str, Any]) -> str:
+    """Type of the last operation of an order, as set by the queue handler"""
+    if order.get('status') == 'deleted':
+        return 'delete'
+    if order.get('nmodified'):
+        return 'modify'
+    return 'new'
+
+
+ORDERID = PaddedId(6)
+ITEMID = PaddedId(4)
+STATUS = Enum(('processing', 'confirmed', 'canceled', 'deleted', 'paid', 'delivered'))
+
+ORDERS = Schema(
+    fields={
+        'id': Field('i', ORDERID),
+        'user': Field('u'),
+        'order': Field('o', fields={
+            'id': Field('i', ITEMID),
+            'quantity': Field('q'),
+        }),
+        'creationtime': Field('c'),
+        'nmodified': Field('n', default=0),
+        'lastmodified': Field('m', default=None),
+        'status': Field('s', STATUS),
+        'laststatuschange': Field('t'),
+    },
+    marker='id',
+    derived={'type': ('y', ('status', 'nmodified'), _ordertype)},
+)
+
+ITEMS = Schema(
+    fields={
+        'id': Field('i', ITEMID),
+        'instock': Field('q'),
+        'limitoutofstock': Field('l'),
+        'unitprice': Field('p'),
+        'last_update': Field('u'),
+        'creation_time': Field('c'),
+        'content': Field('x', fields={
+            'Name': Field('n'),
+            'Style': Field('s'),
+            'Brewery': Field('b'),
+            'Beer Name (Full)': Field('f'),
+            'Description': Field('d'),
+            'ABV': Field('a'),
+            'Min IBU': Field('i0'),
+            'Max IBU': Field('i1'),
+            'Astringency': Field('as'),
+            'Body': Field('bo'),
+            'Alcohol': Field('al'),
+            'Bitter': Field('bi'),
+            'Sweet': Field('sw'),
+            'Sour': Field('so'),
+            'Salty': Field('sa'),
+            'Fruits': Field('fr'),
+            'Hoppy': Field('ho'),
+            'Spices': Field('sp'),
+            'Malty': Field('ma'),
+            'review_aroma': Field('ra'),
+            'review_appearance': Field('rp'),
+            'review_palate': Field('rl'),
+            'review_taste': Field('rt'),
+            'review_overall': Field('ro'),
+            'number_of_reviews': Field('nr'),
+        }),
+    },
+    marker='id',
+)
+
+SCHEMAS = {
+    Storage.ORDERS: ORDERS,
+    Storage.ITEMS: ITEMS,
+}
+
+
+class MappedCollection:
+    """Collection storing documents in compact form, with the interface of a pymongo collection
+
+    Queries, updates and documents use the field names and values of the application. While the
+    collection is being migrated (`legacy`), documents still in the standard form are read as
+    well, and converted to the compact form before they are updated.
+
+    Args:
+        collection: pymongo or memory collection
+        schema: schema of the documents
+        legacy: whether the collection may hold documents in the standard form
+
+    """
+    def __init__(self, collection, schema: Schema, legacy: bool = False):
+        self.collection = collection
+        self.schema = schema
+        self.legacy = legacy
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.collection, name)
+
+    def with_options(self, **kwargs) -> MappedCollection:
+        return MappedCollection(self.collection.with_options(**kwargs), self.schema, self.legacy)
+
+    # filters of the two forms of the documents
+
+    def _compact(self, filter: Optional[dict[str, Any]]) -> dict[str, Any]:
+        filter = self.schema.encode_filter(filter)
+        if self.legacy:
+            return _restrict(filter, self.schema.marker, False)
+        return filter
+
+    def _legacy(self, filter: Optional[dict[str, Any]]) -> dict[str, Any]:
+        return _restrict(filter or {}, self.schema.marker, True)
+
+    def upgrade(self, filter: Optional[dict[str, Any]] = None) -> int:
+        """Convert the documents in standard form matching a query to the compact form
+
+        A document is replaced only if still in standard form, so concurrent upgrades of the same
+        document are safe.
+
+        Returns:
+            number of documents converted
+
+        """
+        if not self.legacy:
+            return 0
+
+        nupgraded = 0
+        for doc in list(self.collection.find(self._legacy(filter))):
+            result = self.collection.replace_one(
+                {'_id': doc['_id'], self.schema.marker: {'$exists': True}},
+                self.schema.encode(doc)
+            )
+            nupgraded += result.modified_count
+        return nupgraded
+
+    # queries
+
+    def find(self, filter: Optional[dict[str, Any]] = None, projection: Optional[dict[str, Any]] = None, *args, **kwargs) -> MappedCursor:
+        return MappedCursor(self, filter or {}, projection, kwargs)
+
+    def find_one(self, filter: Optional[dict[str, Any]] = None, projection: Optional[dict[str, Any]] = None, *args, **kwargs) -> Optional[dict[str, Any]]:
+        for doc in self.find(filter, projection, **kwargs).limit(1):
+            return doc
+        return None
+
+    def count_documents(self, filter: dict[str, Any], **kwargs) -> int:
+        count = self.collection.count_documents(self._compact(filter), **kwargs)
+        if self.legacy:
+            count += self.collection.count_documents(self._legacy(filter), **kwargs)
+        return count
+
+    def distinct(self, key: str, filter: Optional[dict[str, Any]] = None, **kwargs) -> list[Any]:
+        name, spec = self.schema.path(key)
+        values = [self.schema._decode_value(spec, value) for value in self.collection.distinct(name, self._compact(filter), **kwargs)]
+        if self.legacy:
+            values += [value for value in self.collection.distinct(key, self._legacy(filter), **kwargs) if value not in values]
+        return values
+
+    # writes
+
+    def insert_one(self, document: dict[str, Any], **kwargs):
+        encoded = self.schema.encode(document)
+        result = self.collection.insert_one(encoded, **kwargs)
+        document['_id'] = encoded['_id']
+        return result
+
+    def insert_many(self, documents: Iterable[dict[str, Any]], **kwargs):
+        documents = list(documents)
+        encoded = [self.schema.encode(document) for document in documents]
+        result = self.collection.insert_many(encoded, **kwargs)
+        for document, doc in zip(documents, encoded):
+            document['_id'] = doc['_id']
+        return result
+
+    def update_one(self, filter: dict[str, Any], update: dict[str, Any], upsert: bool = False, **kwargs):
+        self.upgrade(filter)
+        return self.collection.update_one(self._compact(filter), self.schema.encode_update(update), upsert=upsert, **kwargs)
+
+    def update_many(self, filter: dict[str, Any], update: dict[str, Any], upsert: bool = False, **kwargs):
+        self.upgrade(filter)
+        return self.collection.update_many(self._compact(filter), self.schema.encode_update(update), upsert=upsert, **kwargs)
+
+    def replace_one(self, filter: dict[str, Any], replacement: dict[str, Any], upsert: bool = False, **kwargs):
+        self.upgrade(filter)
+        return self.collection.replace_one(self._compact(filter), self.schema.encode(replacement), upsert=upsert, **kwargs)
+
+    def find_one_and_update(self, filter: dict[str, Any], update: dict[str, Any], projection: Optional[dict[str, Any]] = None, **kwargs) -> Optional[dict[str, Any]]:
+        self.upgrade(filter)
+        if 'sort' in kwargs and kwargs['sort'] is not None:
+            kwargs['sort'] = self.schema.encode_sort(kwargs['sort'])
+        doc = self.collection.find_one_and_update(
+            self._compact(filter),
+            self.schema.encode_update(update),
+            projection=self.schema.encode_projection(projection),
+            **kwargs
+        )
+        return None if doc is None else self.schema.decode(doc, projection)
+
+    def delete_one(self, filter: dict[str, Any], **kwargs):
+        result = self.collection.delete_one(self._compact(filter), **kwargs)
+        if self.legacy and not result.deleted_count:
+            result = self.collection.delete_one(self._legacy(filter), **kwargs)
+        return result
+
+    def delete_many(self, filter: dict[str, Any], **kwargs):
+        result = self.collection.delete_many(self._compact(filter), **kwargs)
+        if self.legacy:
+            self.collection.delete_many(self._legacy(filter), **kwargs)
+        return result
+
+    def bulk_write(self, requests: Iterable[Any], **kwargs):
+        encoded = []
+        for request in requests:
+            match request:
+                case InsertOne():
+                    encoded.append(InsertOne(self.schema.encode(request._doc)))
+                case UpdateOne() | UpdateMany():
+                    self.upgrade(request._filter)
+                    encoded.append(type(request)(self._compact(request._filter), self.schema.encode_update(request._doc), upsert=bool(request._upsert)))
+                case ReplaceOne():
+                    self.upgrade(request._filter)
+                    encoded.append(ReplaceOne(self._compact(request._filter), self.schema.encode(request._doc), upsert=bool(request._upsert)))
+                case DeleteOne() | DeleteMany():
+                    if self.legacy:
+                        encoded.append(type(request)(self._legacy(request._filter)))
+                    encoded.append(type(request)(self._compact(request._filter)))
+        return self.collection.bulk_write(encoded, **kwargs)
+
+    def create_index(self, keys, **kwargs) -> str:
+        return self.collection.create_index(self.schema.encode_index(keys), **kwargs)
+
+
+def _restrict(filter: dict[str, Any], marker: str, exists: bool) -> dict[str, Any]:
+    """Restrict a query to the documents in standard form (`exists`) or in compact form"""
+    if marker not in filter:
+        return {**filter, marker: {'$exists': exists}}
+    return {'$and': [filter, {marker: {'$exists': exists}}]}
+
+def _sortkey(doc: dict[str, Any], key: str) -> tuple:
+    value = doc
+    for name in key.split('.'):
+        if not isinstance(value, dict) or name not in value:
+            return (False, 0)
+        value = value[name]
+    return (value is not None, value if value is not None else 0)
+
+
+class MappedCursor:
+    """Cursor on a mapped collection, returning documents in the form used by the application"""
+    def __init__(self, collection: MappedCollection, filter: dict[str, Any], projection: Optional[dict[str, Any]], kwargs: dict[str, Any]):
+        self.collection = collection
+        self.filter = filter
+        self.projection = projection
+        self.kwargs = kwargs
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+        self._batchsize = None
+        self._results = None
+
+    def sort(self, key, direction: int = pymongo.ASCENDING) -> MappedCursor:
+        self._sort = [(key, direction)] if isinstance(key, str) else list(key)
+        return self
+
+    def skip(self, skip: int) -> MappedCursor:
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int) -> MappedCursor:
+        self._limit = limit
+        return self
+
+    def batch_size(self, batchsize: int) -> MappedCursor:
+        self._batchsize = batchsize
+        return self
+
+    def close(self):
+        self._results = iter(())
+
+    def _cursor(self, filter: dict[str, Any], projection: Optional[dict[str, Any]], sort: list[tuple[str, int]], skip: int, limit: int):
+        cursor = self.collection.collection.find(filter, projection, **self.kwargs)
+        if sort:
+            cursor = cursor.sort(sort)
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        if self._batchsize is not None:
+            cursor = cursor.batch_size(self._batchsize)
+        return cursor
+
+    def _iterate(self) -> Iterator[dict[str, Any]]:
+        schema = self.collection.schema
+        compact = (
+            schema.decode(doc, self.projection)
+            for doc in self._cursor(
+                self.collection._compact(self.filter),
+                schema.encode_projection(self.projection),
+                schema.encode_sort(self._sort),
+                0 if self.collection.legacy else self._skip,
+                self._skip + self._limit if self.collection.legacy and self._limit else self._limit
+            )
+        )
+        if not self.collection.legacy:
+            return compact
+
+        # merge the documents of the two forms, respecting sort, skip and limit
+        legacy = self._cursor(
+            self.collection._legacy(self.filter),
+            self.projection,
+            self._sort,
+            0,
+            self._skip + self._limit if self._limit else 0
+        )
+        if not self._sort:
+            docs = chain(compact, legacy)
+        elif len({direction for _, direction in self._sort}) == 1:
+            docs = heapq.merge(
+                compact,
+                legacy,
+                key=lambda doc: tuple(_sortkey(doc, key) for key, _ in self._sort),
+                reverse=self._sort[0][1] == pymongo.DESCENDING
+            )
+        else:
+            docs = list(chain(compact, legacy))
+            for key, direction in reversed(self._sort):
+                docs.sort(key=lambda doc: _sortkey(doc, key), reverse=direction == pymongo.DESCENDING)
+        return islice(docs, self._skip, self._skip + self._limit if self._limit else None)
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        if self._results is None:
+            self._results = self._iterate()
+        return self._results
+
+    def next(self) -> dict[str, Any]:
+        return next(iter(self))
+
+    __next__ = next
+
+
+class MappedStorage(Storage):
+    """Storage keeping orders and items in compact form
+
+    Args:
+        storage: storage holding the documents
+        legacy: whether orders and items may still hold documents in the standard form
+
+    """
+    def __init__(self, storage: Storage, legacy: bool = False):
+        self.storage = storage
+        self.legacy = legacy
+
+    def __getitem__(self, name: str):
+        collection = self.storage[name]
+        schema = SCHEMAS.get(name)
+        if schema is None:
+            return collection
+        return MappedCollection(collection, schema, self.legacy)
+
+    def create_queue(self, nmax: int, size: int):
+        self.storage.create_queue(nmax, size)
+
+    def with_read_preference(self, readpreference) -> MappedStorage:
+        return MappedStorage(self.storage.with_read_preference(readpreference), self.legacy)
+
+
+def migrate(storage: Storage, name: str, batchsize: int = 500) -> int:
+    """Convert the documents of a collection from the standard to the compact form
+
+    Documents are converted in batches while the application is running, with the schema set to
+    'migrating'. Each document is replaced only if still in the standard form, so documents
+    converted meanwhile by the application are left untouched.
+
+    Args:
+        storage: storage holding the documents, without mapping
+        name: name of the collection
+        batchsize: number of documents converted at once
+
+    Returns:
+        number of documents converted
+
+    """
+    schema = SCHEMAS[name]
+    collection = storage[name]
+
+    nmigrated = 0
+    while True:
+        docs = list(collection.find({schema.marker: {'$exists': True}}).limit(batchsize))
+        if not docs:
+            break
+
+        result = collection.bulk_write(
+            [
+                ReplaceOne({'_id': doc['_id'], schema.marker: {'$exists': True}}, schema.encode(doc))
+                for doc in docs
+            ],
+            ordered=False
+        )
+        nmigrated += result.modified_count
+        logger.info(f'{nmigrated} documents of {name} migrated.')
+
+    return nmigrated
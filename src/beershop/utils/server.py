@@ -0,0 +1,56 @@
+from __future__ import annotations
+from gunicorn.app.base import BaseApplication
+import logging
+logger = logging.getLogger()
+
+from beershop import create_app
+from beershop.utils.config import Config
+from beershop.utils.db import reset_client
+
+
+def post_fork(server, worker):
+    """Gunicorn hook executed in every worker right after fork
+
+    The MongoClient must be opened only after fork, so any client inherited from the master is
+    discarded.
+
+    """
+    reset_client()
+    logger.info(f'Worker {worker.pid} started.')
+
+
+class BeershopServer(BaseApplication):
+    """Prefork multi-worker, multi-threaded WSGI server for the Beershop application
+
+    Every worker runs a pool of threads (gunicorn 'gthread' worker class). The application is
+    created inside each worker, so no database connection is shared across processes.
+
+    Args:
+        config: configuration data of the application
+
+    """
+    def __init__(self, config: Config):
+        self.config_data = config
+        super().__init__()
+
+    def load_config(self):
+        server = self.config_data.server
+
+        options = {
+            'bind': f"{server['host']}:{server['port']}",
+            'workers': int(server['workers']),
+            'threads': int(server['threads']),
+            'worker_class': 'gthread',
+            'keepalive': int(server['keepalive']),
+            'max_requests': int(server['maxrequests']),
+            'max_requests_jitter': int(server['maxrequestsjitter']),
+            'timeout': int(server['timeout']),
+            'preload_app': False,
+            'post_fork': post_fork,
+        }
+
+        for key, value in options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return create_app(self.config_data)
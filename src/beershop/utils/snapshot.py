@@ -0,0 +1,221 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Optional, Any, Iterable, Iterator
+import bson
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import logging
+logger = logging.getLogger()
+
+from beershop.utils.storage import Storage
+from beershop.utils.catalog import catalog_version, summarize
+
+
+# layout of the snapshot file:
+# - header: magic, layout version, catalog version, number of items, number of styles
+# - styles: length and utf-8 bytes of every style
+# - index: id, offset and length of the document, style and unit price of every item, sorted by id
+# - documents: items without stock, encoded in BSON
+_MAGIC = b'BSNP'
+_LAYOUT = 1
+_HEADER = struct.Struct('<4sHQII')
+_LENGTH = struct.Struct('<H')
+_RECORD = struct.Struct('<16sIIHd')
+_NOSTYLE = 0xFFFF
+
+# fields changed by the orders, always read from the database
+LIVE = ['id', 'instock']
+
+
+def write_snapshot(path: str, version: int, items: Iterable[dict[str, Any]]):
+    """Write a snapshot of the catalog, replacing the existing file atomically
+
+    Args:
+        path: path of the snapshot file
+        version: version of the catalog
+        items: items of the catalog
+
+    """
+    styles = {}
+    records = []
+    documents = []
+    offset = 0
+    for item in sorted(items, key=lambda item: item['id']):
+        iditem = item['id'].encode('utf-8')
+        if len(iditem) > 16:
+            raise ValueError(f"Item id {item['id']} longer than 16 bytes.")
+
+        style = item.get('content', {}).get('Style')
+        if style is not None:
+            style = styles.setdefault(style, len(styles))
+        unitprice = item.get('unitprice')
+
+        document = bson.encode({key: value for key, value in item.items() if key not in LIVE and key != '_id'})
+        records.append(_RECORD.pack(
+            iditem,
+            offset,
+            len(document),
+            _NOSTYLE if style is None else style,
+            math.nan if unitprice is None else float(unitprice)
+        ))
+        documents.append(document)
+        offset += len(document)
+
+    # write to a file of this process, then move it on the snapshot read by the other workers
+    temporary = f'{path}.{os.getpid()}.{threading.get_ident()}'
+    with open(temporary, 'wb') as fid:
+        fid.write(_HEADER.pack(_MAGIC, _LAYOUT, version, len(records), len(styles)))
+        for style in styles:
+            encoded = style.encode('utf-8')
+            fid.write(_LENGTH.pack(len(encoded)))
+            fid.write(encoded)
+        fid.writelines(records)
+        fid.writelines(documents)
+        fid.flush()
+        os.fsync(fid.fileno())
+    os.replace(temporary, path)
+
+
+class CatalogSnapshot:
+    """Catalog read from a snapshot file mapped in memory
+
+    The file is mapped read-only, so its pages are shared by all the processes mapping it.
+    Documents are decoded only when requested.
+
+    Args:
+        path: path of the snapshot file
+
+    """
+    def __init__(self, path: str):
+        with open(path, 'rb') as fid:
+            self.inode = os.fstat(fid.fileno()).st_ino
+            self._mmap = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, layout, self.version, self._nitems, nstyles = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC or layout != _LAYOUT:
+            raise ValueError(f'{path} is not a catalog snapshot of layout {_LAYOUT}.')
+
+        position = _HEADER.size
+        self.styles = []
+        for _ in range(nstyles):
+            length, = _LENGTH.unpack_from(self._mmap, position)
+            position += _LENGTH.size
+            self.styles.append(self._mmap[position:position + length].decode('utf-8'))
+            position += length
+        self._index = position
+        self._documents = position + self._nitems * _RECORD.size
+        self._facets = {}
+
+    def __len__(self) -> int:
+        return self._nitems
+
+    def _record(self, position: int) -> tuple[bytes, int, int, int, float]:
+        return _RECORD.unpack_from(self._mmap, self._index + position * _RECORD.size)
+
+    def _decode(self, record: tuple[bytes, int, int, int, float]) -> dict[str, Any]:
+        _, offset, length, _, _ = record
+        start = self._documents + offset
+        return bson.decode(self._mmap[start:start + length])
+
+    def get(self, iditem: str) -> Optional[dict[str, Any]]:
+        """Item without stock, None if the item is not in the snapshot"""
+        key = iditem.encode('utf-8').ljust(16, b'\x00')
+        low, high = 0, self._nitems
+        while low < high:
+            middle = (low + high) // 2
+            record = self._record(middle)
+            if record[0] < key:
+                low = middle + 1
+            elif record[0] > key:
+                high = middle
+            else:
+                return {'id': iditem, **self._decode(record)}
+        return None
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        for position in range(self._nitems):
+            record = self._record(position)
+            yield {'id': record[0].rstrip(b'\x00').decode('utf-8'), **self._decode(record)}
+
+    def join(self, docs: list[dict[str, Any]], collection_items) -> list[dict[str, Any]]:
+        """Complete the live fields of items with the rest of the item from the snapshot
+
+        Items missing from the snapshot are read from the collection of the items.
+
+        """
+        joined = []
+        for doc in docs:
+            item = self.get(doc['id'])
+            if item is None:
+                item = collection_items.find_one({'id': doc['id']}, {'_id': False, 'lastbatch': False}) or {}
+            joined.append({**item, **doc})
+        return joined
+
+    def facets(self, bins: int) -> dict[str, Any]:
+        """Facets of the catalog, computed from the index without decoding the documents"""
+        facets = self._facets.get(bins)
+        if facets is None:
+            values = []
+            for position in range(self._nitems):
+                _, _, _, style, unitprice = self._record(position)
+                values.append((
+                    None if style == _NOSTYLE else self.styles[style],
+                    None if math.isnan(unitprice) else unitprice
+                ))
+            facets = {'version': self.version, **summarize(values, bins)}
+            self._facets[bins] = facets
+        return facets
+
+
+@dataclass
+class SnapshotStore:
+    """Snapshot of the catalog shared by the workers of a server through a file
+
+    Every `refresh` seconds, a worker compares the snapshot it maps with the catalog version. When
+    the catalog changed, it maps the snapshot written by another worker if it is up to date, or it
+    writes a new one.
+
+    Args:
+        path: path of the snapshot file
+        refresh: time in seconds between the checks of the catalog version
+
+    """
+    path: str
+    refresh: float = 1
+    snapshot: Optional[CatalogSnapshot] = None
+    _checked: float = field(init=False, repr=False, default=-math.inf)
+    _lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def get(self, storage: Storage) -> CatalogSnapshot:
+        if self.snapshot is not None and time.monotonic() - self._checked < self.refresh:
+            return self.snapshot
+
+        with self._lock:
+            if self.snapshot is not None and time.monotonic() - self._checked < self.refresh:
+                return self.snapshot
+
+            version = catalog_version(storage)
+            snapshot = self.snapshot
+            if snapshot is None or snapshot.version != version:
+                snapshot = self._open()
+            if snapshot is None or snapshot.version != version:
+                write_snapshot(self.path, version, storage.items.find({}, {'_id': False, 'lastbatch': False}))
+                snapshot = self._open()
+                logger.info(f'Snapshot of version {version} of the catalog written to {self.path}.')
+
+            self.snapshot = snapshot
+            self._checked = time.monotonic()
+            return snapshot
+
+    def _open(self) -> Optional[CatalogSnapshot]:
+        """Map the current snapshot file, None if it does not exist or it is not readable"""
+        try:
+            if self.snapshot is not None and os.stat(self.path).st_ino == self.snapshot.inode:
+                return self.snapshot
+            return CatalogSnapshot(self.path)
+        except (OSError, ValueError, struct.error):
+            return None
@@ -0,0 +1,718 @@
+from __future__ import annotations
+from typing import Optional, Any, Iterable, Iterator
+from datetime import datetime, timezone
+from bisect import bisect_left, bisect_right, insort
+from bson import ObjectId
+from pymongo import errors, results, CursorType
+from pymongo.operations import InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+import pymongo
+import itertools
+import threading
+import time
+import re
+import logging
+logger = logging.getLogger()
+
+
+class Storage:
+    """Base class of the storage backends
+
+    A storage gives access to the collections of the application by name, with the same interface
+    of a pymongo collection. The collections of items, orders and the order queue are available
+    also as attributes.
+
+    """
+    ITEMS = 'items'
+    ORDERS = 'orders'
+    QUEUE = 'orderqueue'
+    DEADLETTER = 'orderdeadletter'
+    CATALOG = 'catalog'
+    LEASES = 'leases'
+    VELOCITY = 'itemvelocity'
+
+    def __getitem__(self, name: str):
+        raise NotImplementedError
+
+    @property
+    def items(self):
+        return self[self.ITEMS]
+
+    @property
+    def orders(self):
+        return self[self.ORDERS]
+
+    @property
+    def queue(self):
+        return self[self.QUEUE]
+
+    @property
+    def deadletter(self):
+        return self[self.DEADLETTER]
+
+    def create_queue(self, nmax: int, size: int):
+        """Create the order queue as a capped collection, dropping the existing one"""
+        raise NotImplementedError
+
+    def with_read_preference(self, readpreference: pymongo.read_preferences._ServerMode) -> Storage:
+        """Storage reading with a different read preference"""
+        return self
+
+
+class MongoStorage(Storage):
+    """Storage on a MongoDB database
+
+    Args:
+        database: pymongo database
+
+    """
+    def __init__(self, database: pymongo.database.Database):
+        self.database = database
+
+    def __getitem__(self, name: str) -> pymongo.collection.Collection:
+        return self.database[name]
+
+    def with_read_preference(self, readpreference: pymongo.read_preferences._ServerMode) -> MongoStorage:
+        return MongoStorage(self.database.with_options(read_preference=readpreference))
+
+    def create_queue(self, nmax: int, size: int):
+        self.database[self.QUEUE].drop()
+        pymongo.collection.Collection(
+            self.database,
+            self.QUEUE,
+            capped=True,
+            max=nmax,
+            size=size
+        )
+
+
+class MemoryStorage(Storage):
+    """In-process storage
+
+    Collections are kept in memory and indexed on the item id, on the order id and user, and on
+    the creation time of orders and queued orders. Data lives as long as the process, so the
+    queue handler must run in the same process of the API.
+
+    """
+    _INDEXES = {
+        Storage.ITEMS: {'hash': [('id',)], 'sorted': []},
+        Storage.ORDERS: {'hash': [('id', 'user')], 'sorted': ['creationtime', 'id']},
+        Storage.QUEUE: {'hash': [], 'sorted': ['creationtime']},
+        Storage.VELOCITY: {'hash': [('item', 'minute'), ('item',)], 'sorted': []},
+    }
+
+    def __init__(self):
+        self.collections = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        with self._lock:
+            if name not in self.collections:
+                indexes = self._INDEXES.get(name, {'hash': [], 'sorted': []})
+                self.collections[name] = MemoryCollection(name, indexes['hash'], indexes['sorted'])
+            return self.collections[name]
+
+    def create_queue(self, nmax: int, size: int):
+        with self._lock:
+            indexes = self._INDEXES[self.QUEUE]
+            self.collections[self.QUEUE] = MemoryCollection(self.QUEUE, indexes['hash'], indexes['sorted'], capped=nmax)
+
+
+def _normalize(value: Any) -> Any:
+    """Store datetimes as naive utc, as MongoDB does"""
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _copy(value: Any) -> Any:
+    """Copy documents, normalizing datetimes"""
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return _normalize(value)
+
+def _get(doc: dict[str, Any], path: str) -> Any:
+    """Get a value following a dotted path. Returns `_MISSING` if the path does not exist"""
+    value = doc
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return _MISSING
+        value = value[key]
+    return value
+
+def _set(doc: dict[str, Any], path: str, value: Any):
+    """Set a value following a dotted path"""
+    keys = path.split('.')
+    for key in keys[:-1]:
+        doc = doc.setdefault(key, {})
+    doc[keys[-1]] = value
+
+_MISSING = object()
+
+def _compare(value: Any, operator: str, operand: Any) -> bool:
+    """Evaluate a comparison operator"""
+    if value is _MISSING or value is None or operand is None:
+        return False
+    try:
+        match operator:
+            case '$gt':
+                return value > operand
+            case '$gte':
+                return value >= operand
+            case '$lt':
+                return value < operand
+            case '$lte':
+                return value <= operand
+    except TypeError:
+        return False
+
+def _match_condition(value: Any, condition: Any) -> bool:
+    """Whether a value satisfies a condition of a query"""
+    if not isinstance(condition, dict) or not any(key.startswith('$') for key in condition):
+        if isinstance(value, list) and not isinstance(condition, list):
+            return _normalize(condition) in value
+        return (None if value is _MISSING else value) == _normalize(condition)
+
+    for operator, operand in condition.items():
+        operand = _copy(operand)
+        match operator:
+            case '$eq':
+                matched = _match_condition(value, operand)
+            case '$ne':
+                matched = not _match_condition(value, operand)
+            case '$in':
+                matched = any(_match_condition(value, item) for item in operand)
+            case '$nin':
+                matched = not any(_match_condition(value, item) for item in operand)
+            case '$exists':
+                matched = (value is not _MISSING) == bool(operand)
+            case '$gt' | '$gte' | '$lt' | '$lte':
+                matched = _compare(value, operator, operand)
+            case _:
+                raise errors.OperationFailure(f'unknown operator: {operator}')
+        if not matched:
+            return False
+    return True
+
+
+class MemoryCollection:
+    """In-memory collection with the subset of the pymongo collection interface used by the application
+
+    Args:
+        name: name of the collection
+        hashindexes: fields of the indexes used for equality queries
+        sortedindexes: fields of the indexes used for range queries and sorting
+        capped: maximum number of documents. Older documents are removed when exceeded.
+
+    """
+    def __init__(
+        self,
+        name: str,
+        hashindexes: Iterable[tuple[str, ...]] = (),
+        sortedindexes: Iterable[str] = (),
+        capped: Optional[int] = None
+    ):
+        self.name = name
+        self.capped = capped
+        self._docs = {}
+        self._ids = {}
+        self._rowids = itertools.count()
+        self._lastrowid = -1
+        self._hash = {fields: {} for fields in hashindexes}
+        self._unique = set()
+        self._sorted = {field: [] for field in sortedindexes}
+        self._text = []
+        self._lock = threading.RLock()
+        self._newdocs = threading.Condition(self._lock)
+
+    # indexes
+
+    def _index(self, rowid: int, doc: dict[str, Any]):
+        for fields, index in self._hash.items():
+            key = tuple(_get(doc, field) for field in fields)
+            if fields in self._unique and index.get(key):
+                raise errors.DuplicateKeyError(f'E11000 duplicate key error collection: {self.name} index: {fields} dup key: {key}')
+            index.setdefault(key, set()).add(rowid)
+        for field, index in self._sorted.items():
+            value = _get(doc, field)
+            if value is not _MISSING and value is not None:
+                insort(index, (value, rowid))
+
+    def _unindex(self, rowid: int, doc: dict[str, Any]):
+        for fields, index in self._hash.items():
+            key = tuple(_get(doc, field) for field in fields)
+            rowids = index.get(key)
+            if rowids is not None:
+                rowids.discard(rowid)
+                if not rowids:
+                    del index[key]
+        for field, index in self._sorted.items():
+            value = _get(doc, field)
+            if value is not _MISSING and value is not None:
+                position = bisect_left(index, (value, rowid))
+                if position < len(index) and index[position] == (value, rowid):
+                    del index[position]
+
+    def create_index(self, keys, unique: bool = False, **kwargs) -> str:
+        """Create an index. Text indexes enable '$text' queries, other options are ignored"""
+        if isinstance(keys, str):
+            keys = [(keys, pymongo.ASCENDING)]
+        elif isinstance(keys, dict):
+            keys = list(keys.items())
+
+        with self._lock:
+            if any(direction == 'text' for _, direction in keys):
+                self._text = [field for field, direction in keys if direction == 'text']
+                return '_'.join(f'{field}_text' for field in self._text)
+
+            fields = tuple(field for field, _ in keys)
+            if len(fields) == 1 and not unique:
+                if fields[0] not in self._sorted:
+                    index = []
+                    for rowid, doc in self._docs.items():
+                        value = _get(doc, fields[0])
+                        if value is not _MISSING and value is not None:
+                            index.append((value, rowid))
+                    self._sorted[fields[0]] = sorted(index)
+            else:
+                if fields not in self._hash:
+                    self._hash[fields] = {}
+                    for rowid, doc in self._docs.items():
+                        self._hash[fields].setdefault(tuple(_get(doc, field) for field in fields), set()).add(rowid)
+                if unique:
+                    self._unique.add(fields)
+
+        return '_'.join(f'{field}_{direction}' for field, direction in keys)
+
+    def drop(self):
+        with self._lock:
+            self._docs.clear()
+            self._ids.clear()
+            for index in self._hash.values():
+                index.clear()
+            for index in self._sorted.values():
+                index.clear()
+            self._text = []
+
+    # queries
+
+    def _candidates(self, filter: dict[str, Any]) -> Iterable[int]:
+        """Row ids that may match a query, using an index when possible"""
+        for fields, index in self._hash.items():
+            conditions = [filter.get(field, _MISSING) for field in fields]
+            if all(condition is not _MISSING and not isinstance(condition, dict) for condition in conditions):
+                return sorted(index.get(tuple(_normalize(condition) for condition in conditions), ()))
+            if len(fields) == 1 and isinstance(conditions[0], dict) and list(conditions[0]) == ['$in']:
+                rowids = set()
+                for value in conditions[0]['$in']:
+                    rowids |= index.get((_normalize(value),), set())
+                return sorted(rowids)
+
+        if '_id' in filter and not isinstance(filter['_id'], dict):
+            rowid = self._ids.get(filter['_id'])
+            return [] if rowid is None else [rowid]
+
+        for field, index in self._sorted.items():
+            condition = filter.get(field)
+            if isinstance(condition, dict) and condition and set(condition) <= {'$gt', '$gte', '$lt', '$lte'}:
+                start, end = 0, len(index)
+                for operator, operand in condition.items():
+                    operand = _normalize(operand)
+                    try:
+                        match operator:
+                            case '$gt':
+                                start = max(start, bisect_right(index, (operand, float('inf'))))
+                            case '$gte':
+                                start = max(start, bisect_left(index, (operand, -1)))
+                            case '$lt':
+                                end = min(end, bisect_left(index, (operand, -1)))
+                            case '$lte':
+                                end = min(end, bisect_right(index, (operand, float('inf'))))
+                    except TypeError:
+                        return []
+                return sorted(rowid for _, rowid in index[start:end])
+
+        return list(self._docs)
+
+    def _match(self, doc: dict[str, Any], filter: dict[str, Any]) -> bool:
+        """Whether a document matches a query"""
+        for key, condition in filter.items():
+            match key:
+                case '$or':
+                    if not any(self._match(doc, subfilter) for subfilter in condition):
+                        return False
+                case '$and':
+                    if not all(self._match(doc, subfilter) for subfilter in condition):
+                        return False
+                case '$text':
+                    if not self._text:
+                        raise errors.OperationFailure('text index required for $text query')
+                    words = condition['$search'].lower().split()
+                    text = ' '.join(str(_get(doc, field)) for field in self._text).lower()
+                    if not any(re.search(rf'\b{re.escape(word)}\b', text) for word in words):
+                        return False
+                case _:
+                    if not _match_condition(_get(doc, key), condition):
+                        return False
+        return True
+
+    def _find(self, filter: Optional[dict[str, Any]]) -> list[int]:
+        """Row ids of the documents matching a query, in insertion order"""
+        filter = filter or {}
+        with self._lock:
+            return [
+                rowid for rowid in self._candidates(filter)
+                if rowid in self._docs and self._match(self._docs[rowid], filter)
+            ]
+
+    def find(self, filter: Optional[dict[str, Any]] = None, projection: Optional[dict[str, Any]] = None, cursor_type: int = CursorType.NON_TAILABLE, **kwargs) -> MemoryCursor:
+        return MemoryCursor(self, filter or {}, projection, tailable=cursor_type != CursorType.NON_TAILABLE)
+
+    def find_one(self, filter: Optional[dict[str, Any]] = None, projection: Optional[dict[str, Any]] = None, **kwargs) -> Optional[dict[str, Any]]:
+        for doc in self.find(filter, projection).limit(1):
+            return doc
+        return None
+
+    def count_documents(self, filter: dict[str, Any], **kwargs) -> int:
+        return len(self._find(filter))
+
+    def estimated_document_count(self, **kwargs) -> int:
+        return len(self._docs)
+
+    def distinct(self, key: str, filter: Optional[dict[str, Any]] = None, **kwargs) -> list[Any]:
+        values = []
+        with self._lock:
+            for rowid in self._find(filter):
+                value = _get(self._docs[rowid], key)
+                if value is not _MISSING and value not in values:
+                    values.append(value)
+        return values
+
+    # writes
+
+    def _insert(self, doc: dict[str, Any]) -> Any:
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        if doc['_id'] in self._ids:
+            raise errors.DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_ dup key: {doc['_id']}")
+
+        stored = _copy(doc)
+        rowid = next(self._rowids)
+        self._lastrowid = rowid
+        self._index(rowid, stored)
+        self._docs[rowid] = stored
+        self._ids[stored['_id']] = rowid
+
+        # remove oldest documents of capped collections
+        if self.capped is not None:
+            while len(self._docs) > self.capped:
+                oldest = next(iter(self._docs))
+                self._delete(oldest)
+
+        self._newdocs.notify_all()
+        return doc['_id']
+
+    def _delete(self, rowid: int):
+        doc = self._docs.pop(rowid)
+        self._unindex(rowid, doc)
+        del self._ids[doc['_id']]
+
+    def _apply(self, doc: dict[str, Any], update: dict[str, Any], inserting: bool = False):
+        """Apply update operators to a document"""
+        for operator, fields in update.items():
+            for path, value in fields.items():
+                value = _copy(value)
+                match operator:
+                    case '$set':
+                        _set(doc, path, value)
+                    case '$setOnInsert':
+                        if inserting:
+                            _set(doc, path, value)
+                    case '$unset':
+                        keys = path.split('.')
+                        parent = _get(doc, '.'.join(keys[:-1])) if len(keys) > 1 else doc
+                        if isinstance(parent, dict):
+                            parent.pop(keys[-1], None)
+                    case '$inc':
+                        current = _get(doc, path)
+                        _set(doc, path, (0 if current is _MISSING else current) + value)
+                    case '$max' | '$min':
+                        current = _get(doc, path)
+                        if current is _MISSING or (value > current if operator == '$max' else value < current):
+                            _set(doc, path, value)
+                    case _:
+                        raise errors.OperationFailure(f'unknown update operator: {operator}')
+
+    def _update(self, filter: dict[str, Any], update: dict[str, Any], upsert: bool, many: bool) -> results.UpdateResult:
+        with self._lock:
+            rowids = self._find(filter)
+            if not many:
+                rowids = rowids[:1]
+
+            nmodified = 0
+            for rowid in rowids:
+                doc = self._docs[rowid]
+                updated = _copy(doc)
+                self._apply(updated, update)
+                if updated != doc:
+                    self._unindex(rowid, doc)
+                    try:
+                        self._index(rowid, updated)
+                    except errors.DuplicateKeyError:
+                        self._index(rowid, doc)
+                        raise
+                    self._docs[rowid] = updated
+                    nmodified += 1
+
+            upserted = None
+            if not rowids and upsert:
+                doc = {
+                    key: value for key, value in filter.items()
+                    if not key.startswith('$') and not isinstance(value, dict)
+                }
+                self._apply(doc, update, inserting=True)
+                upserted = self._insert(doc)
+
+        raw = {'n': len(rowids) or int(upserted is not None), 'nModified': nmodified}
+        if upserted is not None:
+            raw['upserted'] = upserted
+        return results.UpdateResult(raw, True)
+
+    def insert_one(self, document: dict[str, Any], **kwargs) -> results.InsertOneResult:
+        with self._lock:
+            return results.InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents: Iterable[dict[str, Any]], ordered: bool = True, **kwargs) -> results.InsertManyResult:
+        # like MongoDB, failing documents are reported by index, and an ordered insert stops at the first one
+        with self._lock:
+            ids = []
+            writeerrors = []
+            for index, document in enumerate(documents):
+                try:
+                    ids.append(self._insert(document))
+                except errors.DuplicateKeyError as err:
+                    writeerrors.append({'index': index, 'code': 11000, 'errmsg': str(err), 'op': document})
+                    if ordered:
+                        break
+            if writeerrors:
+                raise errors.BulkWriteError({
+                    'writeErrors': writeerrors, 'writeConcernErrors': [], 'nInserted': len(ids),
+                    'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []
+                })
+            return results.InsertManyResult(ids, True)
+
+    def update_one(self, filter: dict[str, Any], update: dict[str, Any], upsert: bool = False, **kwargs) -> results.UpdateResult:
+        return self._update(filter, update, upsert, many=False)
+
+    def update_many(self, filter: dict[str, Any], update: dict[str, Any], upsert: bool = False, **kwargs) -> results.UpdateResult:
+        return self._update(filter, update, upsert, many=True)
+
+    def replace_one(self, filter: dict[str, Any], replacement: dict[str, Any], upsert: bool = False, **kwargs) -> results.UpdateResult:
+        with self._lock:
+            rowids = self._find(filter)[:1]
+            if rowids:
+                rowid = rowids[0]
+                doc = self._docs[rowid]
+                replacement = _copy(replacement)
+                replacement['_id'] = doc['_id']
+                self._unindex(rowid, doc)
+                self._index(rowid, replacement)
+                self._docs[rowid] = replacement
+                return results.UpdateResult({'n': 1, 'nModified': int(replacement != doc)}, True)
+            if upsert:
+                upserted = self._insert({**replacement})
+                return results.UpdateResult({'n': 1, 'nModified': 0, 'upserted': upserted}, True)
+        return results.UpdateResult({'n': 0, 'nModified': 0}, True)
+
+    def find_one_and_update(
+        self,
+        filter: dict[str, Any],
+        update: dict[str, Any],
+        projection: Optional[dict[str, Any]] = None,
+        upsert: bool = False,
+        return_document: bool = pymongo.ReturnDocument.BEFORE,
+        **kwargs
+    ) -> Optional[dict[str, Any]]:
+        with self._lock:
+            rowids = self._find(filter)[:1]
+            before = self._docs[rowids[0]] if rowids else None
+            result = self._update(filter, update, upsert, many=False)
+            if return_document == pymongo.ReturnDocument.BEFORE:
+                doc = before
+            elif rowids:
+                doc = self._docs[rowids[0]]
+            elif result.upserted_id is not None:
+                doc = self._docs[self._ids[result.upserted_id]]
+            else:
+                doc = None
+            return None if doc is None else _project(doc, projection)
+
+    def delete_one(self, filter: dict[str, Any], **kwargs) -> results.DeleteResult:
+        with self._lock:
+            rowids = self._find(filter)[:1]
+            for rowid in rowids:
+                self._delete(rowid)
+        return results.DeleteResult({'n': len(rowids)}, True)
+
+    def delete_many(self, filter: dict[str, Any], **kwargs) -> results.DeleteResult:
+        with self._lock:
+            rowids = self._find(filter)
+            for rowid in rowids:
+                self._delete(rowid)
+        return results.DeleteResult({'n': len(rowids)}, True)
+
+    def bulk_write(self, requests: Iterable[Any], ordered: bool = True, **kwargs) -> results.BulkWriteResult:
+        raw = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        with self._lock:
+            for index, request in enumerate(requests):
+                match request:
+                    case InsertOne():
+                        self.insert_one(request._doc)
+                        raw['nInserted'] += 1
+                    case UpdateOne() | UpdateMany() | ReplaceOne():
+                        if isinstance(request, ReplaceOne):
+                            result = self.replace_one(request._filter, request._doc, upsert=bool(request._upsert))
+                        else:
+                            result = self._update(request._filter, request._doc, bool(request._upsert), many=isinstance(request, UpdateMany))
+                        if result.upserted_id is not None:
+                            raw['nUpserted'] += 1
+                            raw['upserted'].append({'index': index, '_id': result.upserted_id})
+                        else:
+                            raw['nMatched'] += result.matched_count
+                        raw['nModified'] += result.modified_count
+                    case DeleteOne():
+                        raw['nRemoved'] += self.delete_one(request._filter).deleted_count
+                    case DeleteMany():
+                        raw['nRemoved'] += self.delete_many(request._filter).deleted_count
+        return results.BulkWriteResult(raw, True)
+
+    def with_options(self, **kwargs) -> MemoryCollection:
+        """Options like read preference and write concern have no meaning in memory"""
+        return self
+
+
+def _sortkey(doc: dict[str, Any], field: str) -> tuple:
+    """Sort key of a document. Missing values come first, as in MongoDB"""
+    value = _get(doc, field)
+    if value is _MISSING or value is None:
+        return (False, 0)
+    return (True, value)
+
+def _project(doc: dict[str, Any], projection: Optional[dict[str, Any]]) -> dict[str, Any]:
+    """Apply a projection to a copy of the document"""
+    if not projection:
+        return _copy(doc)
+
+    included = [key for key, value in projection.items() if value and key != '_id']
+    if included:
+        projected = {}
+        if projection.get('_id', True) and '_id' in doc:
+            projected['_id'] = doc['_id']
+        for key in included:
+            value = _get(doc, key)
+            if value is not _MISSING:
+                _set(projected, key, _copy(value))
+        return projected
+
+    return {key: _copy(value) for key, value in doc.items() if projection.get(key, True)}
+
+
+class MemoryCursor:
+    """Cursor on a memory collection. Supports tailable cursors on capped collections"""
+    def __init__(self, collection: MemoryCollection, filter: dict[str, Any], projection: Optional[dict[str, Any]], tailable: bool = False):
+        self.collection = collection
+        self.filter = filter
+        self.projection = projection
+        self.tailable = tailable
+        self.alive = True
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+        self._awaittime = 1.0
+        self._results = None
+        self._lastrowid = -1
+
+    def sort(self, key, direction: int = pymongo.ASCENDING) -> MemoryCursor:
+        self._sort = [(key, direction)] if isinstance(key, str) else list(key)
+        return self
+
+    def skip(self, skip: int) -> MemoryCursor:
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int) -> MemoryCursor:
+        self._limit = limit
+        return self
+
+    def batch_size(self, batchsize: int) -> MemoryCursor:
+        return self
+
+    def max_await_time_ms(self, awaittime: int) -> MemoryCursor:
+        self._awaittime = awaittime / 1000
+        return self
+
+    def close(self):
+        self.alive = False
+
+    def _sorted(self) -> list[dict[str, Any]]:
+        collection = self.collection
+        with collection._lock:
+            # walk a sorted index when sorting all the documents on an indexed field
+            if not self.filter and len(self._sort) == 1 and self._sort[0][0] in collection._sorted:
+                field, direction = self._sort[0]
+                index = collection._sorted[field]
+                if len(index) == len(collection._docs):
+                    rowids = [rowid for _, rowid in (reversed(index) if direction == pymongo.DESCENDING else index)]
+                    end = self._skip + self._limit if self._limit else None
+                    return [collection._docs[rowid] for rowid in rowids[self._skip:end]]
+
+            docs = [collection._docs[rowid] for rowid in collection._find(self.filter)]
+
+        for field, direction in reversed(self._sort):
+            docs.sort(key=lambda doc: _sortkey(doc, field), reverse=direction == pymongo.DESCENDING)
+        end = self._skip + self._limit if self._limit else None
+        return docs[self._skip:end]
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        if self.tailable:
+            return self
+        if self._results is None:
+            self._results = iter(self._sorted())
+        return (_project(doc, self.projection) for doc in self._results)
+
+    def _tail(self, wait: float) -> Optional[dict[str, Any]]:
+        """Next document inserted after the last one returned, waiting at most `wait` seconds"""
+        collection = self.collection
+        deadline = time.monotonic() + wait
+        with collection._lock:
+            while True:
+                # row ids are consecutive, so only the documents inserted since the last call are checked
+                while self._lastrowid < collection._lastrowid:
+                    self._lastrowid += 1
+                    doc = collection._docs.get(self._lastrowid)
+                    if doc is not None and collection._match(doc, self.filter):
+                        return _project(doc, self.projection)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                collection._newdocs.wait(remaining)
+
+    def next(self) -> dict[str, Any]:
+        if self.tailable:
+            doc = self._tail(self._awaittime)
+            if doc is None:
+                raise StopIteration
+            return doc
+        if self._results is None:
+            self._results = iter(self._sorted())
+        return _project(next(self._results), self.projection)
+
+    __next__ = next
+
+    def try_next(self) -> Optional[dict[str, Any]]:
+        if self.tailable:
+            return self._tail(self._awaittime)
+        try:
+            return self.next()
+        except StopIteration:
+            return None
@@ -0,0 +1,103 @@
+from __future__ import annotations
+from typing import Optional, Any
+from datetime import datetime, timezone
+from pymongo import UpdateOne
+import pymongo
+import logging
+logger = logging.getLogger()
+
+from beershop.utils.storage import Storage
+
+
+def minute(time: datetime) -> datetime:
+    """Start of the minute of a time, in utc"""
+    if time.tzinfo is not None:
+        time = time.astimezone(timezone.utc)
+    return time.replace(second=0, microsecond=0)
+
+def create_indexes(storage: Storage, retention: Optional[float] = None):
+    """Create the indexes of the velocity buckets
+
+    Args:
+        storage: storage of the application
+        retention: time in days after which the buckets are removed. None to keep them.
+
+    """
+    storage[Storage.VELOCITY].create_index([('item', pymongo.ASCENDING), ('minute', pymongo.ASCENDING)], unique=True)
+    if retention is not None:
+        storage[Storage.VELOCITY].create_index('minute', expireAfterSeconds=int(retention * 86400))
+
+def record(collection_velocity, time: datetime, sold: dict[str, int], released: dict[str, int], stock: dict[str, int]):
+    """Add the quantities sold and released by a batch to the buckets of the minute
+
+    Args:
+        collection_velocity: collection of the velocity buckets
+        time: time of the batch
+        sold: quantity sold by item id
+        released: quantity released by modifications and deletions, by item id
+        stock: stock by item id at the end of the batch
+
+    """
+    bucket = minute(time)
+    requests = [
+        UpdateOne(
+            {'item': iditem, 'minute': bucket},
+            {
+                '$inc': {'sold': sold.get(iditem, 0), 'released': released.get(iditem, 0)},
+                '$set': {'instock': stock[iditem]},
+            },
+            upsert=True
+        )
+        for iditem in sorted(set(sold) | set(released))
+        if iditem in stock
+    ]
+    if requests:
+        collection_velocity.bulk_write(requests, ordered=False)
+
+def velocity(collection_velocity, item: dict[str, Any], start: datetime, end: datetime) -> dict[str, Any]:
+    """Sales and stock of an item by minute, with an estimate of the time left before it runs out
+
+    The stock is expected to reach `limitoutofstock` at the net rate of the range, the quantity
+    sold minus the quantity released per minute.
+
+    Args:
+        collection_velocity: collection of the velocity buckets
+        item: item, with its current stock
+        start: start of the range
+        end: end of the range, excluded
+
+    Returns:
+        buckets of the range, totals, rate and depletion estimate
+
+    """
+    buckets = list(collection_velocity.find(
+        {'item': item['id'], 'minute': {'$gte': minute(start), '$lt': end}},
+        {'_id': False, 'item': False}
+    ).sort('minute', pymongo.ASCENDING))
+
+    sold = sum(bucket['sold'] for bucket in buckets)
+    released = sum(bucket['released'] for bucket in buckets)
+    minutes = max((end - start).total_seconds() / 60, 1)
+    rate = (sold - released) / minutes
+
+    # minutes left before the stock goes below the limit, None if the stock is not decreasing
+    limit = item.get('limitoutofstock', 0)
+    if item['instock'] <= limit:
+        depletion = 0
+    elif rate > 0:
+        depletion = (item['instock'] - limit) / rate
+    else:
+        depletion = None
+
+    return {
+        'item': item['id'],
+        'start': start,
+        'end': end,
+        'buckets': buckets,
+        'sold': sold,
+        'released': released,
+        'rate': rate,
+        'instock': item['instock'],
+        'limitoutofstock': limit,
+        'depletion': depletion,
+    }
@@ -1,24 +1,115 @@
+import os
+import shutil
+import socket
+import subprocess
+import time
 import pytest
 import pymongo
+from bson import json_util
 from beershop import create_app
 from beershop.utils.config import Config
+from beershop.utils.dataset import initialize, read_items
+from beershop.utils.storage import Storage, MongoStorage, MemoryStorage
+
+
+COLLECTIONS = os.path.join(os.path.dirname(__file__), 'collections')
+DATASET = os.path.join(os.path.dirname(__file__), '..', 'example', 'beer_profile_and_ratings.csv')
+
+
+def pytest_addoption(parser):
+    parser.addoption('--mongod', default=None, help="Run the benchmarks on an ephemeral mongod: path of the binary, or 'auto' to find it in PATH.")
+    parser.addoption('--update-baselines', action='store_true', help='Store the measures of the benchmarks as the new baselines.')
+
+
+def load_collection(name):
+    with open(os.path.join(COLLECTIONS, f'{name}.json'), 'r') as fid:
+        return json_util.loads(fid.read())
+
+
+def stop_queuehandler(app):
+    """Stop the queue handler thread of the memory backend, if any"""
+    handler = app.extensions.get('queuehandler')
+    if handler is not None:
+        handler.stop()
 
 
 @pytest.fixture()
 def app():
-    config = Config.load()
+    # run on the memory backend when no configuration file is provided
+    if os.environ.get('BEERSHOP_CONFIG') is None:
+        config = Config(database={'name': 'beershop', 'backend': 'memory', 'seed': None})
+    else:
+        config = Config.load()
 
     # append "test" to db name
-    testdbname = f"{config.database['name']}-test" 
+    testdbname = f"{config.database['name']}-test"
     config.database['name'] = testdbname
     app = create_app(config)
     app.config.update({
         'TESTING': True,
         'CONFIG': config
     })
-    
+
+    # load the test collections
+    storage = app.extensions.get('storage')
+    if storage is not None:
+        initialize(storage, load_collection('items'))
+        storage.orders.insert_many(load_collection('orders'))
+
     yield app
 
+    stop_queuehandler(app)
+
+
+@pytest.fixture()
+def memory_app():
+    """Factory of applications on the memory backend, loaded with the test items
+
+    The factory takes the items of the shop (default: the test items), the orders, the schema of
+    the database and any other section of the configuration. Queue handlers are stopped on teardown.
+
+    """
+    apps = []
+
+    def make(items=None, orders=None, schema='standard', **sections):
+        config = Config(database={'name': 'beershop-test', 'backend': 'memory', 'seed': None, 'schema': schema}, **sections)
+        app = create_app(config)
+        app.config.update({'TESTING': True})
+        apps.append(app)
+
+        storage = app.extensions['storage']
+        initialize(storage, load_collection('items') if items is None else items)
+        if orders:
+            storage.orders.insert_many(orders)
+        return app
+
+    yield make
+
+    for app in apps:
+        stop_queuehandler(app)
+
+
+@pytest.fixture()
+def config_file(tmp_path):
+    """Factory of configuration files on the local database, with sections in yaml flow style"""
+    def write(**sections):
+        sections = {'database': '{host: 127.0.0.1, port: 27017, name: beershop, timeout: 5000}', **sections}
+        configpath = tmp_path / 'config.yaml'
+        configpath.write_text(''.join(f'{name}: {value}\n' for name, value in sections.items()))
+        return str(configpath)
+
+    return write
+
+
+@pytest.fixture()
+def storage():
+    """Memory storage loaded with the test collections, like the database of the mongodb fixture"""
+    storage = MemoryStorage()
+    storage.items.insert_many(load_collection('items'))
+    storage.orders.insert_many(load_collection('orders'))
+    storage.create_queue(1000, 100000)
+    return storage
+
 
 @pytest.fixture()
 def client(app):
@@ -28,3 +119,112 @@ def client(app):
 @pytest.fixture()
 def runner(app):
     return app.test_cli_runner()
+
+
+@pytest.fixture(scope='session')
+def mongod(request, tmp_path_factory):
+    """Client of an ephemeral mongod, started on a free port. None without the option --mongod"""
+    binary = request.config.getoption('--mongod')
+    if binary is None:
+        yield None
+        return
+    if binary == 'auto':
+        binary = shutil.which('mongod')
+        if binary is None:
+            pytest.skip('mongod not found in PATH.')
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [binary, '--dbpath', str(tmp_path_factory.mktemp('mongod')), '--port', str(port), '--bind_ip', '127.0.0.1'],
+        stdout=subprocess.DEVNULL
+    )
+
+    # wait for the server to accept connections
+    client = pymongo.MongoClient('127.0.0.1', port, serverSelectionTimeoutMS=500)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            client.admin.command('ping')
+            break
+        except pymongo.errors.ServerSelectionTimeoutError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                pytest.fail('mongod did not start.')
+
+    yield client
+
+    client.close()
+    process.terminate()
+    process.wait()
+
+
+class CountingCollection:
+    """Collection counting the operations sent to the database. A cursor counts as one operation"""
+    _OPERATIONS = {
+        'find', 'find_one', 'count_documents', 'distinct', 'insert_one', 'insert_many', 'update_one',
+        'update_many', 'replace_one', 'find_one_and_update', 'delete_one', 'delete_many', 'bulk_write',
+    }
+
+    def __init__(self, collection, counter):
+        self.collection = collection
+        self.counter = counter
+
+    def __getattr__(self, name):
+        attribute = getattr(self.collection, name)
+        if name not in self._OPERATIONS:
+            return attribute
+        def operation(*args, **kwargs):
+            self.counter[0] += 1
+            return attribute(*args, **kwargs)
+        return operation
+
+    def with_options(self, **kwargs):
+        return CountingCollection(self.collection.with_options(**kwargs), self.counter)
+
+
+class CountingStorage(Storage):
+    """Storage counting the round trips to the database of the wrapped storage"""
+    def __init__(self, storage):
+        self.storage = storage
+        self.counter = [0]
+
+    def __getitem__(self, name):
+        return CountingCollection(self.storage[name], self.counter)
+
+    def with_read_preference(self, readpreference):
+        counting = CountingStorage(self.storage.with_read_preference(readpreference))
+        counting.counter = self.counter
+        return counting
+
+    def create_queue(self, nmax, size):
+        self.storage.create_queue(nmax, size)
+
+    @property
+    def roundtrips(self):
+        return self.counter[0]
+
+
+@pytest.fixture()
+def perfapp(mongod):
+    """Application on the memory backend, or on the ephemeral mongod, seeded like beershop-initializetestdb"""
+    if mongod is None:
+        config = Config(database={'name': 'beershop-perf', 'backend': 'memory', 'seed': None})
+        app = create_app(config)
+        storage = app.extensions['storage']
+    else:
+        host, port = mongod.address
+        config = Config(database={'name': 'beershop-perf', 'host': host, 'port': port, 'timeout': 5000, 'schema': 'standard'})
+        app = create_app(config)
+        mongod.drop_database('beershop-perf')
+        storage = MongoStorage(mongod['beershop-perf'])
+        storage.create_queue(10000, 10000000)
+
+    initialize(storage, read_items(DATASET, 1))
+    app.extensions['storage'] = CountingStorage(storage)
+    app.config.update({'TESTING': True})
+
+    yield app
+
+    stop_queuehandler(app)
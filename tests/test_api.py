@@ -20,4 +20,15 @@ def test_insert_neworder(client):
     data = response.json
     
     # check len of order id
-    assert len(data['message']) == 6
\ No newline at end of file
+    assert len(data['message']) == 6
+
+def test_secret_key(memory_app, monkeypatch):
+    monkeypatch.delenv('BEERSHOP_SECRET_KEY', raising=False)
+
+    # without a configured key every application generates its own
+    keys = {memory_app().secret_key for _ in range(2)}
+    assert len(keys) == 2 and all(len(key) == 64 for key in keys)
+
+    # the configured key is used otherwise
+    app = memory_app(server={'secretkey': 'configured'})
+    assert app.secret_key == 'configured'
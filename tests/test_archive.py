@@ -0,0 +1,134 @@
+import pytest
+from datetime import datetime, timezone, timedelta
+from beershop.utils.archive import Archiver
+from beershop.utils.storage import MemoryStorage
+
+
+def archiveconfig(**kwargs):
+    config = {
+        'enabled': True,
+        'backend': 'collection',
+        'path': 'archive',
+        'maxage': 365,
+        'terminalage': 30,
+        'terminalstatus': ['deleted', 'canceled'],
+        'batchsize': 2,
+        'interval': 3600,
+    }
+    config.update(kwargs)
+    return config
+
+def seed(storage):
+    now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+    orders = [
+        # old order, archived whatever the status
+        ('000301', 'confirmed', now - timedelta(days=400)),
+        # deleted order older than terminal age
+        ('000302', 'deleted', now - timedelta(days=40)),
+        # recent deleted order
+        ('000303', 'deleted', now - timedelta(days=1)),
+        # confirmed order younger than max age
+        ('000304', 'confirmed', now - timedelta(days=40)),
+        # latest order
+        ('000305', 'canceled', now - timedelta(days=50)),
+    ]
+    storage.orders.delete_many({})
+    storage.orders.insert_many([
+        {
+            'type': 'new',
+            'id': idorder,
+            'order': {'id': '0001', 'quantity': 1},
+            'user': 'archiveuser',
+            'creationtime': creationtime,
+            'nmodified': 0,
+            'lastmodified': None,
+            'status': status,
+            'laststatuschange': creationtime
+        }
+        for idorder, status, creationtime in orders
+    ])
+
+def test_archive_collection(storage):
+    seed(storage)
+    archiver = Archiver({}, archiveconfig())
+
+    assert archiver.run_once(storage) == 2
+
+    # archived orders are moved out of orders
+    remaining = {order['id'] for order in storage.orders.find({'user': 'archiveuser'})}
+    assert remaining == {'000303', '000304', '000305'}
+
+    archived = archiver.find(storage, 'archiveuser')
+    assert {order['id'] for order in archived} == {'000301', '000302'}
+
+    archived = archiver.find(storage, 'archiveuser', status='deleted')
+    assert [order['id'] for order in archived] == ['000302']
+
+def test_archive_parquet(storage, tmp_path):
+    pytest.importorskip('pyarrow')
+    seed(storage)
+    archiver = Archiver({}, archiveconfig(backend='parquet', path=str(tmp_path)))
+
+    assert archiver.run_once(storage) == 2
+    assert len(list(tmp_path.glob('orders-*.parquet'))) == 1
+
+    archived = archiver.find(storage, 'archiveuser', idorder='000302')
+    assert archived[0]['status'] == 'deleted'
+    assert archived[0]['order'] == {'id': '0001', 'quantity': 1}
+
+    starttime = datetime.now(timezone.utc) - timedelta(days=100)
+    archived = archiver.find(storage, 'archiveuser', starttime=starttime)
+    assert [order['id'] for order in archived] == ['000302']
+
+class ModifyingArchiver(Archiver):
+    """Archiver whose first copy races with a modification of the queue handler"""
+    def _write_collection(self, db, orders):
+        super()._write_collection(db, orders)
+        self.modify()
+
+    def _write_parquet(self, orders):
+        super()._write_parquet(orders)
+        self.modify()
+
+    def modify(self):
+        if not getattr(self, 'modified', False):
+            self.modified = True
+            self.storage.orders.update_one({'id': '000301'}, {'$set': {'nmodified': 1, 'laststatuschange': datetime.now(timezone.utc)}})
+
+@pytest.mark.parametrize('backend', ['collection', 'parquet'])
+def test_archive_modified(backend, tmp_path):
+    if backend == 'parquet':
+        pytest.importorskip('pyarrow')
+    storage = MemoryStorage()
+    seed(storage)
+    archiver = ModifyingArchiver({}, archiveconfig(backend=backend, path=str(tmp_path)))
+    archiver.storage = storage
+
+    # the modified order is copied again instead of being lost
+    assert archiver.run_once(storage) == 2
+    assert storage.orders.count_documents({'user': 'archiveuser'}) == 3
+    archived = {order['id']: order for order in archiver.find(storage, 'archiveuser')}
+    assert set(archived) == {'000301', '000302'}
+    assert archived['000301']['nmodified'] == 1
+
+def test_archive_needed():
+    archiver = Archiver({}, archiveconfig())
+
+    # recent ranges are served by the collection of orders only
+    assert not archiver.needed(datetime.now(timezone.utc) - timedelta(days=1))
+    assert archiver.needed(datetime.now(timezone.utc) - timedelta(days=31))
+    assert archiver.needed(None)
+
+def test_getorders_archived(memory_app):
+    app = memory_app(archive=archiveconfig())
+    storage = app.extensions['storage']
+    seed(storage)
+    archiver = app.extensions['archive']
+    assert archiver.run_once(storage) == 2
+
+    # an order copied to the archive but still in the collection is returned once, as found in the collection
+    copied = archiver.find(storage, 'archiveuser')[0]
+    storage.orders.insert_one({**copied, 'status': 'confirmed'})
+    orders = app.test_client().get('/orders/archiveuser').json
+    assert sorted(order['id'] for order in orders) == ['000301', '000302', '000303', '000304', '000305']
+    assert next(order for order in orders if order['id'] == copied['id'])['status'] == 'confirmed'
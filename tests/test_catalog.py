@@ -0,0 +1,63 @@
+import pytest
+from beershop.utils.catalog import bump_catalog_version
+from tests.conftest import load_collection
+
+
+def catalog():
+    # items of different styles and prices, built from the test items
+    template = load_collection('items')[0]
+    styles = ['altbier', 'stout', 'ipa', 'stout']
+    return [
+        {
+            **{key: value for key, value in template.items() if key != '_id'},
+            'id': f'{count + 1:04d}',
+            'instock': count * 10,
+            'unitprice': count + 2,
+            'content': {**template['content'], 'Style': styles[count % len(styles)]},
+        }
+        for count in range(8)
+    ]
+
+@pytest.fixture(params=['standard', 'compact'])
+def shop(request, memory_app):
+    app = memory_app(catalog(), schema=request.param)
+    return app.test_client(), app.extensions['storage']
+
+def ids(response):
+    return [item['id'] for item in response.json]
+
+def test_filters(shop):
+    client, _ = shop
+
+    assert ids(client.get('/items?styles=Stout')) == ['0002', '0004', '0006', '0008']
+    assert ids(client.get('/items?styles=stout,ipa&minprice=5')) == ['0004', '0006', '0007', '0008']
+    assert ids(client.get('/items?minprice=3&maxprice=4.5')) == ['0002', '0003']
+    assert ids(client.get('/items?maxstock=15')) == ['0001', '0002']
+    assert ids(client.get('/items?instock=true&maxstock=15')) == ['0002']
+    assert 'message' in client.get('/items?minprice=cheap').json
+
+def test_sort_limit(shop):
+    client, _ = shop
+
+    assert ids(client.get('/items?sort=-unitprice&limit=3')) == ['0008', '0007', '0006']
+    assert ids(client.get('/items?styles=stout&sort=-instock&limit=2')) == ['0008', '0006']
+    assert ids(client.get('/items?sort=style&limit=3')) == ['0001', '0005', '0003']
+    assert 'message' in client.get('/items?sort=color').json
+
+def test_facets(shop):
+    client, storage = shop
+
+    facets = client.get('/items/facets?bins=3').json
+    assert facets['items'] == 8
+    assert facets['styles'] == {'stout': 4, 'altbier': 2, 'ipa': 2}
+    assert [bin['count'] for bin in facets['unitprice']] == [3, 2, 3]
+    assert facets['unitprice'][0]['min'] == 2 and facets['unitprice'][-1]['max'] == 9
+
+    # changes that do not bump the catalog version are not seen, the cached facets are served
+    storage.items.update_one({'id': '0001'}, {'$set': {'content.Style': 'porter'}})
+    assert client.get('/items/facets?bins=3').json == facets
+
+    # a new version of the catalog recomputes the facets
+    bump_catalog_version(storage)
+    facets = client.get('/items/facets?bins=3').json
+    assert facets['version'] == 2 and facets['styles']['porter'] == 1
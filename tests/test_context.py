@@ -0,0 +1,60 @@
+from flask import Flask
+from pymongo import MongoClient, WriteConcern, read_preferences
+from beershop.utils.config import Config
+from beershop.utils.context import ORDER_PAYLOAD, RouteContext
+from beershop.utils.dataset import initialize
+from beershop.utils.durability import PROFILES
+from beershop.utils.storage import MemoryStorage, MongoStorage
+from tests.conftest import load_collection
+
+
+def test_payload():
+    assert ORDER_PAYLOAD({'order': {'id': '0001', 'quantity': 3}}) is None
+    assert ORDER_PAYLOAD({}) == "Wrong order format. Expected 'order' key"
+    assert ORDER_PAYLOAD({'order': {'quantity': 3}}) == "Wrong order format. Expected 'id' key"
+    assert ORDER_PAYLOAD({'order': {'id': '0001'}}) == "Wrong order format. Expected 'quantity' key"
+    assert ORDER_PAYLOAD({'order': {'id': '0001', 'quantity': '3'}}) == "Wrong order format. Expected 'quantity' of type int"
+    assert ORDER_PAYLOAD({'order': {'id': '0001', 'quantity': True}}) == "Wrong order format. Expected 'quantity' of type int"
+    assert ORDER_PAYLOAD({'order': {'id': '0001', 'quantity': 0}}) == "Wrong order format. Expected 'quantity' of at least 1"
+    assert ORDER_PAYLOAD({'order': {'id': '0001', 'quantity': -2}}) == "Wrong order format. Expected 'quantity' of at least 1"
+
+def test_handles():
+    app = Flask(__name__)
+    storage = MongoStorage(MongoClient('127.0.0.1', 27017, connect=False)['beershop-test'])
+    app.extensions['storage'] = storage
+    config = Config(
+        database={'name': 'beershop-test'},
+        readpreference={'getitems': {'mode': 'secondaryPreferred', 'maxstaleness': 120}, 'getitem': {'mode': 'primary', 'maxstaleness': -1}},
+        durability={'profile': 'safe', 'profiles': PROFILES}
+    )
+    context = RouteContext.build(app, config)
+
+    # read preferences and write concerns are resolved once for every route
+    handles = context.handles('getitems')
+    assert handles.items.read_preference == read_preferences.SecondaryPreferred(max_staleness=120)
+    assert context.handles('getitem').items.read_preference == read_preferences.Primary()
+    writes = context.handles('neworder')
+    assert writes.queue.write_concern == WriteConcern(w='majority', j=True)
+    assert writes.ordersinsert.write_concern == WriteConcern(w='majority', j=True)
+    assert writes.orders.write_concern == storage.orders.write_concern
+    assert context.handles('getitems') is handles
+
+    # a new storage of the application is resolved again
+    app.extensions['storage'] = MongoStorage(MongoClient('127.0.0.1', 27017, connect=False)['beershop-test'])
+    assert context.handles('getitems') is not handles
+
+def test_routes(memory_app):
+    app = memory_app()
+    client = app.test_client()
+
+    assert client.post('/order/user/new', json={'order': {'id': '0001'}}).json == {'message': "Wrong order format. Expected 'quantity' key"}
+    assert client.post('/order/user/new', json={'order': {'id': '0001', 'quantity': 0}}).json == {'message': "Wrong order format. Expected 'quantity' of at least 1"}
+    assert app.extensions['storage'].queue.count_documents({'type': 'new'}) == 0
+    assert client.post('/order/user/new', json={'order': {'id': '0001', 'quantity': 2}}).json['message'] == '000001'
+
+    # the routes keep working on a storage replaced after the creation of the application
+    storage = MemoryStorage()
+    initialize(storage, load_collection('items'))
+    storage.items.update_one({'id': '0001'}, {'$set': {'instock': 1}})
+    app.extensions['storage'] = storage
+    assert client.get('/item/0001').json['instock'] == 1
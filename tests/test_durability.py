@@ -0,0 +1,48 @@
+import pytest
+from pymongo import MongoClient, WriteConcern
+from beershop.utils.config import Config
+from beershop.utils.durability import PROFILES, write_concern, with_durability
+from beershop.utils.storage import MemoryStorage
+
+
+def test_write_concern():
+    durability = {'profile': 'balanced', 'profiles': PROFILES}
+
+    assert write_concern(durability, 'orderqueue', 'insert') == WriteConcern(w=1, j=False)
+    assert write_concern(durability, 'items', 'update') == WriteConcern(w='majority', j=True)
+
+    # the default profile keeps the write concern of the client
+    assert write_concern({**durability, 'profile': 'default'}, 'items', 'update') is None
+    assert write_concern({}, 'items', 'update') is None
+
+def test_with_durability():
+    durability = {'profile': 'fast', 'profiles': PROFILES}
+
+    client = MongoClient('127.0.0.1', 27017, connect=False)
+    queue = with_durability(client['beershop-test']['orderqueue'], durability, 'insert')
+    assert queue.write_concern == WriteConcern(w=0)
+
+    # write concerns have no meaning in memory
+    storage = MemoryStorage()
+    assert with_durability(storage.queue, durability, 'insert') is storage.queue
+
+def test_config(config_file):
+    config = Config.load(config_file(durability='{profile: custom, profiles: {custom: {items: {update: {w: 2, wtimeout: 1000}}}}}'))
+
+    assert write_concern(config.durability, 'items', 'update') == WriteConcern(w=2, wtimeout=1000)
+    assert 'safe' in config.durability['profiles']
+
+def test_config_errors(config_file):
+    # unknown profile
+    with pytest.raises(SystemExit):
+        Config.load(config_file(durability='{profile: missing}'))
+
+    # unacknowledged writes cannot be journaled
+    with pytest.raises(SystemExit):
+        Config.load(config_file(durability='{profiles: {custom: {orderqueue: {insert: {w: 0, j: true}}}}}'))
+
+    # the stock updates are read back, so they must be acknowledged
+    with pytest.raises(SystemExit):
+        Config.load(config_file(durability='{profiles: {custom: {items: {update: {w: 0}}}}}'))
+    with pytest.raises(SystemExit):
+        Config.load(config_file(durability='{profiles: {custom: {orders: {insert: {w: 0}}}}}'))
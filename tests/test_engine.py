@@ -0,0 +1,51 @@
+from beershop.utils.engine import OrderEngine
+from beershop.utils.queuehandler import QueueHandler
+from beershop.utils.replay import synthetic_stream, replay
+
+
+def test_engine_transitions():
+    engine = OrderEngine({'0001': 5})
+    stream = list(synthetic_stream(3, 1))
+    new = {**stream[0], 'order': {'id': '0001', 'quantity': 3}}
+
+    assert engine.apply(new)[0] == 'confirmed'
+    assert engine.stock['0001'] == 2
+
+    # the quantity can only be reduced
+    assert engine.apply({**new, 'type': 'modify', 'order': {'id': '0001', 'quantity': 4}})[0] == 'ignored'
+    assert engine.apply({**new, 'type': 'modify', 'order': {'id': '0001', 'quantity': 1}})[0] == 'modified'
+    assert engine.stock['0001'] == 4
+
+    assert engine.apply({**new, 'type': 'delete'})[0] == 'deleted'
+    assert engine.apply({**new, 'type': 'delete'})[0] == 'ignored'
+    assert engine.stock['0001'] == 5
+    assert engine.stockchanges() == {}
+
+def test_replay_never_oversells():
+    engine = OrderEngine({f'{count + 1:04d}': 10 for count in range(5)})
+    report = replay(engine, synthetic_stream(5000, 5))
+
+    assert report['orders'] == 5000
+    assert min(report['stock'].values()) >= 0
+
+def test_handler_matches_engine(storage):
+    stream = list(synthetic_stream(300, 3, seed=7))
+    stock = {f'{count + 1:04d}': 20 for count in range(3)}
+
+    # engine alone
+    engine = OrderEngine(dict(stock))
+    replay(engine, stream)
+
+    # queue handler on the database, in batches of 50 orders
+    storage.items.delete_many({})
+    storage.items.insert_many([{'id': iditem, 'instock': quantity} for iditem, quantity in stock.items()])
+    storage.orders.insert_many([{**order, 'user': 'enginetest'} for order in stream if order['type'] == 'new'])
+    handler = QueueHandler(database={}, polling=1)
+    for start in range(0, len(stream), 50):
+        batch = [{**order, 'user': 'enginetest'} for order in stream[start:start + 50]]
+        handler.process(batch, storage.orders, storage.items)
+
+    for iditem, quantity in engine.stock.items():
+        assert storage.items.find_one({'id': iditem})['instock'] == quantity
+    for (idorder, _), order in engine.orders.items():
+        assert storage.orders.find_one({'id': idorder, 'user': 'enginetest'})['status'] == order['status']
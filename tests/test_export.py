@@ -0,0 +1,57 @@
+import io
+import csv
+import json
+from datetime import datetime, timezone
+import pytest
+from beershop.utils.export import iter_documents, parquet_chunks, serialize
+
+
+def test_export_resume(storage):
+    docs = list(iter_documents(storage.items, 'last_update', batchsize=1))
+    assert [doc['id'] for doc in docs] == ['0001', '0002']
+
+    # resume after the first document
+    resumed = list(iter_documents(storage.items, 'last_update', after=docs[0]['_id']))
+    assert [doc['id'] for doc in resumed] == ['0002']
+
+def test_export_formats(storage):
+    docs = list(iter_documents(storage.orders, 'creationtime'))
+
+    lines = b''.join(serialize(iter(docs), 'orders', 'ndjson')).decode().splitlines()
+    assert [json.loads(line)['id'] for line in lines] == ['000001', '000002']
+
+    rows = list(csv.DictReader(io.StringIO(b''.join(serialize(iter(docs), 'orders', 'csv')).decode())))
+    assert rows[1]['order.quantity'] == '4'
+
+    pq = pytest.importorskip('pyarrow.parquet')
+    table = pq.read_table(io.BytesIO(b''.join(serialize(iter(docs), 'orders', 'parquet'))))
+    assert table.column('id').to_pylist() == ['000001', '000002']
+
+def test_export_mixed():
+    # the modification time is missing or null in the first documents, and set in the last one
+    now = datetime(2025, 5, 16, 12, 0, tzinfo=timezone.utc)
+    docs = [
+        {'_id': '1', 'id': '000001', 'order': {'id': '0001', 'quantity': 3}, 'user': 'user', 'creationtime': now, 'status': 'processing'},
+        {'_id': '2', 'id': '000002', 'order': {'id': '0001', 'quantity': 3}, 'user': 'user', 'creationtime': now, 'lastmodified': None},
+        {'_id': '3', 'id': '000003', 'order': {'id': '0002', 'quantity': 1}, 'user': 'user', 'creationtime': now, 'lastmodified': now, 'nmodified': 1},
+    ]
+
+    rows = list(csv.DictReader(io.StringIO(b''.join(serialize(iter(docs), 'orders', 'csv')).decode())))
+    assert [row['lastmodified'] for row in rows] == ['', '', now.isoformat()]
+    assert rows[2]['nmodified'] == '1'
+
+    pq = pytest.importorskip('pyarrow.parquet')
+    table = pq.read_table(io.BytesIO(b''.join(parquet_chunks(iter(docs), 'orders', rowgroupsize=1))))
+    assert table.column('lastmodified').to_pylist() == [None, None, now.replace(tzinfo=None)]
+    assert table.column('order.quantity').to_pylist() == [3, 3, 1]
+
+def test_export_forbidden(memory_app):
+    app = memory_app(admin={'token': 'secret'})
+    client = app.test_client()
+
+    # admin routes require the token
+    response = client.get('/admin/export/orders')
+    assert response.status_code == 403
+
+    response = client.get('/admin/export/orders', headers={'X-Admin-Token': 'wrong'})
+    assert response.status_code == 403
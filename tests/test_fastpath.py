@@ -0,0 +1,59 @@
+import pytest
+from beershop.utils.queuehandler import QueueHandler
+from beershop.utils.storage import MemoryStorage
+from tests.test_queuehandler import queued
+
+
+@pytest.fixture()
+def shop(memory_app):
+    def make(headroom):
+        app = memory_app(fastpath={'enabled': True, 'headroom': headroom})
+        return app.test_client(), app.extensions['storage']
+    return make
+
+def test_reserved(shop):
+    client, storage = shop(0)
+
+    response = client.post('/order/user/new', json={'order': {'id': '0001', 'quantity': 3}})
+    assert response.json == {'message': '000001', 'status': 'confirmed'}
+    assert storage.orders.find_one({'id': '000001'})['status'] == 'confirmed'
+    assert storage.items.find_one({'id': '0001'})['instock'] == 10
+
+    # the queue handler records the order without reserving the stock again
+    queue = [order for order in storage.queue.find({}) if order.get('reserved')]
+    updates = QueueHandler(database={}, polling=1).process(queue, storage.orders, storage.items)
+    assert updates == {}
+    assert storage.items.find_one({'id': '0001'})['instock'] == 10
+
+def test_fallback(shop):
+    client, storage = shop(12)
+
+    # the order would leave less than the headroom in stock
+    response = client.post('/order/user/new', json={'order': {'id': '0001', 'quantity': 2}})
+    assert response.json == {'message': '000001', 'status': 'processing'}
+    assert storage.items.find_one({'id': '0001'})['instock'] == 13
+    assert not storage.queue.find_one({'id': '000001'}).get('reserved')
+
+    # the queued order has its own '_id'
+    assert storage.queue.find_one({'id': '000001'})['_id'] != storage.orders.find_one({'id': '000001'})['_id']
+
+def test_stock_reserved_during_batch():
+    storage = MemoryStorage()
+    storage.items.insert_one({'id': '0101', 'instock': 5, 'limitoutofstock': 3})
+    order = queued('new', '000101', '0101', 4)
+    storage.orders.insert_one({**order})
+
+    # the API reserves 3 items after the handler read the stock
+    handler = QueueHandler(database={}, polling=1)
+    load = handler.load
+    def reserve_after_load(*args):
+        result = load(*args)
+        if storage.items.find_one({'id': '0101'})['instock'] == 5:
+            storage.items.update_one({'id': '0101'}, {'$inc': {'instock': -3}})
+        return result
+    handler.load = reserve_after_load
+
+    # the order is applied again on the stock left
+    updates = handler.process([order], storage.orders, storage.items)
+    assert updates[('000101', 'user')]['status'] == 'canceled'
+    assert storage.items.find_one({'id': '0101'})['instock'] == 2
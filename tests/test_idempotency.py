@@ -0,0 +1,133 @@
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+from flask import Flask, jsonify
+from beershop.utils.config import Config
+from beershop.utils.idempotency import IdempotencyStore, StoredResponse, idempotent
+
+
+def make_app():
+    config = Config(
+        database={'name': 'beershop-test'},
+        idempotency={'enabled': True, 'maxsize': 10, 'ttl': 60, 'shared': False}
+    )
+    app = Flask(__name__)
+    app.config['CONFIG'] = config
+    app.extensions['idempotency'] = IdempotencyStore(10, 60)
+    app.calls = 0
+
+    @app.route('/order/<username>/new', methods=['POST'])
+    @idempotent
+    def neworder(username):
+        app.calls += 1
+        return jsonify({'message': f'{app.calls:06d}'})
+
+    return app
+
+def test_store_states():
+    store = IdempotencyStore(maxsize=2, ttl=60)
+
+    # first claim is new, then pending until completed
+    assert store.begin('a', 'x') == (IdempotencyStore.NEW, None)
+    assert store.begin('a', 'x') == (IdempotencyStore.PENDING, None)
+
+    response = StoredResponse(b'{}', 200, 'application/json')
+    store.complete('a', response)
+    assert store.begin('a', 'x') == (IdempotencyStore.DONE, response)
+
+    # same key with a different payload
+    assert store.begin('a', 'y') == (IdempotencyStore.CONFLICT, None)
+
+def test_store_bounded():
+    store = IdempotencyStore(maxsize=2, ttl=60)
+    for key in ['a', 'b', 'c']:
+        store.begin(key, 'x')
+
+    # the oldest key is evicted
+    assert len(store) == 2
+    assert store.begin('a', 'x') == (IdempotencyStore.NEW, None)
+
+def test_store_ttl():
+    store = IdempotencyStore(maxsize=10, ttl=0)
+    store.begin('a', 'x')
+    store.complete('a', StoredResponse(b'{}', 200, 'application/json'))
+
+    # expired keys are processed again
+    assert store.begin('a', 'x') == (IdempotencyStore.NEW, None)
+
+def test_retry_replayed():
+    app = make_app()
+    client = app.test_client()
+    payload = {'order': {'id': '0001', 'quantity': 3}}
+    headers = {'Idempotency-Key': 'retry-1'}
+
+    first = client.post('/order/user/new', json=payload, headers=headers)
+    retry = client.post('/order/user/new', json=payload, headers=headers)
+
+    # the retry returns the original order id without creating a new one
+    assert app.calls == 1
+    assert retry.json == first.json
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+
+    # requests without key are always processed
+    client.post('/order/user/new', json=payload)
+    assert app.calls == 2
+
+    # the key is scoped to the user
+    client.post('/order/other/new', json=payload, headers=headers)
+    assert app.calls == 3
+
+IDEMPOTENCY = {'enabled': True, 'maxsize': 10, 'ttl': 60, 'shared': True, 'lease': 60}
+
+def test_api_replay(memory_app):
+    app = memory_app(idempotency=IDEMPOTENCY)
+    storage = app.extensions['storage']
+    client = app.test_client()
+    headers = {'Idempotency-Key': 'order-1'}
+
+    first = client.post('/order/user/new', json={'order': {'id': '0001', 'quantity': 3}}, headers=headers)
+    retry = client.post('/order/user/new', json={'order': {'id': '0001', 'quantity': 3}}, headers=headers)
+
+    # the retry is answered with the first response, and queues no other order
+    assert retry.status_code == first.status_code == 200
+    assert retry.json == first.json
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert 'Idempotent-Replayed' not in first.headers
+    assert storage.queue.count_documents({'type': 'new'}) == 1
+
+    # the same key with a different payload is a conflict
+    conflict = client.post('/order/user/new', json={'order': {'id': '0001', 'quantity': 4}}, headers=headers)
+    assert conflict.status_code == 422
+
+def test_api_lease(memory_app):
+    app = memory_app(idempotency={**IDEMPOTENCY, 'ttl': 600})
+    storage = app.extensions['storage']
+    client = app.test_client()
+    data = json.dumps({'order': {'id': '0001', 'quantity': 3}})
+    fingerprint = hashlib.sha256(data.encode()).hexdigest()
+
+    # a key claimed by a crashed worker, and one still in progress
+    claimedat = datetime.now(timezone.utc) - timedelta(seconds=120)
+    storage['idempotencykeys'].insert_one({'_id': 'POST:/order/user/new:crashed', 'fingerprint': fingerprint, 'createdat': claimedat, 'claimedat': claimedat, 'response': None})
+    now = datetime.now(timezone.utc)
+    storage['idempotencykeys'].insert_one({'_id': 'POST:/order/user/new:running', 'fingerprint': fingerprint, 'createdat': now, 'claimedat': now, 'response': None})
+
+    # the expired claim is taken over and processed, the recent one is still in progress
+    response = client.post('/order/user/new', data=data, content_type='application/json', headers={'Idempotency-Key': 'crashed'})
+    assert response.status_code == 200 and len(response.json['message']) == 6
+    assert storage['idempotencykeys'].find_one({'_id': 'POST:/order/user/new:crashed'})['response'] is not None
+    response = client.post('/order/user/new', data=data, content_type='application/json', headers={'Idempotency-Key': 'running'})
+    assert response.status_code == 409
+
+def test_api_expired(memory_app):
+    app = memory_app(idempotency=IDEMPOTENCY)
+    storage = app.extensions['storage']
+    client = app.test_client()
+
+    # the keys older than the ttl are removed from the memory backend when a key is claimed
+    createdat = datetime.now(timezone.utc) - timedelta(seconds=120)
+    storage['idempotencykeys'].insert_one({'_id': 'POST:/order/user/new:old', 'fingerprint': '', 'createdat': createdat, 'claimedat': createdat, 'response': None})
+    response = client.post('/order/user/new', json={'order': {'id': '0001', 'quantity': 3}}, headers={'Idempotency-Key': 'order-1'})
+    assert response.status_code == 200
+    assert storage['idempotencykeys'].find_one({'_id': 'POST:/order/user/new:old'}) is None
+    assert storage['idempotencykeys'].count_documents({}) == 1
@@ -0,0 +1,116 @@
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+import pytest
+from bson import ObjectId
+from beershop.utils.leader import Lease, LeaseLost
+from beershop.utils.queuehandler import QueueHandler
+from beershop.utils.storage import MemoryStorage, Storage
+from tests.test_queuehandler import queued
+
+
+def wait(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def test_lease():
+    storage = MemoryStorage()
+    first = Lease(storage[Storage.LEASES], owner='first', ttl=0.1)
+    second = Lease(storage[Storage.LEASES], owner='second', ttl=0.1)
+
+    # a single holder at a time
+    assert first.acquire()['term'] == 1
+    assert second.acquire() is None
+    assert first.renew() and first.held
+
+    # the lease expires when it is not renewed, and the former holder is fenced off
+    time.sleep(0.15)
+    assert not first.held
+    assert second.acquire()['term'] == 2
+    assert not first.renew()
+    with pytest.raises(LeaseLost):
+        first.commit(None)
+
+    # a released lease is taken over without waiting for the expiry
+    second.release()
+    assert first.acquire()['term'] == 3
+
+def test_resume():
+    storage = MemoryStorage()
+    storage.create_queue(100, 100000)
+    storage.items.insert_one({'id': '0103', 'instock': 10, 'limitoutofstock': 3})
+
+    # orders queued by workers whose '_id' do not follow the order of the queue
+    orders = [queued('new', '000111', '0103', 1), queued('new', '000112', '0103', 2), queued('new', '000113', '0103', 3)]
+    storage.orders.insert_many([{**order} for order in orders])
+    ids = sorted(ObjectId() for _ in orders)
+    for order, queueid in zip(orders, reversed(ids)):
+        storage.queue.insert_one({**order, '_id': queueid})
+
+    # processing resumes after the checkpoint in the order of the queue
+    handler = QueueHandler(database={}, polling=0.01)
+    thread = threading.Thread(target=handler.run, args=(storage,), kwargs={'checkpoint': ids[-1]}, daemon=True)
+    thread.start()
+    try:
+        wait(lambda: storage.orders.find_one({'id': '000113'})['status'] == 'confirmed')
+        assert storage.orders.find_one({'id': '000112'})['status'] == 'confirmed'
+        assert storage.orders.find_one({'id': '000111'})['status'] == 'processing'
+        assert storage.items.find_one({'id': '0103'})['instock'] == 5
+    finally:
+        handler.stop()
+        thread.join()
+
+def test_failover():
+    storage = MemoryStorage()
+    storage.create_queue(100, 100000)
+    storage.items.insert_many([
+        {'id': '0101', 'instock': 10, 'limitoutofstock': 3},
+        {'id': '0102', 'instock': 10, 'limitoutofstock': 3},
+    ])
+
+    # the former leader processed the first order, journaled the second and stopped after the stock
+    # update of the first item of the second
+    orders = [queued('new', '000101', '0101', 1), queued('new', '000102', '0101', 2), queued('new', '000103', '0102', 3)]
+    storage.orders.insert_many([{**order} for order in orders])
+    for order in orders:
+        storage.queue.insert_one(order)
+    storage.items.update_one({'id': '0101'}, {'$set': {'instock': 7, 'lastbatch': orders[1]['_id']}})
+    storage.orders.update_one({'id': '000101'}, {'$set': {'status': 'confirmed'}})
+    storage[Storage.LEASES].insert_one({
+        '_id': 'queuehandler',
+        'owner': 'former',
+        'term': 4,
+        'expires': datetime.now(timezone.utc) - timedelta(seconds=1),
+        'checkpoint': orders[0]['_id'],
+        'pending': {
+            'batch': orders[1]['_id'],
+            'marker': orders[1]['_id'],
+            'stock': [{'id': '0101', 'change': -2}],
+            'orders': [{'id': '000102', 'user': 'user', 'changes': {'status': 'confirmed'}}],
+        },
+    })
+
+    handler = QueueHandler(database={}, polling=0.01, heartbeat=0.05, leasettl=1)
+    lease = Lease(storage[Storage.LEASES], owner='standby', ttl=1)
+    thread = threading.Thread(target=handler.lead, args=(storage,), kwargs={'lease': lease}, daemon=True)
+    thread.start()
+    try:
+        wait(lambda: storage.orders.find_one({'id': '000103'})['status'] == 'confirmed')
+
+        # the journaled writes are completed once, and processing resumes after them
+        assert storage.items.find_one({'id': '0101'})['instock'] == 7
+        assert storage.items.find_one({'id': '0102'})['instock'] == 7
+        assert storage.orders.find_one({'id': '000102'})['status'] == 'confirmed'
+        doc = storage[Storage.LEASES].find_one({'_id': 'queuehandler'})
+        assert doc['owner'] == 'standby' and doc['term'] == 5
+        wait(lambda: storage[Storage.LEASES].find_one({'_id': 'queuehandler'})['checkpoint'] == orders[2]['_id'])
+        assert 'pending' not in storage[Storage.LEASES].find_one({'_id': 'queuehandler'})
+    finally:
+        handler.stop()
+        lease.release()
+        thread.join()
+
+    # the stopped leader gives up the lease
+    assert storage[Storage.LEASES].find_one({'_id': 'queuehandler'})['owner'] is None
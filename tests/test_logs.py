@@ -0,0 +1,98 @@
+import json
+import logging
+import queue
+import pytest
+from beershop.utils import logs
+from beershop.utils.config import Config
+from beershop.utils.logs import AsyncHandler, Event, JsonFormatter, configure_logging, log_event
+
+
+class Collector(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+@pytest.fixture()
+def collected(monkeypatch):
+    # records of a logger of the tests, sampled as configured
+    monkeypatch.setattr(logs, '_sampling', {'order.applied': 0, 'stock.updated': 0})
+    collector = Collector()
+    testlogger = logging.getLogger('beershop-test-logs')
+    testlogger.setLevel(logging.INFO)
+    testlogger.addHandler(collector)
+    yield testlogger, collector.records
+    testlogger.removeHandler(collector)
+
+def test_sampling(collected):
+    testlogger, records = collected
+
+    # sampled out events are never formatted
+    class Unformattable:
+        def __format__(self, spec):
+            raise AssertionError('formatted')
+    log_event(testlogger, logging.INFO, 'order.applied', 'Order {order} confirmed.', order=Unformattable())
+    assert records == []
+
+    # audit events, errors and events without a sampling rate are always kept
+    log_event(testlogger, logging.INFO, 'stock.updated', 'Stock of item {item} updated.', item='0101')
+    log_event(testlogger, logging.ERROR, 'order.applied', 'Order {order} failed.', order='000001')
+    log_event(testlogger, logging.INFO, 'order.queued', 'Order {order} created', order='000002')
+    assert [record.getMessage() for record in records] == [
+        'Stock of item 0101 updated.',
+        'Order 000001 failed.',
+        'Order 000002 created',
+    ]
+
+def test_json():
+    record = logging.LogRecord('root', logging.INFO, __file__, 1, Event('stock.updated', 'Stock of item {item} updated from {before} to {after}.', {'item': '0101', 'before': 10, 'after': 7}), None, None)
+    doc = json.loads(JsonFormatter().format(record))
+    assert doc['event'] == 'stock.updated'
+    assert (doc['item'], doc['before'], doc['after']) == ('0101', 10, 7)
+    assert doc['message'] == 'Stock of item 0101 updated from 10 to 7.'
+
+def test_full_queue():
+    handler = AsyncHandler(queue.Queue(1))
+    def record(level, name):
+        return logging.LogRecord('root', level, __file__, 1, Event(name, name, {}), None, None)
+
+    # sampled events are dropped when the queue is full, instead of waiting
+    handler.handle(record(logging.INFO, 'order.applied'))
+    handler.handle(record(logging.INFO, 'order.applied'))
+    assert handler.dropped == 1 and handler.queue.qsize() == 1
+
+    # audit events wait for room in the queue
+    handler.queue.get_nowait()
+    handler.handle(record(logging.INFO, 'stock.updated'))
+    assert handler.dropped == 1 and handler.queue.get_nowait().msg.name == 'stock.updated'
+
+def test_configure_logging(monkeypatch, capsys):
+    monkeypatch.setattr(logs, '_installed', None)
+    monkeypatch.setattr(logs, '_sampling', {})
+    root = logging.getLogger()
+    level = root.level
+
+    listener = configure_logging({'enabled': True, 'level': 'INFO', 'format': 'json', 'queuesize': 10, 'sampling': {'order.applied': 0.5}})
+    try:
+        assert logs._sampling == {'order.applied': 0.5}
+        log_event(root, logging.INFO, 'order.queued', 'Order {order} created', order='000001')
+    finally:
+        # the records left in the queue are written when the listener stops
+        root.removeHandler(logs._installed[0])
+        listener.stop()
+        root.setLevel(level)
+
+    lines = [json.loads(line) for line in capsys.readouterr().err.splitlines()]
+    assert {'event': 'order.queued', 'order': '000001', 'message': 'Order 000001 created'}.items() <= lines[-1].items()
+
+def test_config(config_file):
+    config = Config.load(config_file(logging='{format: json, sampling: {order.applied: 0.1}}'))
+    assert config.logging['format'] == 'json' and config.logging['sampling'] == {'order.applied': 0.1}
+    assert config.logging['enabled'] and config.logging['queuesize'] == 10000
+
+    with pytest.raises(SystemExit):
+        Config.load(config_file(logging='{format: xml}'))
+    with pytest.raises(SystemExit):
+        Config.load(config_file(logging='{sampling: {order.applied: 2}}'))
@@ -0,0 +1,92 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+import pytest
+from beershop.utils.queuehandler import QueueHandler
+from tests.test_queuehandler import queued
+
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+# latency may grow up to this factor of the baseline, and by at least 1 ms, before failing
+TOLERANCE = float(os.environ.get('BEERSHOP_PERF_TOLERANCE', 3))
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.fixture()
+def benchmark(request, mongod):
+    """Measure an operation and compare it with the stored baseline of the backend"""
+    backend = 'memory' if mongod is None else 'mongod'
+    with open(BASELINES, 'r') as fid:
+        baselines = json.load(fid)
+
+    def measure(name, storage, operation, repeat=20):
+        # one run to warm up caches and count the round trips, then the timed runs. The fastest
+        # run is the least affected by the other threads of the process
+        before = storage.roundtrips
+        operation()
+        roundtrips = storage.roundtrips - before
+        latencies = []
+        for _ in range(repeat):
+            begin = time.perf_counter()
+            operation()
+            latencies.append((time.perf_counter() - begin) * 1000)
+        measured = {'roundtrips': roundtrips, 'latency': round(min(latencies), 3)}
+
+        if request.config.getoption('--update-baselines'):
+            baselines.setdefault(backend, {})[name] = measured
+            with open(BASELINES, 'w') as fid:
+                json.dump(baselines, fid, indent=2, sort_keys=True)
+                fid.write('\n')
+            return measured
+
+        baseline = baselines.get(backend, {}).get(name)
+        if baseline is None:
+            pytest.skip(f'No baseline of {name} on {backend}. Run with --update-baselines.')
+        assert measured['roundtrips'] <= baseline['roundtrips'], f"{name}: {measured['roundtrips']} round trips, baseline {baseline['roundtrips']}"
+        limit = max(baseline['latency'] * TOLERANCE, baseline['latency'] + 1)
+        assert measured['latency'] <= limit, f"{name}: {measured['latency']} ms, baseline {baseline['latency']} ms"
+        return measured
+
+    return measure
+
+def test_getitems(perfapp, benchmark):
+    client = perfapp.test_client()
+    storage = perfapp.extensions['storage']
+
+    benchmark('getitems', storage, lambda: client.get('/items'))
+    benchmark('getitems-filtered', storage, lambda: client.get('/items?styles=stout,porter&maxprice=6&sort=-unitprice&limit=10'))
+
+def test_neworder(perfapp, benchmark):
+    client = perfapp.test_client()
+    storage = perfapp.extensions['storage']
+
+    benchmark('neworder', storage, lambda: client.post('/order/perf/new', json={'order': {'id': '0001', 'quantity': 1}}))
+
+def test_getorders(perfapp, benchmark):
+    client = perfapp.test_client()
+    storage = perfapp.extensions['storage']
+    now = datetime.now(timezone.utc)
+    storage.storage.orders.insert_many([
+        {**queued('new', f'{count + 1:06d}', '0001', 1, user='perf'), 'creationtime': now - timedelta(minutes=count), 'status': 'confirmed'}
+        for count in range(500)
+    ])
+
+    benchmark('getorders', storage, lambda: client.get('/orders/perf'))
+    start = (now - timedelta(minutes=50)).isoformat()
+    benchmark('getorders-range', storage, lambda: client.get('/orders/perf', query_string={'start': start}))
+
+def test_queuehandler_batch(perfapp, benchmark):
+    storage = perfapp.extensions['storage']
+    handler = QueueHandler(database={}, polling=1)
+    items = [item['id'] for item in storage.storage.items.find({}, {'_id': False, 'id': True})][:50]
+
+    # new orders on 50 items, then modifications and deletions of some of them
+    batch = [queued('new', f'{count + 1:06d}', items[count % len(items)], 1, user='perf') for count in range(400)]
+    storage.storage.orders.insert_many([{**order} for order in batch])
+    batch += [queued('modify', f'{count + 1:06d}', items[count % len(items)], 1, user='perf') for count in range(50)]
+    batch += [queued('delete', f'{count + 1:06d}', items[count % len(items)], 1, user='perf') for count in range(50, 100)]
+
+    benchmark('queuehandler-batch', storage, lambda: handler.process(batch, storage.orders, storage.items, storage.deadletter), repeat=5)
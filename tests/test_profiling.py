@@ -0,0 +1,82 @@
+import threading
+from types import SimpleNamespace
+from beershop.utils.config import Config
+from beershop.utils.profiling import CommandProfiler, RouteProfile
+from beershop.utils.queuewriter import QueueWriter
+
+
+def test_route_profile():
+    profile = RouteProfile([1, 10, 100])
+    for elapsed in [0.5, 5, 5, 50, 500]:
+        profile.add(elapsed, None)
+
+    assert profile.counts == [1, 2, 1, 1]
+    assert profile.quantile(0.5) == 10
+    assert profile.quantile(0.99) == 500
+
+def test_command_profiler():
+    listener = CommandProfiler()
+
+    # commands outside of a request are not counted
+    listener.started(SimpleNamespace(command={'find': 'items'}, command_name='find'))
+
+    listener.begin()
+    listener.started(SimpleNamespace(command={'find': 'items'}, command_name='find'))
+    listener.succeeded(SimpleNamespace(reply={'ok': 1}, duration_micros=1500))
+    listener.started(SimpleNamespace(command={'insert': 'orders'}, command_name='insert'))
+    listener.succeeded(SimpleNamespace(reply={'ok': 1}, duration_micros=500))
+    stats = listener.end()
+
+    assert stats.commands == 2
+    assert stats.names == {'find': 1, 'insert': 1}
+    assert stats.dbtime == 2.0
+    assert stats.bytessent > 0
+
+class ProfiledCollection:
+    """Collection sending one command per insert_many, seen by the listener"""
+    def __init__(self, listener):
+        self.listener = listener
+        self.calls = 0
+
+    def insert_many(self, documents, **kwargs):
+        self.calls += 1
+        for document in documents:
+            document['_id'] = document['id']
+        self.listener.started(SimpleNamespace(command={'insert': 'orderqueue', 'documents': documents}, command_name='insert'))
+        self.listener.succeeded(SimpleNamespace(reply={'ok': 1, 'n': len(documents)}, duration_micros=2000))
+
+def test_group_commit_profiled():
+    listener = CommandProfiler()
+    collection = ProfiledCollection(listener)
+    writer = QueueWriter(window=0.2, batchsize=4, listener=listener)
+
+    # the insert sent by the writer thread is counted by every request of the group
+    stats = {}
+    def request(number):
+        listener.begin()
+        writer.append(collection, {'id': f'{number:06d}'})
+        stats[number] = listener.end()
+    threads = [threading.Thread(target=request, args=(number,)) for number in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert collection.calls == 1
+    assert all(stats[number].commands == 1 and stats[number].dbtime == 2.0 for number in range(4))
+    assert all(stats[number].names == {'insert': 1} and stats[number].bytessent > 0 for number in range(4))
+
+def test_profile_endpoint(memory_app):
+    app = memory_app(admin={'token': 'secret'}, profiling={**Config._PROFILING_DEFAULTS, 'enabled': True, 'servertiming': True})
+    client = app.test_client()
+
+    response = client.get('/item/0001')
+    assert response.headers['Server-Timing'].startswith('app;dur=')
+    client.get('/item/0002')
+
+    report = client.get('/admin/profile', headers={'X-Admin-Token': 'secret'}).json
+    assert report['routes']['GET /item/<iditem>']['requests'] == 2
+
+    client.post('/admin/profile/reset', headers={'X-Admin-Token': 'secret'})
+    report = client.get('/admin/profile', headers={'X-Admin-Token': 'secret'}).json
+    assert 'GET /item/<iditem>' not in report['routes']
@@ -0,0 +1,178 @@
+import time
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from beershop.utils.queuehandler import QueueHandler, requeue, prioritize
+from beershop.utils.storage import MemoryStorage
+
+
+def queued(type, idorder, iditem, quantity, user='user'):
+    order = {
+        'type': type,
+        'id': idorder,
+        'order': {'id': iditem, 'quantity': quantity},
+        'user': user,
+        'creationtime': datetime.now(timezone.utc),
+        'nmodified': 0,
+        'lastmodified': None,
+        'status': 'processing',
+        'laststatuschange': datetime.now(timezone.utc)
+    }
+    return order
+
+def test_batch_coalesced(storage):
+    storage.items.insert_one({'id': '0101', 'instock': 10, 'limitoutofstock': 3})
+
+    # three new orders on the same item, then a modify and a delete
+    batch = [
+        queued('new', '000101', '0101', 4),
+        queued('new', '000102', '0101', 5),
+        queued('new', '000103', '0101', 3),
+        queued('modify', '000101', '0101', 1),
+        queued('delete', '000102', '0101', 5),
+    ]
+    storage.orders.insert_many([{**order} for order in batch[:3]])
+
+    handler = QueueHandler(database={}, polling=1)
+    updates = handler.process(batch, storage.orders, storage.items)
+
+    # third order exceeds the stock left when it arrived
+    assert updates[('000101', 'user')]['status'] == 'confirmed'
+    assert updates[('000101', 'user')]['order']['quantity'] == 1
+    assert updates[('000102', 'user')]['status'] == 'deleted'
+    assert updates[('000103', 'user')]['status'] == 'canceled'
+
+    # stock: 10 - 4 - 5 + 3 (modify) + 5 (delete)
+    assert storage.items.find_one({'id': '0101'})['instock'] == 9
+    assert storage.orders.find_one({'id': '000101'})['nmodified'] == 1
+
+def test_delete_canceled_order(storage):
+    storage.items.insert_one({'id': '0102', 'instock': 2, 'limitoutofstock': 3})
+    batch = [
+        queued('new', '000201', '0102', 3),
+        queued('delete', '000201', '0102', 3),
+    ]
+    storage.orders.insert_one({**batch[0]})
+
+    handler = QueueHandler(database={}, polling=1)
+    handler.process(batch, storage.orders, storage.items)
+
+    # a canceled order never held stock, so deleting it releases nothing
+    assert storage.items.find_one({'id': '0102'})['instock'] == 2
+    assert storage.orders.find_one({'id': '000201'})['status'] == 'deleted'
+
+def test_faulty_orders_isolated(storage):
+    storage.items.insert_one({'id': '0103', 'instock': 10, 'limitoutofstock': 3})
+    storage.orders.insert_one({'id': '000301', 'user': 'user', 'status': 'confirmed', 'order': {'id': '0103', 'quantity': 1}})
+    batch = [
+        {'_id': 1, 'dummy': 'dummy'},
+        {'_id': 2, 'type': 'new', 'id': '000302', 'user': 'user', 'order': {'id': '0103'}},
+        queued('delete', '000301', '0103', 1),
+        queued('new', '000303', '0103', 2),
+    ]
+    storage.orders.insert_one({**batch[3]})
+
+    handler = QueueHandler(database={}, polling=1)
+    updates = handler.process(batch, storage.orders, storage.items, storage.deadletter)
+
+    # the order behind the faulty ones is still processed
+    assert updates[('000303', 'user')]['status'] == 'confirmed'
+    assert storage.items.find_one({'id': '0103'})['instock'] == 8
+
+    # the seed of the queue is skipped, the malformed order and the order without nmodified are dead letters
+    deadletters = {doc['stage']: doc for doc in storage.deadletter.find()}
+    assert set(deadletters) == {'validate', 'apply'}
+    assert deadletters['validate']['error'].startswith('Wrong quantity')
+    assert deadletters['apply']['queued']['id'] == '000301'
+    assert deadletters['apply']['attempts'] == 1
+
+def test_requeue():
+    storage = MemoryStorage()
+    storage.create_queue(100, 1000)
+    storage.deadletter.insert_many([
+        {'queued': queued('delete', '000401', '0104', 1), 'error': 'KeyError', 'stage': 'apply', 'attempts': 1},
+        {'queued': queued('delete', '000402', '0104', 1), 'error': 'KeyError', 'stage': 'apply', 'attempts': 3},
+    ])
+
+    assert requeue(storage) == (1, 1)
+    assert storage.queue.find_one({'id': '000401'})['attempts'] == 1
+    assert storage.deadletter.count_documents({}) == 1
+
+    # orders that failed too many times are requeued only without limit
+    assert requeue(storage, maxattempts=None) == (1, 0)
+    assert storage.deadletter.count_documents({}) == 0
+
+def test_prioritize():
+    batch = [
+        queued('new', '000501', '0105', 1),
+        queued('delete', '000500', '0105', 1),
+        queued('modify', '000501', '0105', 1),
+        queued('new', '000502', '0105', 1),
+        queued('delete', '000501', '0105', 1),
+    ]
+    ahead = [queued('modify', '000499', '0105', 1), queued('delete', '000501', '0105', 1)]
+
+    # releasing operations first, but never before the creation of their order
+    ordered = prioritize(batch, ahead)
+    assert [(order['type'], order['id']) for order in ordered] == [
+        ('delete', '000500'), ('modify', '000499'), ('new', '000501'), ('modify', '000501'), ('new', '000502'), ('delete', '000501'),
+    ]
+
+def test_lookahead():
+    storage = MemoryStorage()
+    storage.create_queue(100, 100000)
+    storage.items.insert_one({'id': '0106', 'instock': 0, 'limitoutofstock': 3})
+    storage.orders.insert_one({**queued('new', '000600', '0106', 5), 'status': 'confirmed'})
+
+    # a new order that would find no stock, the deletion releasing it, and a later order and deletion
+    orders = [
+        queued('new', '000601', '0106', 3),
+        queued('new', '000602', '0106', 2),
+        queued('delete', '000600', '0106', 5),
+        queued('delete', '000602', '0106', 2),
+    ]
+    storage.orders.insert_many([{**order} for order in orders[:2]])
+    start = datetime.now(timezone.utc) - timedelta(seconds=1)
+    for order in orders:
+        storage.queue.insert_one(order)
+
+    handler = QueueHandler(database={}, polling=0.01, batchsize=1, lookahead=10)
+    handler.start(storage, starttime=start)
+    deadline = time.monotonic() + 5
+    while storage.orders.find_one({'id': '000602'})['status'] != 'deleted':
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    # the deletion of the confirmed order is applied ahead of the first new order, the deletion of
+    # the second order waits for it to be confirmed
+    assert storage.orders.find_one({'id': '000601'})['status'] == 'confirmed'
+    assert storage.orders.find_one({'id': '000600'})['status'] == 'deleted'
+    time.sleep(0.1)
+    assert storage.items.find_one({'id': '0106'})['instock'] == 2
+
+def test_lookahead_unordered():
+    storage = MemoryStorage()
+    storage.create_queue(100, 100000)
+    storage.items.insert_one({'id': '0107', 'instock': 0, 'limitoutofstock': 3})
+    storage.orders.insert_one({**queued('new', '000700', '0107', 5), 'status': 'confirmed'})
+
+    # the deletion is queued after the new order, with a lower '_id' generated by another worker
+    orders = [queued('new', '000701', '0107', 3), queued('delete', '000700', '0107', 5)]
+    storage.orders.insert_one({**orders[0]})
+    ids = sorted(ObjectId() for _ in orders)
+    start = datetime.now(timezone.utc) - timedelta(seconds=1)
+    for order, queueid in zip(orders, reversed(ids)):
+        storage.queue.insert_one({**order, '_id': queueid})
+
+    handler = QueueHandler(database={}, polling=0.01, batchsize=1, lookahead=10)
+    handler.start(storage, starttime=start)
+    deadline = time.monotonic() + 5
+    while storage.orders.find_one({'id': '000700'})['status'] != 'deleted':
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    time.sleep(0.1)
+    handler.stop()
+
+    # the deletion is applied ahead of the new order and skipped when the queue reaches it
+    assert storage.orders.find_one({'id': '000701'})['status'] == 'confirmed'
+    assert storage.items.find_one({'id': '0107'})['instock'] == 2
+    assert not handler._ahead and not handler._readahead
@@ -0,0 +1,73 @@
+import threading
+import time
+import pytest
+from bson import ObjectId
+from pymongo import errors
+from beershop.utils.queuewriter import QueueWriter, _Append
+from beershop.utils.storage import MemoryStorage
+
+
+class SpyCollection:
+    def __init__(self, collection):
+        self.collection = collection
+        self.calls = []
+
+    def insert_many(self, documents, **kwargs):
+        self.calls.append(len(documents))
+        return self.collection.insert_many(documents, **kwargs)
+
+def test_group_commit():
+    storage = MemoryStorage()
+    storage.create_queue(1000, 100000)
+    collection = SpyCollection(storage.queue)
+    writer = QueueWriter(window=0.2, batchsize=100)
+
+    # concurrent appends are written together, and every request gets its own acknowledgement
+    ids = {}
+    def append(number):
+        ids[number] = writer.append(collection, {'id': f'{number:06d}'})
+    threads = [threading.Thread(target=append, args=(number,)) for number in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(collection.calls) == 20 and len(collection.calls) < 20
+    assert {storage.queue.find_one({'_id': ids[number]})['id'] for number in range(20)} == {f'{number:06d}' for number in range(20)}
+
+def test_batchsize():
+    storage = MemoryStorage()
+    storage.create_queue(1000, 100000)
+    collection = SpyCollection(storage.queue)
+    writer = QueueWriter(window=1, batchsize=1)
+
+    # a full batch is written without waiting for the window
+    begin = time.monotonic()
+    assert writer.append(collection, {'id': '000001'}) is not None
+    assert time.monotonic() - begin < 0.5
+    assert collection.calls == [1]
+
+def test_failed_order(storage):
+    # the failing order does not fail the orders before and after it
+    duplicate = storage.queue.insert_one({'id': '000001'}).inserted_id
+    batch = [
+        _Append(storage.queue, {'id': '000002'}),
+        _Append(storage.queue, {'_id': duplicate, 'id': '000003'}),
+        _Append(storage.queue, {'id': '000004'}),
+    ]
+    QueueWriter().write(batch)
+
+    assert isinstance(batch[0].future.result(), ObjectId)
+    with pytest.raises(errors.DuplicateKeyError):
+        batch[1].future.result()
+    assert isinstance(batch[2].future.result(), ObjectId)
+    assert sorted(order['id'] for order in storage.queue.find({})) == ['000001', '000002', '000004']
+
+def test_api(memory_app):
+    app = memory_app(queuewriter={'enabled': True, 'window': 0.001, 'batchsize': 10})
+    storage = app.extensions['storage']
+    client = app.test_client()
+
+    response = client.post('/order/user/new', json={'order': {'id': '0001', 'quantity': 3}})
+    assert response.json == {'message': '000001', 'status': 'processing'}
+    assert storage.queue.find_one({'id': '000001'})['type'] == 'new'
@@ -0,0 +1,30 @@
+import pytest
+from pymongo import MongoClient, read_preferences
+from beershop.utils.config import Config
+from beershop.utils.db import read_preference
+from beershop.utils.storage import MongoStorage
+
+
+def test_config(config_file):
+    config = Config.load(config_file(readpreference='{getitems: {mode: secondaryPreferred, maxstaleness: 90}}'))
+
+    assert config.readpreference['getitems'] == {'mode': 'secondaryPreferred', 'maxstaleness': 90}
+    assert config.readpreference['getorderbyid'] == {'mode': 'primary', 'maxstaleness': -1}
+
+def test_config_errors(config_file):
+    # write routes always read from the primary
+    with pytest.raises(SystemExit):
+        Config.load(config_file(readpreference='{neworder: {mode: secondary}}'))
+
+    # staleness below the minimum accepted by MongoDB
+    with pytest.raises(SystemExit):
+        Config.load(config_file(readpreference='{getitems: {mode: secondary, maxstaleness: 10}}'))
+
+def test_storage_read_preference():
+    client = MongoClient('127.0.0.1', 27017, connect=False)
+    storage = MongoStorage(client['beershop-test'])
+
+    secondary = storage.with_read_preference(read_preference({'mode': 'secondaryPreferred', 'maxstaleness': 120}))
+
+    assert secondary.items.read_preference == read_preferences.SecondaryPreferred(max_staleness=120)
+    assert storage.items.read_preference == read_preferences.Primary()
@@ -0,0 +1,68 @@
+import pymongo
+import pytest
+from beershop.utils.schema import ORDERS, ITEMS, MappedStorage, migrate
+from beershop.utils.storage import MemoryStorage
+from tests.conftest import load_collection
+
+
+@pytest.fixture()
+def seeded_client(memory_app):
+    def make(schema):
+        app = memory_app(orders=load_collection('orders'), schema=schema)
+        return app.test_client(), app.extensions['storage']
+    return make
+
+def test_roundtrip():
+    for order in load_collection('orders'):
+        encoded = ORDERS.encode(order)
+        assert 'type' not in encoded and isinstance(encoded['i'], int)
+        assert ORDERS.decode(encoded) == order
+
+    for item in load_collection('items'):
+        assert ITEMS.decode(ITEMS.encode(item)) == item
+
+def test_compact_documents(seeded_client):
+    _, storage = seeded_client('compact')
+
+    stored = storage.storage.orders.find_one({'i': 1})
+    assert stored['s'] == 3 and stored['o'] == {'i': 6, 'q': 1}
+
+    # queries and updates use the names of the application
+    storage.orders.update_one({'id': '000002', 'user': 'user'}, {'$set': {'status': 'canceled', 'lastmodified': None}})
+    assert storage.orders.find_one({'status': 'canceled'}, {'_id': False, 'id': True}) == {'id': '000002'}
+
+@pytest.mark.parametrize('path', ['/items', '/item/0001', '/orders/user', '/order/user/000001/get', '/order/user/000002/get'])
+def test_api_unchanged(seeded_client, path):
+    standard, _ = seeded_client('standard')
+    compact, _ = seeded_client('compact')
+
+    assert standard.get(path).json == compact.get(path).json
+
+def test_neworder_compact(seeded_client):
+    client, storage = seeded_client('compact')
+
+    response = client.post('/order/user/new', json={'order': {'id': '0001', 'quantity': 2}})
+    assert response.json['message'] == '000003'
+    assert storage.storage.orders.find_one({'i': 3})['u'] == 'user'
+
+def test_migration():
+    raw = MemoryStorage()
+    raw.orders.insert_many(load_collection('orders'))
+    storage = MappedStorage(raw, legacy=True)
+
+    # new documents are compact, old ones are read in standard form
+    neworder = {key: value for key, value in load_collection('orders')[1].items() if key != '_id'}
+    storage.orders.insert_one({**neworder, 'id': '000003'})
+    assert [order['id'] for order in storage.orders.find({}).sort('id', pymongo.DESCENDING)] == ['000003', '000002', '000001']
+    assert storage.orders.count_documents({'user': 'user'}) == 3
+
+    # an update converts the document first
+    storage.orders.update_one({'id': '000002', 'user': 'user'}, {'$set': {'status': 'paid'}})
+    assert raw.orders.find_one({'i': 2})['s'] == 4
+    assert raw.orders.count_documents({'id': {'$exists': True}}) == 1
+
+    assert migrate(raw, 'orders') == 1
+    assert raw.orders.count_documents({'id': {'$exists': True}}) == 0
+    assert storage.orders.find_one({'id': '000001'}, {'_id': False}) == {
+        key: value for key, value in load_collection('orders')[0].items() if key != '_id'
+    }
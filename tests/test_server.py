@@ -0,0 +1,19 @@
+import sys
+import pytest
+from beershop.tools import cmd
+
+
+def test_serve_memory(config_file, monkeypatch):
+    server = pytest.importorskip('beershop.utils.server')
+    configpath = config_file(database='{name: beershop, backend: memory}', server='{workers: 4, maxrequests: 1000, maxrequestsjitter: 100}')
+
+    # start the server without running it
+    started = {}
+    def run(self):
+        started.update(workers=self.cfg.workers, maxrequests=self.cfg.max_requests, jitter=self.cfg.max_requests_jitter)
+    monkeypatch.setattr(server.BeershopServer, 'run', run)
+    monkeypatch.setattr(sys, 'argv', ['beershop-serve', '-config', configpath])
+    cmd.serve()
+
+    # the single worker holding the memory backend is never recycled
+    assert started == {'workers': 1, 'maxrequests': 0, 'jitter': 0}
@@ -0,0 +1,58 @@
+import pytest
+from beershop.utils.catalog import bump_catalog_version
+from beershop.utils.snapshot import CatalogSnapshot, SnapshotStore, write_snapshot
+from tests.test_catalog import catalog
+
+
+@pytest.fixture()
+def seeded_client(memory_app):
+    def make(tmp_path, snapshot, schema='standard'):
+        app = memory_app(catalog(), schema=schema, snapshot={'enabled': snapshot, 'path': str(tmp_path / 'catalog'), 'refresh': 0})
+        return app.test_client(), app.extensions['storage']
+    return make
+
+def test_layout(tmp_path):
+    items = catalog()
+    write_snapshot(str(tmp_path / 'catalog'), 3, items)
+    snapshot = CatalogSnapshot(str(tmp_path / 'catalog'))
+
+    assert snapshot.version == 3 and len(snapshot) == len(items)
+    assert sorted(snapshot.styles) == ['altbier', 'ipa', 'stout']
+    assert snapshot.get('0002') == {key: value for key, value in items[1].items() if key != 'instock'}
+    assert snapshot.get('9999') is None
+    assert [item['id'] for item in snapshot] == [item['id'] for item in items]
+
+@pytest.mark.parametrize('schema', ['standard', 'compact'])
+@pytest.mark.parametrize('path', ['/items', '/items?styles=stout&sort=-instock&limit=2', '/item/0003', '/item/9999', '/items/facets?bins=3'])
+def test_api_unchanged(seeded_client, tmp_path, schema, path):
+    standard, _ = seeded_client(tmp_path, False, schema)
+    snapshot, _ = seeded_client(tmp_path, True, schema)
+
+    assert standard.get(path).json == snapshot.get(path).json
+
+def test_live_stock(seeded_client, tmp_path):
+    client, storage = seeded_client(tmp_path, True)
+    client.get('/items')
+
+    # the stock is read from the database, the rest of the item from the snapshot
+    storage.items.update_one({'id': '0003'}, {'$set': {'instock': 1, 'content.Name': 'Renamed'}})
+    item = client.get('/item/0003').json
+    assert item['instock'] == 1 and item['content']['Name'] != 'Renamed'
+
+    # a new version of the catalog replaces the snapshot
+    bump_catalog_version(storage)
+    assert client.get('/item/0003').json['content']['Name'] == 'Renamed'
+
+def test_shared_between_workers(seeded_client, tmp_path):
+    _, storage = seeded_client(tmp_path, False)
+    first = SnapshotStore(str(tmp_path / 'shared'), refresh=0)
+    second = SnapshotStore(str(tmp_path / 'shared'), refresh=0)
+
+    # the second worker maps the snapshot written by the first one
+    assert first.get(storage).inode == second.get(storage).inode
+
+    # after a change of the catalog, both map the same new version
+    bump_catalog_version(storage)
+    snapshot = second.get(storage)
+    assert snapshot.version == first.get(storage).version == 2
+    assert first.get(storage).inode == snapshot.inode
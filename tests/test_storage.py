@@ -0,0 +1,101 @@
+import time
+import pymongo
+import pytest
+from datetime import datetime, timezone, timedelta
+from pymongo import UpdateOne, errors
+from beershop.utils.storage import MemoryStorage
+
+
+def test_queries():
+    storage = MemoryStorage()
+    storage.orders.insert_many([
+        {'id': f'{count:06d}', 'user': 'user' if count % 2 else 'other', 'status': 'confirmed', 'creationtime': datetime(2025, 1, count, tzinfo=timezone.utc)}
+        for count in range(1, 11)
+    ])
+
+    # indexed equality, range and sort
+    assert storage.orders.find_one({'id': '000003', 'user': 'user'}, {'_id': False})['status'] == 'confirmed'
+    assert storage.orders.find_one({'id': '000003', 'user': 'other'}) is None
+    found = storage.orders.find({'creationtime': {'$gte': datetime(2025, 1, 4), '$lt': datetime(2025, 1, 7)}, 'user': 'user'})
+    assert [order['id'] for order in found] == ['000005']
+    latest = list(storage.orders.find({}, {'_id': False}).sort('id', pymongo.DESCENDING).limit(1))
+    assert latest[0]['id'] == '000010'
+
+    # datetimes are returned as naive utc, as pymongo does
+    assert latest[0]['creationtime'] == datetime(2025, 1, 10)
+
+    assert storage.orders.count_documents({'$or': [{'id': '000001'}, {'id': {'$in': ['000002', '000004']}}]}) == 3
+
+def test_updates():
+    storage = MemoryStorage()
+    storage.items.insert_one({'id': '0001', 'instock': 10})
+
+    storage.items.bulk_write([UpdateOne({'id': '0001'}, {'$inc': {'instock': -4}})])
+    assert storage.items.find_one({'id': '0001'})['instock'] == 6
+
+    result = storage.items.update_one({'id': '0002'}, {'$set': {'instock': 1}}, upsert=True)
+    assert result.upserted_id is not None
+    assert storage.items.find_one({'id': '0002'})['instock'] == 1
+
+    item = storage.items.find_one_and_update(
+        {'id': '0001', 'instock': {'$gte': 6}},
+        {'$inc': {'instock': -6}},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    assert item['instock'] == 0
+
+    storage.items.create_index('id', unique=True)
+    with pytest.raises(errors.DuplicateKeyError):
+        storage.items.insert_one({'id': '0001'})
+
+    # as in MongoDB, an ordered insert_many stops at the first failing document, reported by index
+    with pytest.raises(errors.BulkWriteError) as err:
+        storage.items.insert_many([{'id': '0003'}, {'id': '0001'}, {'id': '0004'}])
+    assert err.value.details['nInserted'] == 1 and err.value.details['writeErrors'][0]['index'] == 1
+    assert storage.items.find_one({'id': '0004'}) is None
+
+def test_tailable_queue():
+    storage = MemoryStorage()
+    storage.create_queue(3, 1000)
+    starttime = datetime.now(timezone.utc)
+
+    storage.queue.insert_one({'type': 'new', 'creationtime': starttime - timedelta(seconds=1)})
+    cursor = storage.queue.find(
+        {'creationtime': {'$gt': starttime}},
+        cursor_type=pymongo.CursorType.TAILABLE_AWAIT
+    ).max_await_time_ms(10)
+
+    # no document after the start time
+    assert cursor.try_next() is None
+
+    for count in range(5):
+        storage.queue.insert_one({'type': 'new', 'count': count, 'creationtime': starttime + timedelta(seconds=1)})
+
+    # capped collection keeps only the latest documents
+    assert storage.queue.count_documents({}) == 3
+    assert [cursor.next()['count'] for _ in range(3)] == [2, 3, 4]
+    assert cursor.try_next() is None
+
+def test_memory_backend(client, app):
+    response = client.post('/order/user/new', json={'order': {'id': '0001', 'quantity': 2}})
+    idorder = response.json['message']
+
+    # the order is confirmed by the queue handler running in the same process
+    storage = app.extensions['storage']
+    deadline = time.monotonic() + 5
+    while storage.orders.find_one({'id': idorder})['status'] == 'processing' and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert storage.orders.find_one({'id': idorder})['status'] == 'confirmed'
+
+def test_memory_backend_stop(app):
+    if 'queuehandler' not in app.extensions:
+        pytest.skip('Memory backend only.')
+    handler = app.extensions['queuehandler']
+    thread = handler._thread
+
+    # the queue handler thread ends without waiting for the polling interval
+    begin = time.monotonic()
+    handler.stop(timeout=5)
+    assert not thread.is_alive()
+    assert time.monotonic() - begin < 0.5
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta, timezone
+from beershop.utils.engine import OrderEngine
+from beershop.utils.queuehandler import QueueHandler
+from beershop.utils.storage import MemoryStorage, Storage
+from beershop.utils.velocity import minute, velocity
+from tests.test_queuehandler import queued
+
+
+def test_engine_counts():
+    engine = OrderEngine({'0101': 10, '0102': 1})
+    engine.apply(queued('new', '000101', '0101', 4))
+    engine.apply(queued('new', '000102', '0101', 3))
+    engine.apply(queued('new', '000103', '0102', 2))
+    engine.apply(queued('modify', '000101', '0101', 1))
+    engine.apply(queued('delete', '000102', '0101', 3))
+
+    # canceled orders are neither sold nor released
+    assert engine.sold == {'0101': 7}
+    assert engine.released == {'0101': 6}
+    assert engine.stock == {'0101': 9, '0102': 1}
+
+def test_buckets():
+    storage = MemoryStorage()
+    storage.items.insert_many([
+        {'id': '0101', 'instock': 10, 'limitoutofstock': 3},
+        {'id': '0102', 'instock': 10, 'limitoutofstock': 3},
+    ])
+    handler = QueueHandler(database={}, polling=1)
+
+    # batches of the same minute add up in the same bucket. The canceled order is not recorded
+    handler.process([queued('new', '000102', '0101', 3)], storage.orders, storage.items, collection_velocity=storage[Storage.VELOCITY])
+    handler.process([queued('new', '000103', '0101', 1), queued('new', '000104', '0102', 20)], storage.orders, storage.items, collection_velocity=storage[Storage.VELOCITY])
+
+    buckets = list(storage[Storage.VELOCITY].find({}, {'_id': False}).sort('minute', 1))
+    assert {bucket['item'] for bucket in buckets} == {'0101'}
+    assert sum(bucket['sold'] for bucket in buckets) == 4 and buckets[-1]['instock'] == 6
+    assert all(bucket['minute'].second == 0 for bucket in buckets)
+
+def test_depletion():
+    storage = MemoryStorage()
+    now = minute(datetime.now(timezone.utc))
+    storage[Storage.VELOCITY].insert_many([
+        {'item': '0101', 'minute': now - timedelta(minutes=2), 'sold': 8, 'released': 2, 'instock': 22},
+        {'item': '0101', 'minute': now - timedelta(minutes=1), 'sold': 4, 'released': 0, 'instock': 18},
+        {'item': '0102', 'minute': now - timedelta(minutes=1), 'sold': 5, 'released': 0, 'instock': 5},
+    ])
+
+    # net rate of 10 items in 5 minutes, 15 items above the limit
+    result = velocity(storage[Storage.VELOCITY], {'id': '0101', 'instock': 18, 'limitoutofstock': 3}, now - timedelta(minutes=5), now)
+    assert [bucket['sold'] for bucket in result['buckets']] == [8, 4]
+    assert (result['sold'], result['released'], result['rate'], result['depletion']) == (12, 2, 2, 7.5)
+
+    # no estimate when the stock is not decreasing, none left at the limit
+    assert velocity(storage[Storage.VELOCITY], {'id': '0103', 'instock': 18, 'limitoutofstock': 3}, now - timedelta(minutes=5), now)['depletion'] is None
+    assert velocity(storage[Storage.VELOCITY], {'id': '0102', 'instock': 3, 'limitoutofstock': 3}, now - timedelta(minutes=5), now)['depletion'] == 0
+
+def test_endpoint(memory_app):
+    app = memory_app([], velocity={'enabled': True})
+    storage = app.extensions['storage']
+    storage.items.insert_one({'id': '0101', 'instock': 10, 'limitoutofstock': 3})
+    storage[Storage.VELOCITY].insert_one({'item': '0101', 'minute': minute(datetime.now(timezone.utc)) - timedelta(minutes=1), 'sold': 7, 'released': 0, 'instock': 10})
+    client = app.test_client()
+
+    response = client.get('/items/0101/velocity')
+    assert response.json['sold'] == 7 and len(response.json['buckets']) == 1
+    assert response.json['depletion'] == (10 - 3) / (7 / 60)
+
+    # a range before the sales
+    end = (datetime.now(timezone.utc) - timedelta(hours=1)).isoformat()
+    assert client.get('/items/0101/velocity', query_string={'end': end}).json['buckets'] == []
+
+    assert client.get('/items/0199/velocity').json == {'message': '0199 not found.'}
+    assert 'Wrong format' in client.get('/items/0101/velocity', query_string={'start': 'yesterday'}).json['message']